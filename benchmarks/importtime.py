@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark of the adapter: the import time of every subcommand (python -X importtime), checked against the
+budget of benchmarks/importtime_budget.json (in milliseconds).
+
+Without --run_info, only the imports at the start of the adapter are measured (the subcommand is called with -h).
+With --run_info, the subcommands are run on that run_info.xml (use a scratch copy of the model folder), so the
+imports of their code paths are measured too.
+
+    python benchmarks/importtime.py [--run_info run_info.xml] [--budget importtime_budget.json] [pre run post]
+"""
+import argparse as ap
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+benchmark_dir = Path(__file__).resolve().parents[0]
+adapter_script = benchmark_dir.parents[0] / "src" / "epaswmmadaptor" / "epaswmm.py"
+
+
+def import_times(stderr):
+    """
+    Parse the output of python -X importtime: (cumulative time in us, module) of the top-level imports.
+    """
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # header line
+        if fields[2].startswith("  "):
+            continue  # imported by another module, already in its cumulative time
+        times.append((int(fields[1]), fields[2].strip()))
+    return times
+
+
+def measure(subcommand, run_info=None, repeat=3):
+    """
+    Best total import time (ms) of a subcommand over repeat runs, with the heaviest top-level imports of that run.
+    """
+    if run_info is None:
+        command = [sys.executable, "-X", "importtime", str(adapter_script), "--run_info", "run_info.xml",
+                   subcommand, "-h"]
+    else:
+        command = [sys.executable, "-X", "importtime", str(adapter_script), "--run_info", str(run_info), subcommand]
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        times = import_times(result.stderr)
+        total = sum(t for t, _ in times) / 1000.0
+        if best is None or total < best[0]:
+            best = (total, sorted(times, reverse=True)[:5], result.returncode)
+    return best
+
+
+def main(argv=None):
+    parser = ap.ArgumentParser(description="Import time of the adapter subcommands, checked against a budget")
+    parser.add_argument("subcommands", nargs="*", default=["pre", "run", "post"],
+                        help="subcommands to measure (default: pre run post)")
+    parser.add_argument("--run_info", help="run_info.xml on which the subcommands are run")
+    parser.add_argument("--budget", default=str(benchmark_dir / "importtime_budget.json"),
+                        help="JSON file with the budget of every subcommand, in milliseconds")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of every subcommand (best is kept)")
+    args = parser.parse_args(argv)
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    over = []
+    for subcommand in args.subcommands:
+        total, heaviest, returncode = measure(subcommand, args.run_info, args.repeat)
+        limit = budget.get(subcommand)
+        status = "OK" if limit is None or total <= limit else "OVER BUDGET"
+        print("{0:<10} {1:8.1f} ms  (budget {2} ms)  {3}".format(subcommand, total, limit, status))
+        for t, module in heaviest:
+            print("    {0:8.1f} ms  {1}".format(t / 1000.0, module))
+        if returncode != 0:
+            print("    exit code {0}: see the log of the adapter".format(returncode))
+        if status != "OK":
+            over.append(subcommand)
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
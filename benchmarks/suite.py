@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the adapter on synthetic inputs (see benchmarks/synthetic.py) at several scales: run time (best of
+--repeat runs) and peak memory (tracemalloc, in a separate run) of read_rpt_file, create_xarray_dataset,
+write_netcdf, write_runfile, write_rainfall, read_control_rules and read_diagnostics. The results are written to a
+JSON file, which can be compared with the results of another commit:
+
+    python benchmarks/suite.py --scales small medium --output results.json [--compare previous.json]
+
+tracemalloc only sees the memory allocated through Python (including NumPy arrays), not the buffers of the NetCDF
+library.
+"""
+import argparse as ap
+import contextlib
+import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import synthetic
+
+benchmark_dir = Path(__file__).resolve().parents[0]
+repo_dir = benchmark_dir.parents[0]
+units_file = repo_dir / "tests" / "module_adapter" / "Don" / "model" / "UDUNITS_lookup.csv"
+
+# nodes, links and subcatchments x report steps of the *.rpt file, rating curves of the *.inp file, control rule
+# series x events, rainfall stations x time steps
+scales = {
+    "small": {"nodes": 50, "links": 50, "subcatchments": 50, "steps": 96, "curves": 10, "rules": 10,
+              "events": 96, "stations": 10, "rain_steps": 96},
+    "medium": {"nodes": 500, "links": 500, "subcatchments": 500, "steps": 288, "curves": 100, "rules": 100,
+               "events": 288, "stations": 100, "rain_steps": 288},
+    "large": {"nodes": 2000, "links": 2000, "subcatchments": 2000, "steps": 1440, "curves": 500, "rules": 500,
+              "events": 1440, "stations": 500, "rain_steps": 1440},
+}
+
+
+def measure(function, repeat, setup=None):
+    """
+    Best run time (s) of function() over repeat runs, and its peak memory (MB) in one more run with tracemalloc.
+    setup() is called before every run, outside of the measure.
+    """
+    best = None
+    # the messages printed by the adapter are not shown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            t0 = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak / 2 ** 20
+
+
+def remove(*files):
+    for file in files:
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+
+def run_scale(epaswmm, name, size, work_dir, repeat):
+    """
+    Benchmarks of one scale; returns one result per function.
+    """
+    work_dir = Path(work_dir) / name
+    work_dir.mkdir(parents=True, exist_ok=True)
+    rpt = work_dir / "model.rpt"
+    template = work_dir / "template.inp"
+    inp = work_dir / "model.inp"
+    curves = work_dir / "Dam_rating_curve.xml"
+    rules = work_dir / "Control_rules.xml"
+    rain = work_dir / "rain.nc"
+    dat = work_dir / "rain.dat"
+    synthetic.write_rpt(rpt, size["nodes"], size["links"], size["steps"], size["subcatchments"])
+    synthetic.write_inp(template, size["curves"])
+    synthetic.write_rating_curves(curves, size["curves"])
+    synthetic.write_control_rules(rules, size["rules"], size["events"])
+    synthetic.write_rainfall_netcdf(rain, size["stations"], size["rain_steps"])
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        swmm_unit_dict = epaswmm.read_units(units_file)
+        data_dict = epaswmm.read_rpt_file(rpt, object_types=("Node", "Link"))
+        ds_nodes, ds_links = epaswmm.create_xarray_dataset(data_dict, swmm_unit_dict)
+    # times as datetime.datetime, as read_run_info returns them
+    run_info = {"start_time": synthetic.start_time, "end_time": synthetic.report_times(size["steps"])[-1],
+                "properties": {"swmm_input_file": inp, "swmm_template_file": template, "inp_cache": False}}
+    rating_curve = epaswmm.read_rating_curve(curves)
+    control_rule = epaswmm.read_control_rules(rules)
+
+    benchmarks = {
+        "read_rpt_file": (lambda: epaswmm.read_rpt_file(rpt, object_types=("Node", "Link")), None,
+                          {"nodes": size["nodes"], "links": size["links"], "subcatchments": size["subcatchments"],
+                           "steps": size["steps"], "bytes": rpt.stat().st_size}),
+        "create_xarray_dataset": (lambda: epaswmm.create_xarray_dataset(data_dict, swmm_unit_dict), None,
+                                  {"locations": len(data_dict), "steps": size["steps"]}),
+        "write_netcdf": (lambda: (epaswmm.write_netcdf(ds_nodes, work_dir / "nodes.nc"),
+                                  epaswmm.write_netcdf(ds_links, work_dir / "links.nc")), None,
+                         {"nodes": size["nodes"], "links": size["links"], "steps": size["steps"]}),
+        "write_runfile": (lambda: epaswmm.write_runfile(run_info, rating_curve, control_rule), None,
+                          {"curves": size["curves"], "rules": size["rules"], "events": size["events"]}),
+        # the .DAT file and its digest are removed, so that the file is written again at every run
+        "write_rainfall": (lambda: epaswmm.write_rainfall(rain, dat), lambda: remove(dat, str(dat) + ".digest"),
+                           {"stations": size["stations"], "steps": size["rain_steps"]}),
+        "read_control_rules": (lambda: epaswmm.read_control_rules(rules), None,
+                               {"series": size["rules"], "events": size["events"], "bytes": rules.stat().st_size}),
+        "read_diagnostics": (lambda: epaswmm.read_diagnostics([rpt]), None, {"bytes": rpt.stat().st_size}),
+    }
+    results = []
+    for function, (run, setup, params) in benchmarks.items():
+        seconds, peak_mb = measure(run, repeat, setup)
+        print("{0:<8} {1:<22} {2:9.3f} s {3:9.1f} MB".format(name, function, seconds, peak_mb))
+        results.append({"scale": name, "function": function, "params": params, "seconds": seconds,
+                        "peak_mb": peak_mb})
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(repo_dir), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, previous_file):
+    """
+    Print the ratio of the run times and peak memory of results over the results of previous_file.
+    """
+    with open(previous_file) as f:
+        previous = {(r["scale"], r["function"]): r for r in json.load(f)["results"]}
+    print("\nCompared with {0}:".format(previous_file))
+    for r in results:
+        old = previous.get((r["scale"], r["function"]))
+        if old is not None:
+            print("{0:<8} {1:<22} time x{2:6.2f}  memory x{3:6.2f}".format(
+                r["scale"], r["function"], r["seconds"] / max(old["seconds"], 1e-9),
+                r["peak_mb"] / max(old["peak_mb"], 1e-9)))
+
+
+def main(argv=None):
+    parser = ap.ArgumentParser(description="Benchmarks of the adapter on synthetic inputs")
+    parser.add_argument("--scales", nargs="*", default=["small", "medium"], choices=sorted(scales),
+                        help="scales to run (default: small medium)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs (best is kept)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of previous results to compare with")
+    parser.add_argument("--work_dir", help="folder of the synthetic inputs (default: a temporary folder)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(args.work_dir or tmp).resolve()
+        work_dir.mkdir(parents=True, exist_ok=True)
+        # The adapter logs to the working directory when it is imported
+        cwd = os.getcwd()
+        os.chdir(str(work_dir))
+        try:
+            sys.path.insert(0, str(repo_dir / "src"))
+            from epaswmmadaptor import epaswmm
+            # as the command line adapter does, rather than the DEBUG level of an import
+            epaswmm.main_logger.setLevel(logging.INFO)
+            results = []
+            for name in args.scales:
+                results += run_scale(epaswmm, name, scales[name], work_dir, args.repeat)
+            for handler in epaswmm.main_logger.handlers:
+                handler.close()  # so that the temporary folder can be removed on Windows
+        finally:
+            os.chdir(cwd)
+
+    report = {"commit": git_commit(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "versions": {module: sys.modules[module].__version__ for module in ("numpy", "pandas", "xarray")
+                           if module in sys.modules},
+              "repeat": args.repeat, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to: {0}".format(args.output))
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
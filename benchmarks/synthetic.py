@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic inputs of the adapter for the benchmarks (see benchmarks/suite.py), in the layout of the Don test model:
+EPA SWMM report (*.rpt) and input (*.inp) files, FEWS rating curves and control rules (PI-XML) and FEWS rainfall
+(NetCDF) files of configurable size.
+"""
+import datetime
+
+import numpy as np
+
+start_time = datetime.datetime(2020, 3, 18, 20, 0)
+time_step = datetime.timedelta(minutes=15)
+
+rpt_tables = {
+    "Subcatchment": ["  ---------------------------------------------------\n",
+                     "  Date        Time        Precip.    Losses    Runoff\n",
+                     "                            in/hr     in/hr       CFS\n",
+                     "  ---------------------------------------------------\n"],
+    "Node": ["  ----------------------------------------------------------------\n",
+             "                           Inflow  Flooding     Depth      Head\n",
+             "  Date        Time            CFS       CFS      feet      feet\n",
+             "  ----------------------------------------------------------------\n"],
+    "Link": ["  ----------------------------------------------------------------\n",
+             "                             Flow  Velocity     Depth  Capacity/\n",
+             "  Date        Time            CFS    ft/sec      feet   Setting \n",
+             "  ----------------------------------------------------------------\n"],
+}
+
+
+def report_times(steps):
+    """
+    Times of the report steps, after the start time.
+    """
+    return [start_time + (i + 1) * time_step for i in range(steps)]
+
+
+def write_rpt(rpt_file, nodes, links, steps, subcatchments=0, seed=0):
+    """
+    EPA SWMM report file with the timeSeries tables of subcatchments, nodes (Node_J<i>) and links (Link_C<i>) at
+    steps report steps, in the layout of EPA SWMM 5.1.
+    """
+    rng = np.random.default_rng(seed)
+    stamps = ["   " + t.strftime("%m/%d/%Y %H:%M:%S") for t in report_times(steps)]
+    with open(rpt_file, "w") as f:
+        f.write("\n  EPA STORM WATER MANAGEMENT MODEL - VERSION 5.1 (Build 5.1.013)\n"
+                "  --------------------------------------------------------------\n\n"
+                "  Synthetic benchmark model\n  \n")
+        for kind, count, prefix in (("Subcatchment", subcatchments, "S"), ("Node", nodes, "J"),
+                                    ("Link", links, "C")):
+            if count == 0:
+                continue
+            f.write("  " + "*" * len(kind + " Results") + "\n  " + kind + " Results\n  " +
+                    "*" * len(kind + " Results") + "\n  \n")
+            for i in range(count):
+                values = rng.random((steps, 4 if kind != "Subcatchment" else 3)) * 10
+                f.write("  <<< {0} {1}{2} >>>\n".format(kind, prefix, i + 1))
+                f.writelines(rpt_tables[kind])
+                f.write("".join([stamp + "".join(["{0:11.3f}".format(v) for v in row]) + "\n"
+                                 for stamp, row in zip(stamps, values.tolist())]))
+                f.write("  \n  \n")
+        f.write("\n  Analysis begun on:  Fri May  8 11:27:34 2020\n"
+                "  Analysis ended on:  Fri May  8 11:27:34 2020\n"
+                "  Total elapsed time: < 1 sec\n")
+
+
+def write_inp(inp_file, curves, rules=1):
+    """
+    EPA SWMM input file with curves rating curves (RC<i>, 6 points each) and rules control rules.
+    """
+    with open(inp_file, "w") as f:
+        f.write("[TITLE]\n;;Project Title/Notes\nSynthetic benchmark model\n\n")
+        f.write("[OPTIONS]\n;;Option             Value\nFLOW_UNITS           CFS\n"
+                "START_DATE           03/18/2020\nSTART_TIME           20:00:00\n"
+                "REPORT_START_DATE    03/18/2020\nREPORT_START_TIME    20:00:00\n"
+                "END_DATE             03/19/2020\nEND_TIME             20:00:00\n"
+                "REPORT_STEP          00:15:00\n\n")
+        f.write("[CURVES]\n;;Name           Type       X-Value    Y-Value   \n")
+        for i in range(curves):
+            f.write(";Rating Curve\n")
+            for j in range(6):
+                f.write("RC{0}     {1}     {2}     {3}\n".format(i + 1, "Rating" if j == 0 else "      ", j + 1,
+                                                                 10 * j))
+            f.write("\n")
+        f.write("\n[CONTROLS]\n")
+        for i in range(rules):
+            f.write("RULE R{0}\nIF SIMULATION TIME > 0\nTHEN OUTLET OL{0} SETTING = 1\n\n".format(i + 1))
+        f.write("[REPORT]\n;;Reporting Options\nINPUT      YES\nNODES ALL\nLINKS ALL\n")
+
+
+def write_rating_curves(xml_file, curves, rows=6):
+    """
+    FEWS rating curves file (PI-XML) with the curves RC<i> of write_inp.
+    """
+    with open(xml_file, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<RatingCurves xmlns="http://www.wldelft.nl/fews/PI">\n')
+        for i in range(curves):
+            f.write("\t<ratingCurve>\n\t\t<header>\n\t\t\t<locationId>RC{0}</locationId>\n"
+                    '\t\t\t<startDate date="2018-01-01" time="00:00:00"/>\n\t\t\t<stageUnit>m</stageUnit>\n'
+                    "\t\t</header>\n\t\t<table>\n\t\t\t<interpolationMethod>linear</interpolationMethod>\n".format(i + 1))
+            f.write("".join(['\t\t\t<row stage="{0}" discharge="{1}"/>\n'.format(j + 1, 5 * j) for j in range(rows)]))
+            f.write("\t\t</table>\n\t</ratingCurve>\n")
+        f.write("</RatingCurves>\n")
+
+
+def write_control_rules(xml_file, series, events, seed=0):
+    """
+    FEWS control rules file (PI-XML) with series time series of outlet settings (OL<i>), of events events each.
+    """
+    rng = np.random.default_rng(seed)
+    times = [(t.strftime("%Y-%m-%d"), t.strftime("%H:%M:%S")) for t in report_times(events)]
+    with open(xml_file, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<TimeSeries xmlns="http://www.wldelft.nl/fews/PI">\n'
+                "    <timeZone>-5.0</timeZone>\n")
+        for i in range(series):
+            f.write("    <series>\n        <header>\n            <type>accumulative</type>\n"
+                    "            <locationId>OL{0}</locationId>\n            <parameterId>OUTLET</parameterId>\n"
+                    "            <missVal>NaN</missVal>\n        </header>\n".format(i + 1))
+            # settings change every few events, as gate operations do
+            settings = np.repeat(rng.integers(0, 10, events // 4 + 1) / 10, 4)[:events]
+            f.write("".join(['        <event date="{0}" time="{1}" value="{2}" flag="1"/>\n'.format(d, t, v)
+                             for (d, t), v in zip(times, settings.tolist())]))
+            f.write("    </series>\n")
+        f.write("</TimeSeries>\n")
+
+
+def write_rainfall_netcdf(nc_file, stations, steps, seed=0):
+    """
+    FEWS rainfall NetCDF file (NETCDF-CF_TIMESERIES export) with the P time series of stations stations.
+    """
+    import pandas as pd
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+    # mostly dry, with a few radar levels, like real rainfall
+    P = np.where(rng.random((steps, stations)) < 0.7, 0.0, rng.integers(1, 20, (steps, stations)) / 4)
+    times = pd.DatetimeIndex(report_times(steps))
+    ds = xr.Dataset(
+        {"station_id": ("stations", np.array(["DON_{0}".format(i + 1) for i in range(stations)], dtype="S64")),
+         "station_names": ("stations", np.array(["Gauge {0}".format(i + 1) for i in range(stations)],
+                                                dtype="S255")),
+         "P": (("time", "stations"), P.astype(np.float32))},
+        coords={"time": times, "analysis_time": [times[-1]],
+                "lat": ("stations", np.linspace(43.6, 43.9, stations)),
+                "lon": ("stations", np.linspace(-79.5, -79.3, stations))})
+    ds["P"].attrs["units"] = "mm/hr"
+    ds.to_netcdf(nc_file, encoding={"time": {"units": "minutes since 1970-01-01 00:00:00.0 +0000"}})
@@ -6,18 +6,34 @@ This file can also be used as template for Python modules.
 main_logger.
 """
 import argparse as ap
+import contextlib
+import cProfile
 import csv
+import ctypes
 import datetime
+import hashlib
+import ipaddress
+from itertools import repeat
+import json
 import logging
+import mmap
+import multiprocessing
 import os
-import pandas as pd
 from pathlib import Path
+import pickle
 import subprocess
 import re
-from shutil import move
-import xarray as xr
+import shutil
+import socket
+import socketserver
 import sys
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
+# numpy, pandas, xarray, netCDF4 and concurrent.futures are imported in the functions that use them: FEWS starts one
+# process per subcommand, and most of them never need these modules, e.g. the run command only starts the model
+# executable (see benchmarks/importtime.py).
 
 # For package only #
 # uncomment this when building the wheel distribution: python setup.py bdist_wheel
@@ -31,6 +47,108 @@ __license__ = "mit"
 # XML namespace dict, needed to find elements
 namespace = {"pi": "http://www.wldelft.nl/fews/PI"}
 
+# Date/time separators of the *.rpt timeSeries rows ("MM/DD/YYYY HH:MM:SS"), replaced by blanks to read them as numbers
+rpt_separators = str.maketrans("/:", "  ")
+# Keyword at the start of a line of the *.inp file (e.g. START_DATE in the [OPTIONS] section)
+inp_keyword = re.compile(r"\w+")
+# File names of the *.inp file (see set_inp_file_paths): after FILE in the [RAINGAGES], [TIMESERIES] and [TEMPERATURE]
+# sections, and after USE/SAVE and the type of file in the [FILES] section
+inp_file_name = re.compile(r'(\bFILE\s+)("[^"]*"|\S+)', re.IGNORECASE)
+inp_interface_file = re.compile(r'^(\s*(?:USE|SAVE)\s+\S+\s+)("[^"]*"|\S+)', re.IGNORECASE)
+# Lines of the *.rpt file that start or close a timeSeries block (see iter_rpt_blocks)
+rpt_markers = re.compile(rb"<<<|\*\*\*|Analysis begun on|Total elapsed time")
+# Messages of the *.rpt file and of the adapter logs that are written to the run diagnostics file, and the FEWS level
+# of their first field (see read_diagnostics): the most severe one found, e.g. 1 for "ERROR 317"
+diagnostic_line = re.compile(r"ERROR|WARNING|DEBUG|INFO|FATAL")
+diagnostic_levels = {"FATAL": 0, "ERROR": 1, "WARN": 2, "INFO": 3, "DEBUG": 4}
+diagnostic_level = re.compile("|".join(diagnostic_levels))
+
+# Properties of the run_info.xml that are paths to files that must exist; other properties are adapter options.
+file_properties = ("model-executable", "swmm_input_file", "output_filter_file", "swmm_template_file", "swmm_library")
+
+# EPA SWMM binary output file (*.out)
+swmm_magic_number = 516114522
+swmm_flow_units = ["CFS", "GPM", "MGD", "CMS", "LPS", "MLD"]  # index = flow units code; CMS and after are SI units
+# Results written to FEWS, in the same order and with the same names as in the *.rpt timeSeries tables:
+# (name, variable code in the *.out file, kind of unit)
+swmm_out_variables = {
+    "Subcatchment": [("Precip.", [0], "rainfall"), ("Losses", [2, 3], "rainfall"), ("Runoff", [4], "flow")],
+    "Node": [("Inflow", [4], "flow"), ("Flooding", [5], "flow"), ("Depth", [0], "length"), ("Head", [1], "length")],
+    "Link": [("Flow", [0], "flow"), ("Velocity", [2], "velocity"), ("Depth", [1], "length"),
+             ("Capacity", [4], "setting")],
+}
+
+# EPA SWMM 5.2 shared library (engine=library): object type codes, and the property codes of swmm_getValue for the
+# results written to FEWS, with the same names as in swmm_out_variables. As in the *.rpt and *.out files, the
+# Capacity of a conduit is its depth over its full depth (swmm_LINK_FULLDEPTH), and the Capacity of the other links
+# (pumps, orifices, weirs and outlets) is their setting (swmm_LINK_SETTING).
+swmm_library_objects = {"Node": 2, "Link": 3}
+swmm_library_variables = {
+    "Node": [("Inflow", 307), ("Flooding", 308), ("Depth", 303), ("Head", 304)],
+    "Link": [("Flow", 410), ("Velocity", 412), ("Depth", 411), ("Capacity", 407)],
+}
+swmm_link_type = 400
+swmm_link_fulldepth = 405
+swmm_conduit = 0  # link type of swmm_LINK_TYPE
+
+# Lock of the EPA SWMM shared library (engine=library), which runs one simulation at a time per process
+swmm_library_lock = threading.Lock()
+# Files read by a resident adapter process (see serve_adapter and read_cached):
+# {(reader, path): (size, modification time, contents)}
+file_cache = {}
+
+
+class RunContext(threading.local):
+    """
+    Logger, log file, run information and stages of the adapter command run by the current thread (see Adapter).
+    The threads that do not run an Adapter use the defaults below: the logger of the command line adapter, or of the
+    module when it is imported.
+    """
+    logger = logging.getLogger("EPASWMM FEWS Python Logger")
+    logger_filename = None
+    run_info = None
+    stages = None
+    stage = None
+    profile = False
+
+
+class ContextLogger:
+    """
+    Logger of the adapter command run by the current thread (see RunContext), so that main_logger.info(...) only
+    writes to the log of that command.
+    """
+    def __getattr__(self, name):
+        return getattr(run_context.logger, name)
+
+
+# Run context of the current thread, and its logger
+run_context = RunContext()
+main_logger = ContextLogger()
+
+
+class AdapterError(SystemExit):
+    """
+    Error that stops an adapter command (see stop_program). It is a SystemExit with exit code 1, so that the command
+    line adapter exits as before, while a resident process running Adapter objects can catch it and go on.
+    """
+    def __init__(self, message=""):
+        super().__init__(1)
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def add_inp_controls(sections, control_rule):
+    """
+    Append the control rules ({rule id: text}) at the end of the [CONTROLS] section of a parsed *.inp file
+    (see read_inp), after the rules already in the model. Returns the new sections.
+    """
+    if len(control_rule) == 0:
+        return sections
+    return [[name, lines + list(control_rule.values()) if name == "[CONTROLS]" else lines]
+            for name, lines in sections]
+
 
 def add_attributes(ds):
     """
@@ -65,6 +183,37 @@ def add_attributes(ds):
     return ds
 
 
+def adapter_command():
+    """
+    Command line that starts this adapter: the PyInstaller executable, or the Python script.
+    """
+    if getattr(sys, "frozen", False):
+        return [sys.executable]
+    return [sys.executable, os.path.abspath(__file__)]
+
+
+def append_netcdf(ds, ds_fn):
+    """
+    Append the time steps of a DataSet to a NetCDF file with the same variables and stations, written by write_netcdf
+    with an unlimited time dimension.
+    """
+    import netCDF4
+    import pandas as pd
+    if ds.sizes["time"] == 0:
+        return
+    try:
+        with netCDF4.Dataset(ds_fn, "a") as nc:
+            start = len(nc.dimensions["time"])
+            end = start + ds.sizes["time"]
+            nc["time"][start:end] = netCDF4.date2num(pd.DatetimeIndex(ds["time"].values).to_pydatetime(),
+                                                     nc["time"].units, getattr(nc["time"], "calendar", "standard"))
+            for var in ds.data_vars:
+                nc[var][start:end] = ds[var].transpose(*nc[var].dimensions).values
+    except Exception:
+        main_logger.error("Failed to append dataset to:" + str(ds_fn))
+        stop_program()
+
+
 def bytes_to_string(df, col_to_convert):
     """
     Decodes columns in a dataframe. When the NetCDF file is read, string columns are encoded.
@@ -82,80 +231,60 @@ def check_properties(key, props, run_info_file):
         )
 
 
+def combine_ensemble(member_files, realizations, ds_fn):
+    """
+    Combine the NetCDF results of the ensemble members into one NetCDF file, with a realization dimension.
+    """
+    import pandas as pd
+    import xarray as xr
+    datasets = [xr.open_dataset(f) for f in member_files]
+    try:
+        ds = xr.concat(datasets, dim=pd.Index(realizations, name="realization"))
+        ds["realization"].attrs["standard_name"] = "realization"
+        ds["realization"].attrs["long_name"] = "Index of an ensemble member within an ensemble"
+        ds.load()
+    except Exception:
+        main_logger.error("Failed to combine the results of the ensemble members into: " + str(ds_fn))
+        stop_program()
+    finally:
+        for d in datasets:
+            d.close()
+    write_netcdf(ds, ds_fn)
+
+
 def create_xarray_dataset(data_dict, swmm_unit_dict):
     """
     Creating xarray datasets.
     """
     main_logger.debug("Creating DataSet from the results DataFrame.")
-    list_ds_nodes = []
-    list_ds_links = []
+    list_keys_nodes = []
+    list_keys_links = []
     list_keys_ignored = []
     for key in data_dict.keys():
-        try:
-            header = data_dict[key]['Header']
-            units = data_dict[key]['Units']
-            rename_header = {}
-        except Exception:
-            main_logger.error("Failed to get header/units when creating dataset.")
-            stop_program()
-
-        for item in range(0, len(units)):
-            try:
-                rename_header[units[item]] = header[item]
-                temp_df = data_dict[key]['Data'].copy(deep=True)
-                temp_df = temp_df.rename(rename_header, axis='columns')
-                temp_df['station_id'] = key
-                temp_df.set_index(['station_id'], append=True, inplace=True)
-                ds2 = xr.Dataset.from_dataframe(temp_df)
-            except Exception:
-                main_logger.error("Failed to create DataSet for {0}".format(temp_df['station_id']))
-                stop_program()
-
-        for var, unit in data_dict[key]['units_dict'].items():
-            try:
-                attributes_info = swmm_unit_dict.get(unit)
-                for attrs, val in attributes_info.items():
-                    if attrs == 'UDUNITS':
-                        attrs = 'units'
-                    ds2[var].attrs[attrs] = val
-            except Exception:
-                main_logger.error(
-                    "Error raised due to EPA SWMM unit --> {0} is not recognized. Please add corresponding information into the UDUNITS_lookup.csv input file.".format(
-                        unit))
-                stop_program()
-                raise KeyError(
-                    "Error raised due to EPA SWMM unit --> {0} is not recognized. Please add corresponding information into the UDUNITS_lookup.csv input file.".format(
-                        unit))
-
-        try:
-            if "node" in key.lower():
-                list_ds_nodes.append(ds2)
-            elif "link" in key.lower():
-                list_ds_links.append(ds2)
-            else:
-                list_keys_ignored.append(key)
-                pass
-        except Exception:
-            main_logger.error("Failed to append data to dataset for: {0}".format(key))
-            stop_program()
+        if "node" in key.lower():
+            list_keys_nodes.append(key)
+        elif "link" in key.lower():
+            list_keys_links.append(key)
+        else:
+            list_keys_ignored.append(key)
 
     print("Locations ignored in the resulting output file (i.e. not a node or a link): \n\n" + str(list_keys_ignored))
-    # Combining Dataset for each station_id with same type
+    # Building one Dataset for each station_id type
 
     try:
-        main_logger.debug("Start combining xarray DataSets for nodes ...")
-        combined_ds_nodes = xr.combine_by_coords(list_ds_nodes)
+        main_logger.debug("Start building xarray DataSet for nodes ...")
+        combined_ds_nodes = make_dataset(data_dict, list_keys_nodes, swmm_unit_dict)
         combined_ds_nodes = add_attributes(combined_ds_nodes)
     except Exception:
-        main_logger.error("Failed to combining xarray DataSets for nodes")
+        main_logger.error("Failed to build xarray DataSet for nodes")
         stop_program()
 
     try:
-        main_logger.debug("Start combining xarray DataSets for links ...")
-        combined_ds_links = xr.combine_by_coords(list_ds_links)
+        main_logger.debug("Start building xarray DataSet for links ...")
+        combined_ds_links = make_dataset(data_dict, list_keys_links, swmm_unit_dict)
         combined_ds_links = add_attributes(combined_ds_links)
     except Exception:
-        main_logger.error("Failed to combining xarray DataSets for links")
+        main_logger.error("Failed to build xarray DataSet for links")
         stop_program()
 
     print("\nDone creating xarray DataSet for Nodes and Links.\n")
@@ -163,15 +292,79 @@ def create_xarray_dataset(data_dict, swmm_unit_dict):
     return combined_ds_nodes, combined_ds_links
 
 
-def dir_element(elem, exists=True):
+def decode_block(rows, ncols, time_axis=None):
+    """
+    Decode timeSeries rows from the *.rpt file ("MM/DD/YYYY HH:MM:SS value value ...") in one vectorized pass.
+    Returns the datetime64 times and a float64 array with one column per variable.
+
+    time_axis is an optional dictionary shared by all the blocks of a report. The first block decoded stores
+    the report time axis in it (see make_time_axis). The following blocks reuse that DatetimeIndex when their
+    first and last timestamps match it, and only their values are decoded.
+    """
+    import numpy as np
+    if time_axis and time_axis['times'] is not None and len(rows) == len(time_axis['times']):
+        offset = time_axis['offset']
+        if rows[0][:offset] == time_axis['first'] and rows[-1][:offset] == time_axis['last']:
+            values = np.fromstring("".join([row[offset:] for row in rows]), sep=" ")
+            if values.size == len(rows) * ncols:
+                return time_axis['times'], values.reshape(len(rows), ncols)
+
+    text = "".join(rows).translate(rpt_separators)
+    values = np.fromstring(text, sep=" ")
+    if values.size != len(rows) * (ncols + 6):
+        raise ValueError("Expected {0} values per row in the timeSeries block.".format(ncols + 6))
+    values = values.reshape(len(rows), ncols + 6)
+
+    month, day, year, hour, minute, second = values[:, :6].astype(np.int64).T
+    dates = ((year - 1970) * 12 + month - 1).astype("datetime64[M]").astype("datetime64[D]") + (day - 1)
+    times = dates.astype("datetime64[ns]") + ((hour * 60 + minute) * 60 + second).astype("timedelta64[s]")
+    if time_axis is not None and not time_axis and len(rows) > 0:
+        time_axis.update(make_time_axis(rows, times))
+        if time_axis['times'] is not None:
+            times = time_axis['times']
+    return times, values[:, 6:].copy()
+
+
+def decode_rpt_blocks(rpt_input_file, blocks):
+    """
+    Decode a contiguous list of timeSeries blocks [location, start, end, first_line] of a *.rpt file (see
+    index_rpt_file). Runs in the worker processes of iter_rpt_parallel, so only NumPy arrays are returned:
+    (location, block information, times, values) per block, where times is None when it is the same as for
+    the previous block.
+    """
+    offset = blocks[0][1]
+    with open(rpt_input_file, "rb") as f:
+        f.seek(offset)
+        data = f.read(blocks[-1][2] - offset)
+
+    results = []
+    time_axis = {}
+    previous = None
+    for location, start, end, first_line in blocks:
+        block = data[start - offset:end - offset].decode().replace("\r\n", "\n").splitlines(keepends=True)
+        name, info = parse_rpt_block(block, first_line)
+        # Same rows as make_df
+        start_row = info['start_line'] - first_line
+        nrows = info['end_line'] - info['start_line']
+        times, values = decode_block(block[start_row + 2:start_row + nrows - 1], len(info['df_header']) - 2,
+                                     time_axis)
+        results.append((name, info, None if times is previous else times, values))
+        previous = times
+    return results
+
+
+def dir_element(elem, exists=True, base_dir=None):
     """
     Checks if a string or XML element is a directory path, and returns the corresponding path.
+    Relative paths are relative to base_dir if given; otherwise they are kept relative to the working directory.
     """
     if isinstance(elem, str):
         # such that this works if the path is in an attribute
         path = Path(elem)
     else:
         path = Path(elem.text)
+    if base_dir is not None:
+        path = Path(base_dir) / path
     if exists and not path.is_dir():
         main_logger.error(
             "The following is expected to exist but was not found: %s" % (os.path.join(os.getcwd(), path)))
@@ -180,19 +373,25 @@ def dir_element(elem, exists=True):
     return path
 
 
-def file_element(elem, exists=True):
+def file_element(elem, exists=True, base_dir=None):
     """
     Checks if a string or XML element is a path, and returns the corresponding path.
+    Relative paths are relative to base_dir if given; otherwise they are kept relative to the working directory.
+    Paths in the "bin" folder are relative to the parent folder of base_dir (or of the working directory).
     """
     if isinstance(elem, str):
         # such that this works if the path is in an attribute
         if "bin" in elem:
             path = Path(elem)
-            root = Path(os.getcwd())
+            root = Path(os.getcwd() if base_dir is None else base_dir)
             path = os.path.join(root.parents[0], path)
             path = Path(path)
+        elif base_dir is not None:
+            path = Path(base_dir) / elem
         else:
             path = Path(elem)
+    elif base_dir is not None:
+        path = Path(base_dir) / elem.text
     else:
         path = Path(elem.text)
 
@@ -204,35 +403,217 @@ def file_element(elem, exists=True):
         raise FileNotFoundError(path.resolve())
     return path
 
+def keep_location(name, locations=None, object_types=None):
+    """
+    Whether the results of a location (e.g. 'Node_J1') are wanted, given a whitelist of locations and/or of
+    object types ('Subcatchment', 'Node', 'Link'). None means no filter.
+    """
+    return (locations is None or name in locations) and (object_types is None or name.split("_")[0] in object_types)
+
 
-def make_df(lines, start, nrows, df_header):
+def load_swmm_library(library_file):
     """
-    Method to create a pandas DataFrame from a subset of lines from the simulation results *.rpt file.
+    Load the EPA SWMM 5.2 shared library (swmm5.dll, libswmm5.so) with ctypes, for run_swmm_library.
     """
-    # PERFORMANCE ISSUE: parsers.py from pandas is causing lost in performance.
-    #     Using pandas.DataFrame() method allowed increasing performance.
-    # df = pd.read_csv(file, delimiter=r"\s+", names=df_header, header=None,
-    # skiprows=start+2,nrows=nrows-1, parse_dates=[0], dayfirst = False)
+    try:
+        swmm = (ctypes.WinDLL if os.name == "nt" else ctypes.CDLL)(str(library_file))
+        swmm.swmm_open.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
+        swmm.swmm_start.argtypes = [ctypes.c_int]
+        swmm.swmm_step.argtypes = [ctypes.POINTER(ctypes.c_double)]
+        swmm.swmm_getError.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        swmm.swmm_getCount.argtypes = [ctypes.c_int]
+        swmm.swmm_getName.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        swmm.swmm_getValue.argtypes = [ctypes.c_int, ctypes.c_int]
+        swmm.swmm_getValue.restype = ctypes.c_double
+    except (OSError, AttributeError):
+        main_logger.error("Failed to load the EPA SWMM 5.2 shared library: {0}".format(library_file))
+        stop_program()
+    return swmm
+
 
+def log_file():
+    """
+    Log file of the adapter run of the current thread (see Adapter), or else of the command line adapter.
+    """
+    return run_context.logger_filename
+
+
+def make_dataset(data_dict, keys, swmm_unit_dict):
+    """
+    Build a (time x station_id) Dataset from the results of several locations.
+    One array per variable is preallocated and filled in place, so the cost grows linearly with the number of
+    locations.
+    """
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    stations = sorted(keys)
+    if len(stations) == 0:
+        # e.g. all the locations of this type were filtered out (see read_output_filter)
+        return xr.Dataset(coords={"time": pd.DatetimeIndex([], name="time"),
+                                  "station_id": np.array([], dtype=object)})
+    times = data_dict[stations[0]]['Data'].index
+    variables = {}
+    for key in stations:
+        df = data_dict[key]['Data']
+        if not df.index.equals(times):
+            times = times.union(df.index)
+        for var in df.columns:
+            variables.setdefault(var, data_dict[key]['units_dict'][var])
+
+    arrays = {var: np.full((len(times), len(stations)), np.nan) for var in variables}
+    for j, key in enumerate(stations):
+        df = data_dict[key]['Data']
+        if df.index.equals(times):
+            rows = slice(None)
+        else:
+            rows = times.get_indexer(df.index)
+        values = df.to_numpy()
+        for k, var in enumerate(df.columns):
+            arrays[var][rows, j] = values[:, k]
+
+    ds = xr.Dataset({var: (("time", "station_id"), arr) for var, arr in arrays.items()},
+                    coords={"time": pd.DatetimeIndex(times, name="time"),
+                            "station_id": np.array(stations, dtype=object)})
+
+    for key in stations:
+        for var, unit in data_dict[key]['units_dict'].items():
+            if unit not in swmm_unit_dict:
+                main_logger.error(
+                    "Error raised due to EPA SWMM unit --> {0} is not recognized. Please add corresponding information into the UDUNITS_lookup.csv input file.".format(
+                        unit))
+                stop_program()
+                raise KeyError(
+                    "Error raised due to EPA SWMM unit --> {0} is not recognized. Please add corresponding information into the UDUNITS_lookup.csv input file.".format(
+                        unit))
+    for var, unit in variables.items():
+        for attrs, val in swmm_unit_dict[unit].items():
+            if attrs == 'UDUNITS':
+                attrs = 'units'
+            ds[var].attrs[attrs] = val
+    return ds
+
+
+def make_df(lines, start, nrows, df_header, time_axis=None):
+    """
+    Method to create a pandas DataFrame from a subset of lines from the simulation results *.rpt file.
+    """
+    # PERFORMANCE ISSUE: splitting every line and converting the columns with pd.to_datetime/pd.to_numeric
+    #     dominated the post-adapter. The rows are decoded in one vectorized pass instead (see decode_block).
+    import pandas as pd
     try:
-        df = pd.DataFrame([[i for i in line.strip().split()] for line in lines[start + 2:start + nrows - 1]],
-                          columns=df_header)
-        df['DateO'] = pd.to_datetime(df['Date'])
-        df['TimeO'] = pd.to_timedelta(df['Time'])
-        df['time'] = df['DateO'] + df['TimeO']
-        df = df.drop(columns=['DateO', 'TimeO', 'Date', 'Time'])
-        df = df.set_index('time')
-        df = df.apply(pd.to_numeric)
+        times, values = decode_block(lines[start + 2:start + nrows - 1], len(df_header) - 2, time_axis)
+        df = pd.DataFrame(values, index=pd.DatetimeIndex(times, name='time'), columns=df_header[2:])
     except Exception:
         main_logger.error("Failed to create dataframe for line starting with: {0}".format(lines[start]))
         stop_program()
     return df
 
 
+def netcdf_encoding(ds, properties):
+    """
+    Encoding of the data variables of a results DataSet, from the run_info.xml properties:
+      - netcdf_complevel: zlib (deflate) compression level from 1 to 9; 0 or absent means no compression.
+      - netcdf_dtype: 'float64' (default), 'float32', or 'int16' (packed with scale_factor/add_offset).
+      - netcdf_chunk_by_station: true to store each station's time series as one chunk, the way FEWS reads it.
+    Returns None when no option is set, so that the NetCDF files are written as before.
+    """
+    complevel = int(properties.get("netcdf_complevel", 0))
+    dtype = properties.get("netcdf_dtype", "float64")
+    chunk_by_station = str(properties.get("netcdf_chunk_by_station", False)).lower() == "true"
+    if dtype not in ("float64", "float32", "int16"):
+        main_logger.error("netcdf_dtype in the run_info.xml must be 'float64', 'float32' or 'int16'.")
+        stop_program()
+    if complevel == 0 and dtype == "float64" and not chunk_by_station:
+        return None
+
+    encoding = {}
+    for var in ds.data_vars:
+        enc = {}
+        if complevel > 0:
+            enc.update(zlib=True, complevel=complevel, shuffle=True)
+        if chunk_by_station and ds[var].size > 0:
+            enc["chunksizes"] = tuple(1 if dim == "station_id" else ds.sizes[dim] for dim in ds[var].dims)
+        if dtype == "float32":
+            enc["dtype"] = "float32"
+        elif dtype == "int16":
+            # Pack the range of the variable into [-32766, 32766]; -32767 is kept for missing values.
+            vmin = float(ds[var].min()) if ds[var].notnull().any() else 0.0
+            vmax = float(ds[var].max()) if ds[var].notnull().any() else 0.0
+            enc.update(dtype="int16", _FillValue=-32767, add_offset=(vmax + vmin) / 2,
+                       scale_factor=(vmax - vmin) / 65532 if vmax > vmin else 1.0)
+        encoding[var] = enc
+    return encoding
+
+
+def read_cached(read, file, *args):
+    """
+    Read a file with read(file, *args), reusing the contents read before by this process while the file is unchanged (same
+    size and modification time), e.g. the units table and the model template in a resident adapter (see
+    serve_adapter). The contents are shared between the runs and must not be modified.
+    """
+    stat = os.stat(file)
+    key = (read.__name__, str(file))
+    cached = file_cache.get(key)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    contents = read(file, *args)
+    file_cache[key] = (stat.st_size, stat.st_mtime_ns, contents)
+    return contents
+
+
+def read_inp(inp_file):
+    """
+    Parse an EPA SWMM input file (*.inp) once into its sections.
+    Returns a list of [section, lines] in the order of the file, where section is the stripped header line
+    (e.g. '[OPTIONS]'; None for the lines before the first header) and lines are all the lines of the section,
+    the header included. Writing all the lines back (see write_inp) gives the original file.
+    The set_inp_* and add_inp_* functions return new sections and never modify the lines of a parsed file.
+    """
+    sections = [[None, []]]
+    with open(inp_file) as f:
+        for line in f:
+            if line.startswith("["):
+                sections.append([line.strip(), [line]])
+            else:
+                sections[-1][1].append(line)
+    return sections
+
+
+def read_inp_cached(inp_file, cache_file=None):
+    """
+    Parse an EPA SWMM input file (*.inp) like read_inp, reusing the sections pickled in cache_file (default:
+    inp_file + ".pkl") while the file is unchanged: same size, and same modification time or same sha1.
+    """
+    cache_file = str(inp_file) + ".pkl" if cache_file is None else cache_file
+    stat = os.stat(inp_file)
+    try:
+        with open(cache_file, "rb") as f:
+            cache = pickle.load(f)
+        if cache["size"] == stat.st_size:
+            if cache["mtime"] == stat.st_mtime_ns:
+                main_logger.debug("Using the parsed INP file from: {0}".format(cache_file))
+                return cache["sections"]
+            if cache["sha1"] == hashlib.sha1(Path(inp_file).read_bytes()).hexdigest():
+                # e.g. the file was copied again: same contents, new modification time
+                main_logger.debug("Using the parsed INP file from: {0}".format(cache_file))
+                save_inp_cache(cache["sections"], inp_file, cache_file)
+                return cache["sections"]
+    except FileNotFoundError:
+        pass
+    except Exception:
+        main_logger.warning("Ignoring unreadable INP cache file: {0}".format(cache_file))
+
+    sections = read_inp(inp_file)
+    save_inp_cache(sections, inp_file, cache_file)
+    return sections
+
+
 def read_netcdf(netcdf_filename, col_to_convert):
     """ 
     Read a netCDF file and return a pandas DataFrame
     """
+    import xarray as xr
     ds = xr.open_dataset(netcdf_filename)
     try:
         df = ds.to_dataframe()
@@ -247,191 +628,494 @@ def read_netcdf(netcdf_filename, col_to_convert):
     return df
 
 
-def read_errors_warnings(file_list):
+def read_output_filter(properties):
     """
-    Read errors and warnings from the *.rpt ASCII and Python log file output from the simulation.
+    Read the locations and variables to write to FEWS from the run_info.xml properties 'output_locations' and
+    'output_variables' (comma separated, e.g. "Node_J1,Link_C3") and/or from the 'output_filter_file' (csv with
+    the columns 'type' and 'name', where type is 'location' or 'variable').
+    Returns (locations, variables); None means that everything is written.
     """
-    main_logger.debug("File list: {0}".format(file_list))
-    list_warning_error = []
-    df = None
+    selection = {"location": [], "variable": []}
+    for kind in selection:
+        value = properties.get("output_" + kind + "s")
+        if value:
+            selection[kind] += [item.strip() for item in value.split(",") if item.strip()]
+    if "output_filter_file" in properties:
+        try:
+            with open(properties["output_filter_file"], newline="") as f:
+                for row in csv.DictReader(f):
+                    selection[row["type"].strip().lower()].append(row["name"].strip())
+        except Exception:
+            main_logger.error("Error parsing output filter file: %s" % properties["output_filter_file"])
+            stop_program()
+    return selection["location"] or None, selection["variable"] or None
+
+
+def read_out_file(out_input_file, locations=None, variables=None, object_types=None):
+    """
+    Read the EPA SWMM binary output file (*.out) with the results of the simulation.
+    The file is memory-mapped and the results of each period are read by offset; no text report is needed.
+    Returns a dictionary with the same structure as read_rpt_file (Header, Units, units_dict and Data per location).
+    locations, variables and object_types are optional whitelists (see read_rpt_file).
+    """
+    import numpy as np
+    import pandas as pd
+    try:
+        mm = np.memmap(out_input_file, dtype=np.uint8, mode="r")
+        magic, version, flow_code, n_subcatch, n_nodes, n_links, n_polluts = [
+            int(x) for x in np.frombuffer(mm, "<i4", count=7)]
+        id_pos, input_pos, output_pos, n_periods, error_code, magic_end = [
+            int(x) for x in np.frombuffer(mm, "<i4", count=6, offset=mm.size - 24)]
+    except Exception:
+        main_logger.error("Error encountered while opening: {0}.".format(out_input_file))
+        stop_program()
+
+    if magic != swmm_magic_number or magic_end != swmm_magic_number:
+        main_logger.error("{0} is not an EPA SWMM binary output file.".format(out_input_file))
+        stop_program()
+    if error_code != 0:
+        main_logger.error("EPA SWMM binary output file {0} reports error code {1}.".format(out_input_file, error_code))
+        stop_program()
+    if n_periods == 0:
+        main_logger.error(
+            "Error raised due to detected empty Time Series.  Check result file from EPA SWMM model output: %s" % (
+                out_input_file))
+        stop_program()
 
+    try:
+        # Object IDs, each one stored as its length followed by its characters
+        pos = id_pos
+        names = {}
+        for kind, count in (("Subcatchment", n_subcatch), ("Node", n_nodes), ("Link", n_links)):
+            names[kind] = []
+            for j in range(count):
+                length = int(np.frombuffer(mm, "<i4", count=1, offset=pos)[0])
+                names[kind].append(mm[pos + 4:pos + 4 + length].tobytes().decode("utf-8"))
+                pos += 4 + length
+
+        # Skip the input properties of subcatchments, nodes and links, then read the codes of the reported variables
+        pos = input_pos
+        for count in (n_subcatch, n_nodes, n_links):
+            n_props = int(np.frombuffer(mm, "<i4", count=1, offset=pos)[0])
+            pos += 4 * (1 + n_props + n_props * count)
+        codes = {}
+        for kind in ("Subcatchment", "Node", "Link", "System"):
+            n_vars = int(np.frombuffer(mm, "<i4", count=1, offset=pos)[0])
+            codes[kind] = list(np.frombuffer(mm, "<i4", count=n_vars, offset=pos + 4))
+            pos += 4 * (1 + n_vars)
+        del mm
+
+        # One record per reporting period: date followed by the results of every object
+        period = np.dtype([("date", "<f8"),
+                           ("Subcatchment", "<f4", (n_subcatch, len(codes["Subcatchment"]))),
+                           ("Node", "<f4", (n_nodes, len(codes["Node"]))),
+                           ("Link", "<f4", (n_links, len(codes["Link"]))),
+                           ("System", "<f4", (len(codes["System"]),))])
+        results = np.memmap(out_input_file, dtype=period, mode="r", offset=output_pos, shape=(n_periods,))
+
+        # Dates are decimal days since 12/30/1899
+        seconds = np.round(results["date"] * 86400).astype(np.int64)
+        times = pd.DatetimeIndex(np.datetime64("1899-12-30", "s") + seconds.astype("timedelta64[s]"), name="time")
+
+        units = swmm_units(flow_code)
+
+        data_dict = {}
+        for kind in ("Subcatchment", "Node", "Link"):
+            selected = [j for j, name in enumerate(names[kind])
+                        if keep_location(kind + "_" + name, locations, object_types)]
+            kind_variables = [(name, var_codes, unit) for name, var_codes, unit in swmm_out_variables[kind]
+                              if variables is None or name in variables]
+            if len(selected) == 0 or len(kind_variables) == 0:
+                continue
+            values = np.asarray(results[kind][:, selected], dtype=np.float64)
+            columns = [[codes[kind].index(code) for code in var_codes] for name, var_codes, unit in kind_variables]
+            header = [name for name, var_codes, unit in kind_variables]
+            header_units = [units[unit] for name, var_codes, unit in kind_variables]
+            for j, name in enumerate(names[kind][k] for k in selected):
+                data = np.column_stack([values[:, j, cols].sum(axis=1) for cols in columns])
+                data_dict[kind + "_" + name] = {
+                    'Header': header, 'Units': header_units, 'df_header': ['Date', 'Time'] + header,
+                    'units_dict': dict(zip(header, header_units)),
+                    'Data': pd.DataFrame(data, index=times, columns=header)}
+        del results
+    except Exception:
+        main_logger.error("Error encountered while reading the EPA SWMM binary output file: {0}.".format(
+            out_input_file))
+        stop_program()
+    main_logger.debug("Done reading *.out file.")
+    return data_dict
+
+
+def read_diagnostics(file_list):
+    """
+    Read the errors, warnings and messages of the *.rpt ASCII file and of the Python log files, as a list of
+    (FEWS level, description) without duplicates, in the order of the files (see write_run_diagnostics).
+    A *.rpt file is only read up to its first timeSeries block: SWMM writes its errors and warnings before the
+    results.
+    """
+    main_logger.debug("File list: {0}".format(file_list))
+    diagnostics = []
+    seen = set()
     for f in file_list:
         try:
             with open(f, "r") as fi:
                 for ln in fi:
-                    if any(x in ln for x in ["ERROR", "WARNING", "DEBUG", "INFO", "FATAL"]):
-                        list_warning_error.append(ln.strip())
-
+                    if ln.lstrip().startswith("<<<"):
+                        break
+                    if diagnostic_line.search(ln) is None:
+                        continue
+                    level, _, description = ln.strip().partition(":")
+                    description = description.strip()
+                    if (level, description) in seen:
+                        continue  # SWMM outputs identical warnings sometimes, which does not add any value
+                    seen.add((level, description))
+                    found = diagnostic_level.findall(level)
+                    diagnostics.append((min(diagnostic_levels[x] for x in found) if found else level,
+                                        level + ": " + description))
         except Exception:
             main_logger.error(
                 "The following is expected to exist but was not found: {0}".format(os.path.join(os.getcwd(), f)))
             stop_program()
             raise FileNotFoundError(Path(f).resolve())
 
-    if len(list_warning_error) > 0:
-        df = pd.Series(list_warning_error).str.split(":", 1, expand=True).rename(
-            columns={0: "level", 1: "description"})
-        df["description"] = [x.strip() for x in df["description"]]
-        df = df.drop_duplicates(["level",
-                                 "description"]).reset_index()  # SWMM outputs identical warnings sometimes, which does not add any value
+    if len(diagnostics) == 0:
+        main_logger.info("No errors, warnings or info messages were detected.")
+    return diagnostics
+
+
+def read_errors_warnings(file_list):
+    """
+    Read errors and warnings from the *.rpt ASCII and Python log file output from the simulation, as a DataFrame
+    with the level and description columns (see read_diagnostics).
+    """
+    import pandas as pd
+    return pd.DataFrame(read_diagnostics(file_list), columns=["level", "description"])
+
+
+def rpt_location(line):
+    """
+    Location name of a timeSeries block from its '<<< Node X >>>' line (e.g. 'Node_X').
+    """
+    return line.strip().strip("<<<").strip(">>>").lstrip(" ").rstrip(" ").replace(" ", "_")
+
+
+def parse_rpt_block(block, first_line):
+    """
+    Parse the header and units of a single timeSeries block from the *.rpt file.
+    The block starts at its '<<< ... >>>' line and ends just before the line that closes it.
+    Returns the location name and the block information stored in the data dictionary.
+    """
+    name = rpt_location(block[0])
+
+    # Parsing Header and Units information.
+    # Two potential cases, told apart by the number of fields of the Header and Units lines:
+    #   1) Date and Time located on the Header line, which has more fields (Subcatchment:
+    #      "Date Time Precip. Losses Runoff"): df_header is the Header line, the variables are header[2:]
+    #   2) Date and Time located on the Units line (Nodes and Links: "Date Time CFS CFS feet feet"):
+    #      df_header is units[:2] + the Header line, the units are units[2:]
+    header = block[2].strip().lstrip(" ").rstrip(" ").rstrip("/").split()
+    units = block[3].strip().lstrip(" ").rstrip(" ").rstrip("/").split()
+    if len(header) > len(units):
+        df_header = header
+        header = header[2::]
     else:
-        df = None
-
-    # CONVERT TO FEWS ERROR Numbering
-    if df is not None and len(df) > 0:
-        df['description'] = df['level'] + ": " + df['description']
-        for index, row in df.iterrows():
-            if "DEBUG" in row["level"]:
-                df.at[index, "level"] = 4
-            if "INFO" in row["level"]:
-                df.at[index, "level"] = 3
-            if "WARN" in row["level"]:
-                df.at[index, "level"] = 2
-            if "ERROR" in row["level"]:
-                df.at[index, "level"] = 1
-            if "FATAL" in row["level"]:
-                df.at[index, "level"] = 0
+        df_header = units[:2] + header
+        units = units[2::]
+    units_dict = {}
+
+    for item in range(len(header)):
+        units_dict[header[item]] = units[item]
+    # start_line/end_line are the (0-based) line numbers used since the first version of the parser:
+    # the block is closed 3 lines after its end_line.
+    info = {'start_line': first_line + 3, 'end_line': first_line + len(block) - 3, 'Header': header,
+            'Units': units, 'df_header': df_header, 'units_dict': units_dict}
+    return name, info
+
+
+def iter_rpt_blocks(rpt_input_file, locations=None, object_types=None):
+    """
+    Generator over the timeSeries blocks of a *.rpt ASCII file.
+    The file is read once, line by line, and only the lines of the block being parsed are kept in memory.
+    Yields (location, block information, DataFrame) as soon as a block ends; the header and units of the
+    block are in the 'Header' and 'Units' entries of the block information.
+    Blocks of locations that are not wanted (see keep_location) are skipped without being parsed.
+    """
+    if locations is not None:
+        locations = set(locations)
+    block = []
+    first_line = None
+    time_axis = {}
+    i = 0
+    line = ""
+    with open(rpt_input_file, "r") as f:
+        try:
+            for i, line in enumerate(f):
+                if "<<<" in line:
+                    if block:
+                        yield make_block(block, first_line, time_axis)
+                    block = [line] if keep_location(rpt_location(line), locations, object_types) else []
+                    first_line = i
+                elif first_line is None:
+                    pass
+                elif "***" in line:  # Export type/variable change
+                    if block:
+                        yield make_block(block, first_line, time_axis)
+                        block = []
+                elif "Analysis begun on" in line:  # Catch last item to be parsed
+                    main_logger.info("EPASWMM Model: " + line.strip())
+                    if block:
+                        yield make_block(block, first_line, time_axis)
+                        block = []
+                elif "Analysis ended on" in line:
+                    main_logger.info("EPASWMM Model: " + line.strip())
+                elif "Total elapsed time" in line:
+                    main_logger.info("EPASWMM Model: " + line.strip())
+                    break
+                elif block:
+                    block.append(line)
+        except Exception:
+            main_logger.error(
+                "While parsing SWMM output RPT file, error encountered on line# {0}: {1}".format(str(i + 1), line))
+            stop_program()
+
+
+def index_rpt_file(rpt_input_file, index_file=None):
+    """
+    Index the timeSeries blocks of a *.rpt ASCII file by byte offset, without decoding them.
+    The file is memory-mapped and only the lines that start or close a block are looked at, with the same rules
+    as iter_rpt_blocks. Returns a dictionary {location: [start, end, first_line]}, where start/end are the byte
+    offsets of the block and first_line is the (0-based) line number of its '<<< ... >>>' line.
+
+    If index_file is given, the index is saved there as JSON together with the size and modification time of
+    the *.rpt file, and reused as long as the *.rpt file is unchanged.
+    """
+    stat = os.stat(rpt_input_file)
+    if index_file is not None and os.path.isfile(index_file):
+        try:
+            with open(index_file, "r") as f:
+                saved = json.load(f)
+            if saved["size"] == stat.st_size and saved["mtime"] == stat.st_mtime:
+                main_logger.debug("Using *.rpt index file: {0}".format(index_file))
+                return saved["blocks"]
+        except Exception:
+            main_logger.warning("Ignoring unreadable *.rpt index file: {0}".format(index_file))
+
+    blocks = {}
+    with open(rpt_input_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = 0
+        line_no = 0
+        counted = 0
+        start = None
+        match = rpt_markers.search(mm, pos)
+        while match:
+            line_start = mm.rfind(b"\n", 0, match.start()) + 1
+            line_end = mm.find(b"\n", match.start())
+            line_end = len(mm) if line_end == -1 else line_end + 1
+            line = mm[line_start:line_end]
+            line_no += mm[counted:line_start].count(b"\n")
+            counted = line_start
+            if b"<<<" in line:
+                if start is not None:
+                    blocks[name] = [start, line_start, first_line]
+                start = line_start
+                first_line = line_no
+                name = rpt_location(line.decode())
+            elif start is None:
+                pass
+            elif b"Total elapsed time" in line:
+                break
+            elif b"***" in line or b"Analysis begun on" in line:
+                blocks[name] = [start, line_start, first_line]
+                start = None
+            match = rpt_markers.search(mm, line_end)
+
+    if index_file is not None:
+        try:
+            with open(index_file, "w") as f:
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "blocks": blocks}, f)
+        except Exception:
+            main_logger.warning("Could not save the *.rpt index file: {0}".format(index_file))
+    return blocks
+
+
+def iter_rpt_parallel(rpt_input_file, workers, locations=None, object_types=None):
+    """
+    Parallel version of iter_rpt_blocks: the blocks are located with index_rpt_file, then decoded by a pool of
+    worker processes, each one reading a contiguous range of the file. Yields the same (location, block
+    information, DataFrame) as iter_rpt_blocks, in the order of the file.
+    """
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    blocks = [[name] + position for name, position in index_rpt_file(rpt_input_file).items()
+              if keep_location(name, locations, object_types)]
+    if len(blocks) == 0:
+        return
+    # A few chunks per worker, so that the work stays balanced when some blocks are longer than others.
+    n_chunks = min(len(blocks), workers * 4)
+    chunks = [blocks[i * len(blocks) // n_chunks:(i + 1) * len(blocks) // n_chunks] for i in range(n_chunks)]
+    main_logger.debug("Decoding {0} blocks of the *.rpt file with {1} workers.".format(len(blocks), workers))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for results in executor.map(decode_rpt_blocks, repeat(rpt_input_file), chunks):
+                for name, info, times, values in results:
+                    if times is not None:
+                        index = pd.DatetimeIndex(times, name='time')
+                    print("Proceeding with --> ", name)
+                    yield name, info, pd.DataFrame(values, index=index, columns=info['df_header'][2:])
+    except Exception:
+        main_logger.error("Failed to decode the timeSeries blocks of {0} in parallel.".format(rpt_input_file))
+        stop_program()
+
+
+def make_block(block, first_line, time_axis=None):
+    """
+    Create the block information and the DataFrame of a single timeSeries block of the *.rpt file.
+    """
+    name, info = parse_rpt_block(block, first_line)
+    print("Proceeding with --> ", name)
+    # Line numbers relative to the block, so that make_df keeps the same rows as when parsing the whole file.
+    df = make_df(block, info['start_line'] - first_line, info['end_line'] - info['start_line'], info['df_header'],
+                 time_axis)
+    return name, info, df
+
+
+def make_time_axis(rows, times):
+    """
+    Describe the time axis of a report from the rows and decoded times of its first timeSeries block.
+    SWMM reports every location at the same REPORT_STEP, so a regular axis is built once as a DatetimeIndex
+    and shared by all the blocks. 'times' is None when the report times are not at a regular step.
+    """
+    import numpy as np
+    import pandas as pd
+    stamp = " ".join(rows[0].split()[:2])
+    offset = rows[0].index(stamp) + len(stamp)
+    steps = np.diff(times)
+    if len(steps) > 0 and (steps[0] <= np.timedelta64(0) or (steps != steps[0]).any()):
+        main_logger.debug("Irregular time steps in the *.rpt file; timestamps are decoded for every block.")
+        axis = None
     else:
-        main_logger.info("No errors, warnings or info messages were detected.")
-        df = pd.DataFrame(columns=['description', 'level'])
-    return df
+        step = pd.Timedelta(steps[0]) if len(steps) > 0 else None
+        axis = pd.date_range(times[0], periods=len(times), freq=step, name='time')
+    return {'times': axis, 'offset': offset, 'first': rows[0][:offset], 'last': rows[-1][:offset]}
 
 
-def read_rpt_file(rpt_input_file):
+def read_rpt_file(rpt_input_file, locations=None, variables=None, object_types=None, workers=1):
     """
     Read *.rpt ASCII file with timeSeries output from the simulation.
+    locations (e.g. ['Node_J1']), variables (e.g. ['Depth', 'Flow']) and object_types (e.g. ['Node', 'Link'])
+    are optional whitelists; the blocks of other locations are skipped while scanning the file.
+    With workers > 1, the blocks are decoded in parallel by that many processes (see iter_rpt_parallel).
     """
     try:
-        with open(rpt_input_file, "r") as f:
-            lines = f.readlines()
-            data_dict = {}
-            in_data = False
-            varchange = False
-            old_name = ""
-            main_logger.debug("Starting parsing *.rpt file...")
-            # Parse ASCII *.rpt file into nested Dictionary/DataFrame
-            for i in range(0, len(lines)):
-                try:
-                    if "<<<" in lines[i]:
-                        new_name = lines[i].strip().strip("<<<").strip(">>>").lstrip(" ").rstrip(" ").replace(" ", "_")
-                        print("Proceeding with --> ", new_name)
-                        data_dict[new_name] = {'start_line': i + 3}
-
-                        # Parsing Header and Units information.
-                        # Two potential cases:
-                        #   1) Date and Time located on the Header line (Nodes and Links)
-                        #   2) Date and Time located on the Units line (Subcatchment)
-                        header = lines[i + 2].strip().lstrip(" ").rstrip(" ").rstrip("/").split()
-                        units = lines[i + 3].strip().lstrip(" ").rstrip(" ").rstrip("/").split()  # [2::]
-                        if len(header) > len(units):
-                            df_header = header
-                            header = header[2::]
-                        else:
-                            df_header = units[:2] + header
-                            units = units[2::]
-                        units_dict = {}
-
-                        for item in range(len(header)):
-                            units_dict[header[item]] = units[item]
-                        data_dict[new_name] = {'start_line': i + 3, 'Header': header, 'Units': units,
-                                               'df_header': df_header, 'units_dict': units_dict}
-
-                        if not in_data:
-                            in_data = True
-
-                        elif varchange:
-                            varchange = False
-                            # Pass when there's a change in variable
-                        else:
-                            data_dict[old_name]['end_line'] = i - 3
-                            df_header = data_dict[old_name]['df_header']
-                            start = data_dict[old_name]['start_line']
-                            nrows = data_dict[old_name]['end_line'] - data_dict[old_name]['start_line']
-                            df = make_df(lines, start, nrows, df_header)
-                            data_dict[old_name]['Data'] = df
-
-                    elif not in_data:
-                        pass
-                    elif "***" in lines[i]:  # Export type/variable change
-                        data_dict[old_name]['end_line'] = i - 5
-                        df_header = data_dict[old_name]['df_header']
-                        start = data_dict[old_name]['start_line']
-                        nrows = data_dict[old_name]['end_line'] - data_dict[old_name]['start_line']
-                        df = make_df(lines, start, nrows, df_header)
-                        data_dict[old_name]['Data'] = df
-                        varchange = True
-
-                    elif "Analysis begun on" in lines[i]:  # Catch last item to be parsed
-                        main_logger.info("EPASWMM Model: " + lines[i].strip())
-                        data_dict[old_name]['end_line'] = i - 3
-                        df_header = data_dict[old_name]['df_header']
-                        start = data_dict[old_name]['start_line']
-                        nrows = data_dict[old_name]['end_line'] - data_dict[old_name]['start_line']
-                        df = make_df(lines, start, nrows, df_header)
-                        data_dict[old_name]['Data'] = df
-                    elif "Analysis ended on" in lines[i]:
-                        main_logger.info("EPASWMM Model: " + lines[i].strip())
-                    elif "Total elapsed time" in lines[i]:
-                        main_logger.info("EPASWMM Model: " + lines[i].strip())
-                        break
-                    else:
-                        old_name = new_name
-                except Exception:
-                    main_logger.error(
-                        "While parsing SWMM output RPT file, error encountered on line# {0}: {1}".format(str(i + 1),
-                                                                                                         lines[i]))
-                    stop_program()
-            if len(data_dict) == 0:
-                main_logger.error(
-                    "Error raised due to detected empty Time Series.  Check result file from EPA SWMM model output: %s" % (
-                        rpt_input_file))
-                stop_program()
-            else:
-                main_logger.debug("Done parsing *.rpt file.")
+        data_dict = {}
+        main_logger.debug("Starting parsing *.rpt file...")
+        # Parse ASCII *.rpt file into nested Dictionary/DataFrame
+        if workers > 1:
+            blocks = iter_rpt_parallel(rpt_input_file, workers, locations, object_types)
+        else:
+            blocks = iter_rpt_blocks(rpt_input_file, locations, object_types)
+        for name, info, df in blocks:
+            info['Data'] = df
+            if variables is not None:
+                info = select_variables(info, variables)
+                if len(info['Header']) == 0:
+                    continue
+            data_dict[name] = info
+        if len(data_dict) == 0:
+            main_logger.error(
+                "Error raised due to detected empty Time Series.  Check result file from EPA SWMM model output: %s" % (
+                    rpt_input_file))
+            stop_program()
+        else:
+            main_logger.debug("Done parsing *.rpt file.")
         return data_dict
     except Exception:
         main_logger.error("Error encountered while opening: {0}.".format(rpt_input_file))
         stop_program()
 
 
-def read_run_info(run_info_file):
+def read_rpt_locations(rpt_input_file, locations, index_file=None, variables=None, object_types=None):
+    """
+    Read the timeSeries of some locations only from a *.rpt ASCII file.
+    The blocks are found with index_rpt_file and only the requested ones are decoded, so the cost grows with the
+    number of locations requested rather than with the size of the report.
+    variables and object_types are optional whitelists (see read_rpt_file); the locations that are not in the
+    report are skipped with a warning.
+    Returns a dictionary with the same structure as read_rpt_file.
+    """
+    blocks = index_rpt_file(rpt_input_file, index_file)
+    locations = [location for location in locations if keep_location(location, None, object_types)]
+    missing = [location for location in locations if location not in blocks]
+    if missing:
+        main_logger.warning("Locations not found in the *.rpt file {0}: {1}".format(rpt_input_file,
+                                                                                  ", ".join(missing)))
+
+    data_dict = {}
+    time_axis = {}
+    with open(rpt_input_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for location in locations:
+            if location not in blocks:
+                continue
+            start, end, first_line = blocks[location]
+            block = mm[start:end].decode().replace("\r\n", "\n").splitlines(keepends=True)
+            name, info, df = make_block(block, first_line, time_axis)
+            info['Data'] = df
+            if variables is not None:
+                info = select_variables(info, variables)
+                if len(info['Header']) == 0:
+                    continue
+            data_dict[name] = info
+    if len(data_dict) == 0:
+        main_logger.error(
+            "Error raised due to detected empty Time Series.  Check result file from EPA SWMM model output: %s" % (
+                rpt_input_file))
+        stop_program()
+    main_logger.debug("Done reading {0} locations from the *.rpt file.".format(len(data_dict)))
+    return data_dict
+
+
+def read_run_info(run_info_file, base_dir=None):
     """ 
     Read FEWS run_info.xml file.
+    Relative paths are relative to base_dir if given (e.g. the folder of the run_info.xml), otherwise to the working
+    directory.
     """
-    global run_info
-    run_info = {}
+    info = {}
+    run_context.run_info = info
 
     if not os.path.exists(run_info_file):
         main_logger.error("Failed to find run_info file: " + str(run_info_file))
         print("Failed to parse run_info file: {0}.\nCheck the adapter log: {1}.".format(str(run_info_file),
-                                                                                        logger_filename))  # can't write run_diagnsotics, because if run_info is not found, then we don't know where to write
-        sys.exit(1)
+                                                                                        log_file()))  # can't write run_diagnsotics, because if run_info is not found, then we don't know where to write
+        raise AdapterError("Failed to find run_info file: " + str(run_info_file))
 
     try:
         tree = ET.parse(run_info_file)
         root = tree.getroot()
     except Exception:
         main_logger.error("Failed to parse run_info file.")
-        print("Failed to parse run_info file.; check:" + logger_filename)
-        sys.exit(1)
+        print("Failed to parse run_info file.; check:" + log_file())
+        raise AdapterError("Failed to parse run_info file: " + str(run_info_file))
 
-    run_info["diagnostic_xml"] = file_element(root.find("pi:outputDiagnosticFile", namespace), exists=False)
-    run_info["workDir"] = dir_element(root.find("pi:workDir", namespace).text, exists=True)
+    info["diagnostic_xml"] = file_element(root.find("pi:outputDiagnosticFile", namespace), exists=False,
+                                              base_dir=base_dir)
+    info["workDir"] = dir_element(root.find("pi:workDir", namespace).text, exists=True, base_dir=base_dir)
 
     st = time_element(root.find("pi:startDateTime", namespace))
     et = time_element(root.find("pi:endDateTime", namespace))
     t0 = time_element(root.find("pi:time0", namespace))
     lobs = time_element(root.find("pi:lastObservationDateTime", namespace))
     tz = root.find("pi:timeZone", namespace).text
-    run_info["start_time"] = pd.Timestamp(st)
-    run_info["end_time"] = pd.Timestamp(et)
-    run_info["time0"] = pd.Timestamp(t0)
-    run_info["last_obs_time"] = pd.Timestamp(lobs)
-    run_info["time_zone"] = float(tz)
+    info["start_time"] = st
+    info["end_time"] = et
+    info["time0"] = t0
+    info["last_obs_time"] = lobs
+    info["time_zone"] = float(tz)
 
     # The Rating Curve and the Control Rule files are optional inptus
     if root.find("pi:inputRatingCurveFile", namespace) is not None:
-        run_info["dam_rating_curve"] = file_element(root.find("pi:inputRatingCurveFile", namespace).text, exists=True)
+        info["dam_rating_curve"] = file_element(root.find("pi:inputRatingCurveFile", namespace).text, exists=True,
+                                                    base_dir=base_dir)
     else:
         main_logger.info("No rating curve file provided in the run_info.xml; rating curves will not be updated.")
         print("No rating curve file provided in the run_info.xml; rating curves will not be updated.")
@@ -439,7 +1123,8 @@ def read_run_info(run_info_file):
 
     if root.find("pi:inputTimeSeriesFile", namespace) is not None:
         if os.path.basename(root.find("pi:inputTimeSeriesFile", namespace).text) == "Control_rules.xml":
-            run_info["control_rule"] = file_element(root.find("pi:inputTimeSeriesFile", namespace),exists=True)
+            info["control_rule"] = file_element(root.find("pi:inputTimeSeriesFile", namespace), exists=True,
+                                                   base_dir=base_dir)
         else:
             main_logger.info("Time series file was provided, but is not is not considered a Control Rules file. Control_rules.xml is expected.")
             print("Time series file was provided, but is not is not considered a Control Rules file. Control_rules.xml is expected.")
@@ -447,119 +1132,201 @@ def read_run_info(run_info_file):
         main_logger.info("No control rule file (Control_rules.xml) provided in the run_info.xml; control rules will not be updated.")
         print("No control rule file (Control_rules.xml) provided in the run_info.xml; control rules will not be updated.")
 
-    run_info["netcdf"] = file_element(root.find("pi:inputNetcdfFile", namespace))
+    info["netcdf"] = file_element(root.find("pi:inputNetcdfFile", namespace), base_dir=base_dir)
 
 
     # To keep the number of configuration files to a minimum,
     # we put extra properties in the run_info.xml
     properties = root.find("pi:properties", namespace)
-    run_info["properties"] = {}
-    for e in properties.findall("pi:string", namespace):
+    info["properties"] = {}
+    for e in properties:
         key = e.get("key")
         val = e.get("value")
-        path = file_element(val, exists=True)  # currently, the two files are in the properties section are: 1) SWMM exe, 2) SWMM inp file; both should exist
-        run_info["properties"][key] = path
+        tag = e.tag.replace("{%s}" % namespace["pi"], "")
+        if key in file_properties:
+            # the SWMM exe and the SWMM inp file should exist
+            info["properties"][key] = file_element(val, exists=True, base_dir=base_dir)
+        elif tag == "int":
+            info["properties"][key] = int(val)
+        elif tag == "double":
+            info["properties"][key] = float(val)
+        elif tag == "bool":
+            info["properties"][key] = val.lower() == "true"
+        else:
+            info["properties"][key] = val
+
+    info["properties"].setdefault("swmm_results_format", "text")
+    info["properties"].setdefault("rpt_workers", 1)
+    info["properties"].setdefault("engine", "executable")
+    if info["properties"]["swmm_results_format"] not in ("text", "binary"):
+        main_logger.error("swmm_results_format in the run_info.xml must be 'text' (*.rpt) or 'binary' (*.out).")
+        stop_program()
+    if info["properties"]["engine"] not in ("executable", "library"):
+        main_logger.error("engine in the run_info.xml must be 'executable' (model-executable) or 'library' "
+                          "(swmm_library).")
+        stop_program()
+    if info["properties"]["engine"] == "library" and "swmm_library" not in info["properties"]:
+        main_logger.error("engine 'library' requires the swmm_library property in the run_info.xml.")
+        stop_program()
+    if int(info["properties"].get("netcdf_stream_periods", 0)) > 0 and (
+            info["properties"]["engine"] != "library" or info["properties"].get("netcdf_dtype") == "int16"):
+        main_logger.error("netcdf_stream_periods in the run_info.xml requires engine 'library', and a netcdf_dtype "
+                          "other than 'int16' (packed with the range of the first periods only).")
+        stop_program()
 
     # Hardwired properties
-    swmm_input_path = run_info["properties"]["swmm_input_file"]
+    swmm_input_path = info["properties"]["swmm_input_file"]
     swmm_input_fn = os.path.splitext(os.path.basename(swmm_input_path))[0]
-    run_info["properties"]["UDUNITS"] = file_element(
+    info["properties"]["UDUNITS"] = file_element(
         str(Path(run_info_file).parents[0]) + "//model//UDUNITS_lookup.csv", exists=True)
-    run_info["properties"]["out_nodes_netcdf"] = file_element(
+    info["properties"]["out_nodes_netcdf"] = file_element(
         str(Path(run_info_file).parents[0]) + "//output//" + swmm_input_fn + "_output_nodes.nc", exists=False)
-    run_info["properties"]["out_links_netcdf"] = file_element(
+    info["properties"]["out_links_netcdf"] = file_element(
         str(Path(run_info_file).parents[0]) + "//output//" + swmm_input_fn + "_output_links.nc", exists=False)
-    run_info["properties"]["swmm_output_file"] = file_element(
+    info["properties"]["swmm_output_file"] = file_element(
         str(Path(run_info_file).parents[0]) + "//model//" + swmm_input_fn + ".rpt", exists=False)
-    return run_info
+    info["properties"]["swmm_binary_output_file"] = file_element(
+        str(Path(run_info_file).parents[0]) + "//model//" + swmm_input_fn + ".out", exists=False)
+    return info
 
 
-def read_rating_curve(rating_curve_file):
+def rainfall_digest(station_id, times, P, n_times):
     """
-    Reads the dam rating curve XML file, and returns a dictionary with pairs of a) location and b) a string (formatted for use with SWMM)
+    Digest of the first n_times time steps of the rainfall arrays (see read_rainfall).
+    """
+    import numpy as np
+    digest = hashlib.sha1("\n".join(station_id.tolist()).encode("utf-8"))
+    digest.update(times.asi8[:n_times].tobytes())
+    digest.update(np.ascontiguousarray(P[:, :n_times]).tobytes())
+    return digest.hexdigest()
+
+
+def read_rainfall(rainfall_net_cdf):
     """
+    Read the rainfall NetCDF file from FEWS as NumPy arrays: the decoded station ids (S,), the times (T,) and the
+    P values (S, T), station after station (the order of ds.to_dataframe() in the original writer), for every
+    analysis time of the file.
+    """
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
     try:
-        tree = ET.parse(rating_curve_file)
-        root = tree.getroot()
-        curves = root.findall("pi:ratingCurve", namespace)
+        with xr.open_dataset(rainfall_net_cdf) as ds:
+            station_id = ds["station_id"].values
+            times = pd.DatetimeIndex(ds["time"].values)
+            dims = [dim for dim in sorted(ds.dims) if dim not in ("stations", "time")] + ["stations", "time"]
+            P = ds["P"].broadcast_like(ds).transpose(*dims).values.reshape(-1, len(times))
     except Exception:
-        main_logger.error("Failed to parse rating curve file.")
+        main_logger.error("Failed to read the rainfall NetCDF file: {0}".format(rainfall_net_cdf))
         stop_program()
+    if station_id.dtype.kind == "S":
+        station_id = np.char.decode(station_id, "utf-8")
+    return np.tile(station_id.astype(str), len(P) // max(len(station_id), 1)), times, P
 
-    if len(curves) == 0:
-        main_logger.error("No rating curves provided in {0}.".format(rating_curve_file))
-        stop_program()
-        raise ValueError("No rating curves found in the rating curve XML file {0}.".format(rating_curve_file))
 
+def read_rating_curve(rating_curve_file):
+    """
+    Reads the dam rating curve XML file, and returns a dictionary with pairs of a) location and b) a string (formatted for use with SWMM)
+    The file is streamed with iterparse: each curve is dropped from the tree once it has been read.
+    """
+    pi = "{%s}" % namespace["pi"]
     dict_rc = dict()
     loc_list = []
-    for curve in curves:
-        for item in curve.findall("pi:header", namespace):
-            loc = item.find("pi:locationId", namespace).text
+    loc = None
+    rows = None
+    try:
+        context = ET.iterparse(rating_curve_file, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event == "start":
+                if elem.tag == pi + "ratingCurve":
+                    loc = None
+                    rows = None
+                elif elem.tag == pi + "table":
+                    rows = []
+                continue
             try:
-                loc_list = loc_list + [loc]
-                unit = item.find("pi:stageUnit", namespace).text
-                for table in curve.findall("pi:table", namespace):
-                    rows = table.findall("pi:row", namespace)
-                    rating_curve_string = ""
-                    i = 0
-                    for r in rows:
-                        if i == 0:
-                            rating_curve_string = loc + "     " + "Rating" + "     " + r.get('stage') + "     " + \
-                                                  r.get('discharge') + '\n'
-                        else:
-                            rating_curve_string = rating_curve_string + loc + "     " + "     " + "     " + \
-                                                  r.get('stage') + "     " + r.get('discharge') + '\n'
-                        i += 1
-                dict_rc[loc] = rating_curve_string
+                if elem.tag == pi + "row":
+                    if len(rows) == 0:
+                        rows.append(loc + "     " + "Rating" + "     " + elem.get('stage') + "     " +
+                                    elem.get('discharge') + '\n')
+                    else:
+                        rows.append(loc + "     " + "     " + "     " + elem.get('stage') + "     " +
+                                    elem.get('discharge') + '\n')
+                    elem.clear()
+                elif elem.tag == pi + "header":
+                    loc = elem.find("pi:locationId", namespace).text
+                    loc_list.append(loc)
+                    unit = elem.find("pi:stageUnit", namespace).text
+                elif elem.tag == pi + "ratingCurve":
+                    dict_rc[loc] = "".join(rows)
+                    root.clear()
             except Exception:
-                print("Failed to extract rating curve for: " + loc)
-                main_logger.error("Failed to extract rating curve for: " + loc)
+                print("Failed to extract rating curve for: " + str(loc))
+                main_logger.error("Failed to extract rating curve for: " + str(loc))
                 stop_program()
+    except (ET.ParseError, OSError, StopIteration):
+        main_logger.error("Failed to parse rating curve file.")
+        stop_program()
+
+    if len(loc_list) == 0:
+        main_logger.error("No rating curves provided in {0}.".format(rating_curve_file))
+        stop_program()
+        raise ValueError("No rating curves found in the rating curve XML file {0}.".format(rating_curve_file))
+
     if len(loc_list) != len(set(loc_list)):
         main_logger.error("Multiple curves with the same name found in {0}".format(rating_curve_file))
         stop_program()
-    if len(loc_list) >= 1:
-        main_logger.info(
-            "{0} rating curves provided in {1}: {2}".format(len(loc_list), str(rating_curve_file), loc_list))
-    else:
-        main_logger.error("No rating curves provided in {0}.".format(rating_curve_file))
+    main_logger.info(
+        "{0} rating curves provided in {1}: {2}".format(len(loc_list), str(rating_curve_file), loc_list))
     return dict_rc
 
 
-def read_control_rules(control_rule_file):
-    tree = ET.parse(control_rule_file)
-    root = tree.getroot()
-    tseries = root.findall("pi:series", namespace)
-
+def read_control_rules(control_rule_file, compact=False):
+    """
+    Reads the control rules XML file, and returns a dictionary with pairs of a) location-parameter and b) the
+    SWMM rules (one rule per event, at the date and time of the event).
+    With compact=True, an event with the same setting as the previous one is skipped: SWMM keeps a setting
+    until a rule changes it, so only the change points are needed.
+    The file is streamed with iterparse: each series is dropped from the tree once it has been read.
+    """
+    pi = "{%s}" % namespace["pi"]
     dict_rules = dict()
     rule_list = []
     j = 0
 
-    for s in tseries:
-        rating_curve_string = ''
-        for item in s.findall("pi:header", namespace):
-            param = item.find("pi:parameterId", namespace).text
-            loc = item.find("pi:locationId", namespace).text
-            missing_value = item.find("pi:missVal", namespace).text
-
-            rule_id = loc + '-' + param  # unique identifier of these time series rules
-            rule_list = rule_list + [rule_id]
-
-        events = s.findall("pi:event", namespace)
-        i = 0
-        for e in events:
+    context = ET.iterparse(control_rule_file, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "start":
+            if elem.tag == pi + "series":
+                rules = []
+                i = 0
+                previous = None
+            continue
+        if elem.tag == pi + "event":
             # convert date format for epaswmm
-            if e.get('value') != missing_value:
-                d = time_element(e)
-                rating_curve_string = rating_curve_string + 'Rule ' + 'AdapterRule' + str(j + 1) + '.' + str(
-                    i + 1) + '\n' + \
-                                      'IF SIMULATION DATE = ' + d.strftime('%m/%d/%Y') + '\n' \
-                                      'AND SIMULATION CLOCKTIME = ' + d.strftime("%H:%M:%S") + '\n' \
-                                      'THEN' + ' ' + param + ' ' + loc + ' ' + 'SETTING = ' + e.get('value') + '\n\n'
+            value = elem.get('value')
+            if value != missing_value and not (compact and previous is not None and float(value) == float(previous)):
+                d = time_element(elem)
+                rules.append('Rule AdapterRule' + str(j + 1) + '.' + str(i + 1) + '\n' +
+                             'IF SIMULATION DATE = ' + d.strftime('%m/%d/%Y') + '\n' +
+                             'AND SIMULATION CLOCKTIME = ' + d.strftime("%H:%M:%S") + '\n' +
+                             'THEN ' + param + ' ' + loc + ' SETTING = ' + value + '\n\n')
+                previous = value
                 i += 1
-        dict_rules[rule_id] = rating_curve_string
-        j += 1
+            elem.clear()
+        elif elem.tag == pi + "header":
+            param = elem.find("pi:parameterId", namespace).text
+            loc = elem.find("pi:locationId", namespace).text
+            missing_value = elem.find("pi:missVal", namespace).text
+
+            rule_id = loc + '-' + param  # unique identifier of these time series rules
+            rule_list.append(rule_id)
+        elif elem.tag == pi + "series":
+            dict_rules[rule_id] = "".join(rules)
+            j += 1
+            root.clear()
 
     if len(rule_list) != len(set(rule_list)):
         main_logger.error("Multiple rule time series for the same location-type pair (e.g. OL341-OUTLET) found in {0}".format(
@@ -587,22 +1354,415 @@ def read_units(units_input_file):
         stop_program()
     return swmm_unit_dict
 
+def select_variables(info, variables):
+    """
+    Keep only some variables in the results of a location (Header, Units, units_dict and Data).
+    """
+    header = [var for var in info['Header'] if var in variables]
+    info['Units'] = [info['units_dict'][var] for var in header]
+    info['units_dict'] = {var: info['units_dict'][var] for var in header}
+    info['Header'] = header
+    info['Data'] = info['Data'][header]
+    return info
+
+
+def run_ensemble_member(command, member_run_info):
+    """
+    Run the pre-adapter, the model and the post-adapter of one ensemble member, each one in its own process like
+    FEWS does. Returns the command that failed, or None.
+    """
+    for step in ("pre", "run", "post"):
+        if subprocess.run(command + ["--run_info", str(member_run_info), step]).returncode != 0:
+            return step
+    return None
+
+
+def run_swmm_library(swmm, inp_file, rpt_file, out_file="", locations=None, variables=None, on_periods=None,
+                     n_periods=1):
+    """
+    Run the model in-process with the EPA SWMM shared library (see load_swmm_library), and collect the results of
+    the nodes and links at each reporting time while stepping, the way SWMM interpolates them between routing steps
+    for its output file. The status report (warnings and errors) is still written to rpt_file, and the binary output
+    file to out_file if given. Returns a dictionary with the same structure as read_out_file.
+    locations and variables are optional whitelists (see read_rpt_file).
+    With on_periods, the results are streamed instead: on_periods is called with the dictionary of every n_periods
+    new reporting periods (and of the last ones) while the model is running, and None is returned.
+    """
+    import numpy as np
+    import pandas as pd
+    def check(error_code):
+        if error_code != 0:
+            message = ctypes.create_string_buffer(256)
+            swmm.swmm_getError(message, 256)
+            main_logger.error("EPA SWMM error {0}: {1}".format(error_code, message.value.decode("utf-8").strip()))
+            swmm.swmm_close()
+            stop_program()
+
+    check(swmm.swmm_open(str(inp_file).encode("utf-8"), str(rpt_file).encode("utf-8"),
+                         str(out_file).encode("utf-8")))
+    check(swmm.swmm_start(1 if out_file else 0))
+
+    objects = []  # (kind, name, index) of the selected nodes and links
+    name = ctypes.create_string_buffer(256)
+    for kind, code in swmm_library_objects.items():
+        for index in range(swmm.swmm_getCount(code)):
+            swmm.swmm_getName(code, index, name, 256)
+            if keep_location(kind + "_" + name.value.decode("utf-8"), locations):
+                objects.append((kind, name.value.decode("utf-8"), index))
+    codes = [(code, index) for kind, _, index in objects for _, code in swmm_library_variables[kind]]
+    # Full depth of the conduits, 0 for the nodes and the other links
+    full_depth = np.array([swmm.swmm_getValue(swmm_link_fulldepth, index)
+                           if kind == "Link" and int(swmm.swmm_getValue(swmm_link_type, index)) == swmm_conduit
+                           else 0.0 for kind, _, index in objects])
+    units = swmm_units(int(swmm.swmm_getValue(8, 0)))  # swmm_FLOWUNITS
+    start_date = swmm.swmm_getValue(0, 0)  # swmm_STARTDATE, decimal days since 12/30/1899
+    report_step = swmm.swmm_getValue(5, 0)  # swmm_REPORTSTEP, seconds
+
+    def get_values():
+        return np.array([swmm.swmm_getValue(code, index) for code, index in codes], dtype=np.float64)
+
+    def results(periods, first_period):
+        # Dictionary of the results of the reporting periods first_period, first_period + 1, ...
+        values = np.stack(periods).reshape(len(periods), len(objects), 4)  # four variables per node or link
+        seconds = np.round(start_date * 86400 + report_step * np.arange(first_period, first_period + len(periods)))
+        times = pd.DatetimeIndex(np.datetime64("1899-12-30", "s") + seconds.astype(np.int64).astype("timedelta64[s]"),
+                                 name="time")
+        data_dict = {}
+        for j, (kind, location, index) in enumerate(objects):
+            header = [name for name, _, _ in swmm_out_variables[kind] if variables is None or name in variables]
+            if len(header) == 0:
+                continue
+            data = values[:, j, :]
+            if kind == "Link":
+                # Capacity: fraction of the full depth of a conduit, or the setting of the other links
+                depth, setting = data[:, 2], data[:, 3]
+                data = data.copy()
+                data[:, 3] = depth / full_depth[j] if full_depth[j] > 0 else setting
+            names = [name for name, _ in swmm_library_variables[kind]]
+            header_units = [units[unit] for name, _, unit in swmm_out_variables[kind] if name in header]
+            data_dict[kind + "_" + location] = {
+                'Header': header, 'Units': header_units, 'df_header': ['Date', 'Time'] + header,
+                'units_dict': dict(zip(header, header_units)),
+                'Data': pd.DataFrame(data[:, [names.index(name) for name in header]], index=times, columns=header)}
+        return data_dict
+
+    # Results of each reporting period, interpolated between the routing times before and after it (in seconds)
+    periods = []
+    first_period = 1
+    old_time, old_values = 0.0, get_values()
+    report_time = report_step
+    elapsed = ctypes.c_double(0.0)
+    while True:
+        check(swmm.swmm_step(ctypes.byref(elapsed)))
+        if elapsed.value <= 0:
+            break
+        new_time, new_values = elapsed.value * 86400, get_values()
+        while report_time <= new_time:
+            f = (report_time - old_time) / (new_time - old_time)
+            periods.append(old_values + f * (new_values - old_values))
+            report_time += report_step
+        old_time, old_values = new_time, new_values
+        if on_periods is not None and len(periods) >= n_periods:
+            on_periods(results(periods, first_period))
+            first_period += len(periods)
+            periods = []
+
+    check(swmm.swmm_end())
+    check(swmm.swmm_report())
+    check(swmm.swmm_close())
+
+    if len(periods) == 0 and first_period == 1:
+        main_logger.error("Error raised due to detected empty Time Series.  No reporting period in {0}".format(
+            inp_file))
+        stop_program()
+    main_logger.debug("Done running the EPA SWMM shared library.")
+    if on_periods is None:
+        return results(periods, first_period)
+    if len(periods) > 0:
+        on_periods(results(periods, first_period))
+    return None
+
+
+def save_inp_cache(sections, inp_file, cache_file=None):
+    """
+    Pickle the parsed sections of inp_file (see read_inp) to cache_file (default: inp_file + ".pkl"), with the
+    size, modification time and sha1 of inp_file, so that read_inp_cached can reuse them.
+    """
+    cache_file = str(inp_file) + ".pkl" if cache_file is None else cache_file
+    # One line per element, as read_inp returns them (inserted curves and control rules span several lines)
+    sections = [[name, "".join(lines).splitlines(keepends=True)] for name, lines in sections]
+    try:
+        stat = os.stat(inp_file)
+        cache = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                 "sha1": hashlib.sha1(Path(inp_file).read_bytes()).hexdigest(), "sections": sections}
+        # Written to a temporary file of its own first, so that runs sharing a template (in several processes, or in
+        # the threads of a resident adapter) never read a partial cache
+        fd, cache_tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(cache_file)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_tmp, cache_file)
+        except Exception:
+            os.remove(cache_tmp)
+            raise
+        file_cache[(read_inp_cached.__name__, str(inp_file))] = (stat.st_size, stat.st_mtime_ns, sections)
+    except Exception:
+        main_logger.warning("Could not save the INP cache file: {0}".format(cache_file))
+
+
+def set_inp_curves(sections, rating_curve):
+    """
+    Replace the rating curves ({curve id: text}) of the [CURVES] section of a parsed *.inp file (see read_inp).
+    A curve starts on its '<id> Rating x y' line and its lines are replaced up to the next blank or comment line;
+    the other curves are kept. Returns the new sections and the set of rating curve ids found in the file.
+    """
+    set_curves = set()
+    if not bool(rating_curve):
+        main_logger.debug(
+            "No rating curves found when updating the [CURVES] section. No updates will be made to this section.")
+        return sections, set_curves
+
+    new_sections = []
+    write_original = True
+    for name, lines in sections:
+        if name == "[CURVES]":
+            curve_lines = []
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 4 and fields[1] == 'Rating':
+                    curve_id = fields[0]
+                    set_curves.add(curve_id)
+                    write_original = curve_id not in rating_curve
+                    if not write_original:
+                        main_logger.info("Using the curve from the XML file for: " + curve_id)
+                        curve_lines.append(rating_curve[curve_id])
+                elif line == '\n' or line.startswith(";"):
+                    write_original = True
+                if write_original:
+                    curve_lines.append(line)
+            lines = curve_lines
+        new_sections.append([name, lines])
+    return new_sections, set_curves
+
+
+def set_inp_file_paths(sections, base_dir):
+    """
+    Make the relative file names of a parsed *.inp file (see read_inp) absolute, relative to base_dir: the files of
+    the rain gages, time series and temperatures, and the interface files of the [FILES] section. Returns the new
+    sections.
+    """
+    def absolute(match):
+        file_name = match.group(2).strip('"')
+        if not os.path.isabs(file_name):
+            file_name = os.path.join(str(base_dir), file_name)
+        return match.group(1) + '"' + file_name + '"'
+
+    new_sections = []
+    for name, lines in sections:
+        if name == "[FILES]":
+            pattern = inp_interface_file
+        elif name in ("[RAINGAGES]", "[TIMESERIES]", "[TEMPERATURE]"):
+            pattern = inp_file_name
+        else:
+            pattern = None
+        if pattern is not None:
+            lines = [line if line.lstrip().startswith(";") else pattern.sub(absolute, line, count=1)
+                     for line in lines]
+        new_sections.append([name, lines])
+    return new_sections
+
+
+def set_inp_options(sections, options):
+    """
+    Replace the lines of the [OPTIONS] section of a parsed *.inp file (see read_inp) that start with one of the
+    keywords of options ({keyword: new line without end of line}). Returns the new sections.
+    """
+    new_sections = []
+    for name, lines in sections:
+        if name == "[OPTIONS]":
+            lines = list(lines)
+            for i, line in enumerate(lines):
+                keyword = inp_keyword.match(line)
+                if keyword is not None and keyword.group() in options:
+                    lines[i] = options[keyword.group()] + "\n"
+        new_sections.append([name, lines])
+    return new_sections
+
+
+def split_ensemble_rainfall(run_info_file, rainfall_net_cdf):
+    """
+    Split a member-indexed rainfall NetCDF file from FEWS (with a realization dimension) into one scratch copy of the
+    run_info.xml folder per member, next to it (e.g. Don_member_0, Don_member_1, ...), so that the members can run
+    side by side. Each copy has the rainfall of its member, and a run_info.xml referring to it.
+    The absolute paths of the run_info.xml that are in its folder are replaced by the same paths in the folder of the
+    member (relative paths already are). The files written by the runs (workDir, output files and swmm_input_file)
+    must be in the folder of the run_info.xml, otherwise the members would share them.
+    Returns the run_info files and the realization of the members.
+    """
+    import xarray as xr
+    base_dir = Path(run_info_file).resolve().parents[0]
+    try:
+        rainfall = xr.open_dataset(rainfall_net_cdf)
+        realizations = [int(r) for r in rainfall["realization"].values]
+    except Exception:
+        main_logger.error("No realization dimension found in the rainfall NetCDF file: {0}".format(rainfall_net_cdf))
+        stop_program()
+
+    def ignore(directory, names):
+        # The outputs and logs of the base run are not copied, only their folders
+        return names if Path(directory) in (base_dir / "output", base_dir / "log") else []
+
+    def member_path(text, member_dir, written, name, bin_rule=False):
+        # Path of the member for a path of the run_info.xml, resolved the same way as in read_run_info
+        path = Path(text)
+        if path.is_absolute():
+            resolved = path
+        elif bin_rule:
+            resolved = file_element(text, exists=False, base_dir=base_dir)
+        else:
+            resolved = base_dir / path
+        try:
+            relative = Path(os.path.normpath(str(resolved))).relative_to(base_dir)
+        except ValueError:
+            if written:
+                main_logger.error("{0} ({1}) is outside of the folder of {2}: the ensemble members would share it. "
+                                  "Use a path in that folder.".format(name, text, run_info_file))
+                stop_program()
+            return text  # e.g. the model executable, shared by the members but not written
+        return str(member_dir / relative) if path.is_absolute() else text
+
+    ET.register_namespace("", namespace["pi"])
+    member_files = []
+    try:
+        for k, realization in enumerate(realizations):
+            member_dir = base_dir.parents[0] / "{0}_member_{1}".format(base_dir.name, realization)
+            tree = ET.parse(run_info_file)
+            for elem in tree.getroot():
+                tag = elem.tag.replace("{%s}" % namespace["pi"], "")
+                if tag == "workDir" or tag.startswith("input") or tag.startswith("output"):
+                    elem.text = member_path(elem.text, member_dir, tag == "workDir" or tag.startswith("output"), tag,
+                                            bin_rule=tag == "inputRatingCurveFile")
+                elif tag == "properties":
+                    for prop in elem:
+                        if prop.get("key") in file_properties:
+                            prop.set("value", member_path(prop.get("value"), member_dir,
+                                                          prop.get("key") == "swmm_input_file", prop.get("key"),
+                                                          bin_rule=True))
+
+            if member_dir.exists():
+                shutil.rmtree(member_dir)
+            shutil.copytree(base_dir, member_dir, ignore=ignore)
+            member_rainfall = member_dir / "input" / Path(rainfall_net_cdf).name
+            member_rainfall.parent.mkdir(exist_ok=True)
+            rainfall.isel(realization=k).to_netcdf(member_rainfall)
+
+            member_file = member_dir / Path(run_info_file).name
+            tree.getroot().find("pi:inputNetcdfFile", namespace).text = str(member_rainfall)
+            tree.write(member_file, encoding="UTF-8", xml_declaration=True)
+            member_files.append(member_file)
+    finally:
+        rainfall.close()
+    main_logger.info("{0} ensemble members written next to {1}".format(len(member_files), base_dir))
+    return member_files, realizations
+
+
+def peak_rss():
+    """
+    Peak resident set size (peak working set on Windows) of the adapter process so far, in MB, or None if unknown.
+    """
+    try:
+        if os.name == "nt":
+            from ctypes import wintypes
+
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaNonPagedPoolUsage", ctypes.c_size_t), ("PagefileUsage", ctypes.c_size_t),
+                            ("PeakPagefileUsage", ctypes.c_size_t)]
+
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess
+            process.restype = wintypes.HANDLE
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(process(), ctypes.byref(counters), counters.cb):
+                return None
+            return counters.PeakWorkingSetSize / 2 ** 20
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10  # bytes on macOS, kB on Linux
+    except Exception:
+        return None
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """
+    Time a stage of an adapter command. The wall time, the CPU time (of the adapter process, and of its child
+    processes such as the SWMM executable except on Windows) and the peak RSS of the process at the end of the stage
+    are logged as an INFO line, which goes to the run diagnostics file with the other messages of the log, and are
+    kept for the metrics file of the command (see write_stage_metrics).
+    With the --profile option, the stage is also profiled with cProfile, to a pstats file in the log folder
+    (e.g. log/post_adapter_read_results.prof).
+    A stage run within another stage is part of the outer one, and is not timed on its own.
+    """
+    if run_context.stage is not None:
+        yield
+        return
+    run_context.stage = stage
+    profiler = cProfile.Profile() if run_context.profile else None
+    wall, cpu = time.perf_counter(), time.process_time() + sum(os.times()[2:4])  # children are 0 on Windows
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall, cpu = time.perf_counter() - wall, time.process_time() + sum(os.times()[2:4]) - cpu
+        run_context.stage = None
+        rss = peak_rss()
+        main_logger.info("Stage {0}: {1:.3f} s wall time, {2:.3f} s CPU time, peak RSS {3}".format(
+            stage, wall, cpu, "unknown" if rss is None else "{0:.1f} MB".format(rss)))
+        if run_context.stages is not None:
+            run_context.stages.append({"stage": stage, "wall_time": wall, "cpu_time": cpu, "peak_rss_mb": rss})
+        if profiler is not None:
+            prof_file = str(Path(log_file()).with_name("{0}_{1}.prof".format(Path(log_file()).stem, stage)))
+            try:
+                profiler.dump_stats(prof_file)
+                main_logger.info("Profile of stage {0} written to: {1}".format(stage, prof_file))
+            except OSError:
+                main_logger.warning("Could not write the profile of stage {0}: {1}".format(stage, prof_file))
+
+
 def stop_program():
     """
     Used when an error is encountered:
     - Read the adapter log
     - Write errors to run_diagnostics.xml
-    - Exit program execution.
+    - Exit program execution (raise AdapterError).
     """
     if "pytest" in sys.modules:
         xml = r"log/run_diagnostic_test_cases.xml"
+    elif run_context.run_info is not None:
+        xml = run_context.run_info["diagnostic_xml"]
     else:
-        xml = run_info["diagnostic_xml"]
+        xml = None  # the run_info.xml was not read: the location of the diagnostics file is unknown
     main_logger.error(
         "STOPPING ADAPTER : Error encountered while running the adapter. Reading Adapter Log, and writing the Diagnostics File and exiting.")
-    df = read_errors_warnings([logger_filename])
-    write_run_diagnostics(df, xml)
-    sys.exit(1)
+    if xml is not None and log_file() is not None:
+        write_run_diagnostics(read_diagnostics([log_file()]), xml)
+    raise AdapterError("Error encountered while running the adapter; see {0}".format(log_file()))
+
+def swmm_units(flow_code):
+    """
+    Units of the EPA SWMM results (flow, length, velocity, rainfall and setting), from the flow units code.
+    """
+    si = flow_code >= swmm_flow_units.index("CMS")
+    return {"flow": swmm_flow_units[flow_code], "length": "meters" if si else "feet",
+            "velocity": "m/sec" if si else "ft/sec", "rainfall": "mm/hr" if si else "in/hr", "setting": "Setting"}
+
 
 def time_element(elem):
     """
@@ -616,40 +1776,143 @@ def time_element(elem):
         stop_program()
     return dt
 
-def write_netcdf(ds, ds_fn):
+def write_netcdf(ds, ds_fn, encoding=None, unlimited_dims=None):
     """
     Write a DataSet to NetCDF format.
+    encoding is an optional per-variable encoding (see netcdf_encoding). unlimited_dims (e.g. ("time",)) are the
+    dimensions that can be extended afterwards with append_netcdf.
     """
     try:
-        ds.to_netcdf(ds_fn, mode='w')
+        ds.to_netcdf(ds_fn, mode='w', encoding=encoding, unlimited_dims=unlimited_dims)
     except Exception:
         main_logger.error("Failed to write dataset to:" + str(ds_fn))
         stop_program()
 
 
+def write_inp(sections, inp_file):
+    """
+    Write the sections of a parsed *.inp file (see read_inp).
+    """
+    with open(inp_file, "w") as f:
+        for name, lines in sections:
+            f.writelines(lines)
+
+
 def write_rainfall(rainfall_net_cdf, rainfall_dat, col_to_convert=['station_id', 'station_names']):
     """
-    Reads the rainfall NetCDF file, converts column type (unicode).
-    Write the rainfall in SWMM .DAT format.
-    """
-    df_rain = read_netcdf(rainfall_net_cdf, col_to_convert)
-    df_rain = df_rain.reset_index()[["station_id", "time", "P"]]
-    df_rain['year'] = df_rain['time'].dt.year
-    df_rain['month'] = df_rain['time'].dt.month
-    df_rain['day'] = df_rain['time'].dt.day
-    df_rain['hour'] = df_rain['time'].dt.hour
-    df_rain['minute'] = df_rain['time'].dt.minute
-    df_rain = df_rain[["station_id", "year", "month", "day", "hour", "minute", "P"]]
-    df_rain.to_csv(rainfall_dat, sep=" ", header=[";Rainfall"] + (len(df_rain.columns) - 1) * [""],
-                   escapechar="\\", quoting=csv.QUOTE_NONE, index=False)
-    main_logger.info(
-        "Converted the NetCDF rainfall file ({0}) to EPASWMM .DAT format ({1}).".format(rainfall_net_cdf, rainfall_dat))
+    Reads the rainfall NetCDF file and writes the rainfall in SWMM .DAT format.
+    The P values and the time axis are read as NumPy arrays (see read_rainfall) and the rows are written station
+    after station, one buffered write per station. Only the station ids are decoded (once per station);
+    col_to_convert is kept so that existing calls keep working.
+
+    A digest of the rainfall is kept next to the .DAT file (rainfall_dat + ".digest"). The .DAT file is not
+    rewritten if the rainfall has not changed since it was written, and only the new time steps are appended
+    if the rainfall was only extended in time.
+    """
+    station_id, times, P = read_rainfall(rainfall_net_cdf)
+    digest_file = str(rainfall_dat) + ".digest"
+    previous = None
+    if os.path.isfile(digest_file) and os.path.isfile(rainfall_dat):
+        try:
+            with open(digest_file) as f:
+                previous = json.load(f)
+            stat = os.stat(rainfall_dat)
+            if previous["size"] != stat.st_size or previous["mtime"] != stat.st_mtime:
+                previous = None  # the .DAT file was changed by something else
+        except Exception:
+            previous = None
+
+    n_old = previous["n_times"] if previous is not None else 0
+    if 0 < n_old <= len(times) and previous["digest"] == rainfall_digest(station_id, times, P, n_old):
+        if n_old == len(times):
+            main_logger.info("Rainfall unchanged since {0} was written; not rewritten.".format(rainfall_dat))
+            return
+        write_rainfall_rows(rainfall_dat, station_id, times[n_old:], P[:, n_old:], mode="a")
+        main_logger.info("Appended {0} time steps of the NetCDF rainfall file ({1}) to {2}.".format(
+            len(times) - n_old, rainfall_net_cdf, rainfall_dat))
+    else:
+        write_rainfall_rows(rainfall_dat, station_id, times, P)
+        main_logger.info(
+            "Converted the NetCDF rainfall file ({0}) to EPASWMM .DAT format ({1}).".format(rainfall_net_cdf,
+                                                                                          rainfall_dat))
+
+    stat = os.stat(rainfall_dat)
+    try:
+        with open(digest_file, "w") as f:
+            json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "n_times": len(times),
+                       "digest": rainfall_digest(station_id, times, P, len(times))}, f)
+    except Exception:
+        main_logger.warning("Could not save the rainfall digest file: {0}".format(digest_file))
+
+
+def write_rainfall_rows(rainfall_dat, station_id, times, P, mode="w"):
+    """
+    Write rainfall arrays (see read_rainfall) as rows of the SWMM .DAT file, station after station.
+    The header is only written with mode="w"; with mode="a" the rows are appended to the file.
+    The rows are formatted as they used to be by DataFrame.to_csv: the station ids are escaped with a backslash,
+    missing values are empty and the values are the repr of the float64 value.
+    """
+    import numpy as np
+    station_id = [station.replace("\\", "\\\\").replace(" ", "\\ ") + " " for station in station_id.tolist()]
+    stamps = (times.year.astype(str) + " " + times.month.astype(str) + " " + times.day.astype(str) + " " +
+              times.hour.astype(str) + " " + times.minute.astype(str) + " ").tolist()
+    # Rainfall takes few distinct values (zeros, radar levels): each one is formatted once.
+    uniques, inverse = np.unique(P, return_inverse=True)
+    text = np.where(np.isnan(uniques), "", uniques.astype(np.float64).astype(str))
+    values = text[inverse.reshape(P.shape)].tolist()
+    with open(rainfall_dat, mode) as f:
+        if mode == "w":
+            f.write(";Rainfall" + 6 * " " + "\n")
+        for station, station_values in zip(station_id, values):
+            f.write("".join([station + stamp + value + "\n" for stamp, value in zip(stamps, station_values)]))
+
+
+def write_results_netcdf(data_dict, properties, swmm_unit_dict=None, mode="w"):
+    """
+    Write the EPA SWMM results (see read_rpt_file) to the nodes and links NetCDF files for FEWS.
+    With netcdf_stream_periods in the properties, the files are written with an unlimited time dimension, and the
+    results of the next reporting periods are appended to them with mode="a".
+    swmm_unit_dict is read from the UDUNITS lookup table if not given.
+    """
+    if swmm_unit_dict is None:
+        # Read EPA SWMM Units and attributes
+        print("   -->     Reading units...\n")
+        swmm_unit_dict = read_cached(read_units, properties["UDUNITS"])
+        main_logger.info("Reading units lookup table: {0}".format(properties["UDUNITS"]))
+
+    if mode == "a":
+        main_logger.debug("Appending {0} results to the nodes and links netCDF output files.".format(len(data_dict)))
+        combined_ds_nodes, combined_ds_links = create_xarray_dataset(data_dict, swmm_unit_dict)
+        append_netcdf(combined_ds_nodes, properties["out_nodes_netcdf"])
+        append_netcdf(combined_ds_links, properties["out_links_netcdf"])
+        return
+
+    print("\n   -->     Creating DataSet from the results DataFrame...\n")
+    main_logger.info("Creating DataSet from the results DataFrame.".format(properties["UDUNITS"]))
+    with stage_timer("create_dataset"):
+        combined_ds_nodes, combined_ds_links = create_xarray_dataset(data_dict, swmm_unit_dict)
+
+    unlimited_dims = None
+    for ds, fn, kind in ((combined_ds_nodes, properties["out_nodes_netcdf"], "nodes"),
+                         (combined_ds_links, properties["out_links_netcdf"], "links")):
+        encoding = netcdf_encoding(ds, properties)
+        if int(properties.get("netcdf_stream_periods", 0)) > 0:
+            # Fixed time units, so that the appended time steps are encoded the same way
+            unlimited_dims = ("time",)
+            encoding = dict(encoding or {}, time={"units": "minutes since 1970-01-01 00:00:00", "dtype": "float64"})
+        print("\n   -->     Writing {0} netCDF output file...\n".format(kind))
+        main_logger.info("Writing {0} netCDF output file: {1}".format(kind, fn))
+        with stage_timer("write_{0}_netcdf".format(kind)):
+            write_netcdf(ds, fn, encoding, unlimited_dims)
 
 
 def write_run_diagnostics(df_err_warn, run_diagnostics):
     """
-    Write the dataframe that contains both Python and EPASWMM errors to the run diagnostics file, in FEWS PI XML format.
+    Write the Python and EPASWMM errors, as a list of (level, description) (see read_diagnostics) or as a dataframe
+    (see read_errors_warnings), to the run diagnostics file, in FEWS PI XML format.
     """
+    if hasattr(df_err_warn, "columns"):  # DataFrame
+        df_err_warn = list(zip(df_err_warn["level"], df_err_warn["description"]))
     try:
         with open(run_diagnostics, 'w') as xf:
             # Write Header
@@ -661,10 +1924,8 @@ def write_run_diagnostics(df_err_warn, run_diagnostics):
 
             # Write Warnings Errors
             if len(df_err_warn) > 0:
-                for index, row in df_err_warn.iterrows():
-                    loc_text = str('            <line level="%s" description="%s"/>\n') % (
-                        row["level"], row["description"])
-                    xf.write(loc_text)
+                xf.write("".join(['            <line level="%s" description="%s"/>\n' % (level, description)
+                                  for level, description in df_err_warn]))
             else:
                 xf.write(
                     '            <line level="2" description="No errors, warnings or info messages were detected in the EPASWMM output or adapter log."/>\n')
@@ -673,16 +1934,37 @@ def write_run_diagnostics(df_err_warn, run_diagnostics):
     except IOError:
         print("Error writing the run diagnostics file: {0}".format(run_diagnostics))
         main_logger.error("Error writing the run diagnostics file.".format(run_diagnostics))
-        sys.exit(1)
+        raise AdapterError("Error writing the run diagnostics file: {0}".format(run_diagnostics))
         # not using stop_program(), since stop_program() uses write_run_diagnostics()
 
 
+def write_stage_metrics(properties):
+    """
+    Write the stages of the current command (see stage_timer) to a JSON file next to its log file (e.g.
+    log/post_adapter_metrics.json), if the stage_metrics property of the run_info.xml is true.
+    """
+    if str(properties.get("stage_metrics", False)).lower() != "true":
+        return
+    metrics_file = str(Path(log_file()).with_name(Path(log_file()).stem + "_metrics.json"))
+    metrics = {"log_file": log_file(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "stages": run_context.stages or []}
+    try:
+        with open(metrics_file, "w") as f:
+            json.dump(metrics, f, indent=2)
+        main_logger.info("Stage metrics written to: {0}".format(metrics_file))
+    except OSError:
+        main_logger.warning("Could not write the stage metrics file: {0}".format(metrics_file))
+
+
 def write_runfile(run_info, rating_curve, control_rule):
     """ 
     Use template file to create the input file required by EPA SWMM.
+    By default the input file is updated in place. If the swmm_template_file property is set, the input file is
+    rendered from that template instead, which is never modified: every run starts from the same model.
     """
     filein = run_info["properties"]["swmm_input_file"]
-    filetmp = os.getcwd() + "//model//temp.inp"
+    template = run_info["properties"].get("swmm_template_file", filein)
+    filetmp = str(filein) + ".tmp"
 
     dict_options = {
         "START_DATE": "START_DATE".ljust(21, " ") + run_info["start_time"].strftime("%m/%d/%Y"),
@@ -692,102 +1974,41 @@ def write_runfile(run_info, rating_curve, control_rule):
         "REPORT_START_DATE": "REPORT_START_DATE".ljust(21, " ") + run_info["start_time"].strftime("%m/%d/%Y"),
         'REPORT_START_TIME': "REPORT_START_TIME".ljust(21, " ") + run_info["start_time"].strftime("%H:%M:%S")
     }
-
-    replace_key = None
-    write_original = True
-    set_curves = set()
-    previous_section = None
-    current_section = None
-    control_rules_exist = False
-    section_switch = False
     main_logger.debug(rating_curve)
 
-    if not os.path.exists(filein):
-        main_logger.error("Expected file was not found: " + str(filein))
+    if not os.path.exists(template):
+        main_logger.error("Expected file was not found: " + str(template))
         stop_program()
-        raise IOError("Expected file was not found: " + str(filein))
+        raise IOError("Expected file was not found: " + str(template))
+
+    inp_cache = str(run_info["properties"].get("inp_cache", False)).lower() == "true"
+    if inp_cache:
+        # The cache is kept in the work dir, never next to the model
+        cache_dir = Path(run_info["workDir"]) / "inp_cache"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file = cache_dir / (Path(template).name + ".pkl")
+        sections = read_cached(read_inp_cached, template, cache_file)
+    else:
+        sections = read_inp(template)
+    sections = set_inp_options(sections, dict_options)
+    sections, set_curves = set_inp_curves(sections, rating_curve)
+    if len(control_rule) > 0 and "[CONTROLS]" not in [name for name, lines in sections]:
+        main_logger.error("No control rules in INP file, control rules were provided by FEWS. If control" \
+                          "rules are required, add a default control rule to the INP file.")
+        stop_program()
+    sections = add_inp_controls(sections, control_rule)
 
     try:
-        with open(filein) as f_in:
-            with open(filetmp, "w") as f_out:
-                for num, line in enumerate(f_in, 1):
-                    # Checking which section we are in:
-                    if re.match(r'\[', line) is not None:  # CHECK which section we are in
-                        previous_section = current_section
-                        current_section = line.strip()
-                        section_switch = True
-
-                        if line.strip() == "[CONTROLS]":
-                            control_rules_exist = True
-                    else:
-                        section_switch = False
-
-
-                    # Updating the "CONTROLS" section ***************************
-                    # Appending to the end of the section for clarity in the INP File
-                    if section_switch == True and previous_section == "[CONTROLS]":
-                        for key, value in control_rule.items():
-                            f_out.write(value)
-                        f_out.write(line)
-
-
-                    # Updating the "OPTIONS" section ***************************
-                    elif current_section == "[OPTIONS]":
-                        # Checking if one of the keys to replace is in the line
-                        for key in dict_options:
-                            if re.match(key + '\\b', line) is not None:
-                                replace_key = key
-                        # Replacing the line with the desired text
-                        if replace_key is not None:
-                            f_out.write(dict_options[replace_key] + "\n")
-                        else:
-                            f_out.write(line)
-                        replace_key = None
-
-                    # Updating the "RATING CURVE" section ***************************
-                    elif current_section == "[CURVES]":
-                        main_logger.debug(" --> " + str(num) + line)
-                        if not bool(rating_curve):
-                            main_logger.debug(rating_curve)
-                            main_logger.debug(
-                                "No rating curves found when updating the [CURVES] section. No updates will be made to this section.")
-                        elif bool(rating_curve):
-                            if len(line.split()) == 4 and line.split()[1] == 'Rating':
-                                curve_id = line.split()[0]
-                                set_curves.add(curve_id)
-                                # Check if a match exists in the XML file
-                                write_original = False  # first, assume the curve doesn't need to be replaced
-                                for key, value in rating_curve.items():
-                                    if curve_id != key:
-                                        main_logger.debug(
-                                            "The XML curve {0} does not match the current INP storage curve. Will continue checking other curves in the XML".format(
-                                                key, curve_id))
-                                        write_original = True
-                                    elif curve_id == key:
-                                        write_original = False
-                                        main_logger.info("Using the curve from the XML file for: " + key)
-                                        f_out.write(value)
-                                        break  # stop checking the XML
-                            elif line == '\n' or line.startswith(";"):
-                                write_original = True
-                        if write_original:
-                            main_logger.debug("Writing: " + line.strip())
-                            f_out.write(line)
-
-                    else:
-                        f_out.write(line)
-
-            if control_rules_exist is False and len(control_rule) > 0:
-                main_logger.error("No control rules in INP file, control rules were provided by FEWS. If control" \
-                                  "rules are required, add a default control rule to the INP file.")
-                stop_program()
-
+        write_inp(sections, filetmp)
     except IOError:
         print("Error writing the model run file: {0}".format(filetmp))
         main_logger.error("Error writing the model run file: {0}".format(filetmp))
 
     try:
-        move(filetmp, filein)
+        os.replace(filetmp, filein)  # the input file is never left half written
+        if inp_cache and template == filein:
+            # The next run starts from the file written now
+            save_inp_cache(sections, filein, cache_file)
     except OSError:
         main_logger.error("Error when updating the INP file; trying to overwrite {0} with {1}.".format(filein, filetmp))
 
@@ -801,82 +2022,132 @@ def write_runfile(run_info, rating_curve, control_rule):
 # MAIN METHODS
 #####################################################
 
-def pre_adapter():
+def pre_adapter(run_info_file):
     """
     Pre-Adapter method.
     """
-    print("\n\n\n##### Running Pre-Adapter EPA-SWMM Delft-FEWS for {0} ...\n".format(args.run_info))
-    main_logger.info("##### Running Pre-Adapter EPA-SWMM Delft-FEWS for {0} ...".format(args.run_info))
+    print("\n\n\n##### Running Pre-Adapter EPA-SWMM Delft-FEWS for {0} ...\n".format(run_info_file))
+    main_logger.info("##### Running Pre-Adapter EPA-SWMM Delft-FEWS for {0} ...".format(run_info_file))
+    run_context.stages = []
 
 
-    if run_info_file is None or not run_info_file.exists():
-        main_logger.error(f"'run_info.xml' not found in {os.getcwd()}")
-        raise AssertionError(f"'run_info.xml' not found in {os.getcwd()}")
+    if run_info_file is None or not Path(run_info_file).exists():
+        main_logger.error(f"'run_info.xml' not found: {run_info_file}")
+        raise AssertionError(f"'run_info.xml' not found: {run_info_file}")
     else:
-        run_info = read_run_info(run_info_file)
+        # Paths of the run_info.xml are relative to its folder
+        run_info = read_run_info(run_info_file, base_dir=Path(run_info_file).resolve().parents[0])
         properties = run_info["properties"]
 
     # Read Rating Curve
     if "dam_rating_curve" in run_info.keys():
-        rc_dict = read_rating_curve(run_info["dam_rating_curve"])
+        with stage_timer("read_rating_curve"):
+            rc_dict = read_rating_curve(run_info["dam_rating_curve"])
     else:
         rc_dict = dict()
 
     # Read Control Rules
     if "control_rule" in run_info.keys():
-        rule_dict = read_control_rules(run_info["control_rule"])
+        with stage_timer("read_control_rules"):
+            compact = str(properties.get("control_rules_compact", False)).lower() == "true"
+            rule_dict = read_control_rules(run_info["control_rule"], compact)
     else:
         rule_dict = dict()
 
     # Writing EPA SWMM input file
-    write_runfile(run_info, rc_dict, rule_dict)
+    with stage_timer("write_runfile"):
+        write_runfile(run_info, rc_dict, rule_dict)
     print("\nRun Info content: \n", run_info)
 
     # Writing rainfall file from netCDF format received from FEWS.
-    rainfall_dat = os.getcwd() + "//model//rain.dat"
-    write_rainfall(run_info["netcdf"], rainfall_dat)
+    rainfall_dat = str(Path(run_info_file).resolve().parents[0]) + "//model//rain.dat"
+    with stage_timer("write_rainfall"):
+        write_rainfall(run_info["netcdf"], rainfall_dat)
     print("\nDone writing {0} file.\n".format(rainfall_dat))
+    write_stage_metrics(properties)
 
     try:
         print("\n   -->     Reading warnings and errors...")
-        main_logger.info("Reading warnings and errors from: {0}".format(logger_filename))
-        main_logger.info("##### Completed Pre-Adapter EPA-SWMM Delft-FEWS".format(logger_filename))
+        main_logger.info("Reading warnings and errors from: {0}".format(log_file()))
+        main_logger.info("##### Completed Pre-Adapter EPA-SWMM Delft-FEWS".format(log_file()))
         print("\n   -->     Writing Diagnostic file...\n")
-        df_err_warn = read_errors_warnings([logger_filename])
-        write_run_diagnostics(df_err_warn, run_info["diagnostic_xml"])
+        write_run_diagnostics(read_diagnostics([log_file()]), run_info["diagnostic_xml"])
 
     except Exception:
         main_logger.error(
-            "Errors occurred while checking the log file for warnings and errors. Check {0}.".format(logger_filename))
+            "Errors occurred while checking the log file for warnings and errors. Check {0}.".format(log_file()))
         raise ValueError(
-            "Errors occurred while checking the log file for warnings and errors. Check {0}.".format(logger_filename))
+            "Errors occurred while checking the log file for warnings and errors. Check {0}.".format(log_file()))
 
 
-def run_model():
+def run_model(run_info_file):
     """
     Running model...
     This method is intended for testing the adapter.
     The normal workflow will be that FEWS initiates the model adapter.
     """
-    print("\n\n\n##### Running EPA-SWMM model for {0} ...\n".format(args.run_info))
-    main_logger.info("##### Running EPA-SWMM model for {0} ...".format(args.run_info))
+    print("\n\n\n##### Running EPA-SWMM model for {0} ...\n".format(run_info_file))
+    main_logger.info("##### Running EPA-SWMM model for {0} ...".format(run_info_file))
+    run_context.stages = []
 
-    if run_info_file is None or not run_info_file.exists():
-        main_logger.error(f"'run_info.xml' not found in {os.getcwd()}")
-        raise AssertionError(f"'run_info.xml' not found in {os.getcwd()}")
+    if run_info_file is None or not Path(run_info_file).exists():
+        main_logger.error(f"'run_info.xml' not found: {run_info_file}")
+        raise AssertionError(f"'run_info.xml' not found: {run_info_file}")
     else:
-        run_info = read_run_info(run_info_file)
+        # Paths of the run_info.xml are relative to its folder
+        run_info = read_run_info(run_info_file, base_dir=Path(run_info_file).resolve().parents[0])
         properties = run_info["properties"]
 
-    model_bin = run_info["properties"]["model-executable"]
-    main_logger.info("Model executable being used to run SWMM model: {0}".format(str(model_bin)))
-    os.chdir(str(run_info["workDir"]))  # current directory must be the model folder in order for the SWM .inp's reference to the rain.dat to work. WorkDir in Run Info refers to the "model" folder
-    with open('Run_model.bat', "w") as bf:
-        bf.write(str(model_bin) + " " + str(run_info["properties"]["swmm_input_file"]) + " " + str(
-            run_info["properties"]["swmm_output_file"]))
-    output = subprocess.run([str(model_bin), str(run_info["properties"]["swmm_input_file"]),
-                             str(run_info["properties"]["swmm_output_file"])], check=True)
-    os.chdir(run_info["workDir"]) # change back to working directory
+    # The model runs in the workDir, for the reference of the SWMM .inp to the rain.dat to work.
+    # The shared library runs in this process instead, whose working directory is not changed: see below.
+    if properties["engine"] == "library":
+        # In-process run: the results are collected while stepping and written for FEWS here, the post-adapter
+        # only checks the status report for warnings and errors.
+        main_logger.info("EPA SWMM shared library being used to run SWMM model: {0}".format(
+            str(properties["swmm_library"])))
+        locations, variables = read_output_filter(properties)
+        out_file = properties["swmm_binary_output_file"] if properties["swmm_results_format"] == "binary" else ""
+        swmm = load_swmm_library(properties["swmm_library"])
+        # The shared library opens the files named in the .inp (e.g. the rain.dat of the rain gages) from the working
+        # directory of the process, shared by all its threads: it runs a copy of the .inp with these names made
+        # absolute from the workDir (e.g. model/DonRiver_library.inp), and absolute paths of the .inp, .rpt and .out.
+        inp_file = Path(properties["swmm_input_file"]).resolve()
+        library_inp = inp_file.with_name(inp_file.stem + "_library.inp")
+        write_inp(set_inp_file_paths(read_inp(inp_file), Path(run_info["workDir"]).resolve()), library_inp)
+        rpt_file = Path(properties["swmm_output_file"]).resolve()
+        out_file = Path(out_file).resolve() if out_file else ""
+        # The shared library runs one model at a time
+        with swmm_library_lock:
+            if int(properties.get("netcdf_stream_periods", 0)) > 0:
+                # The results are appended to the NetCDF files every netcdf_stream_periods reporting periods,
+                # while the model is running.
+                swmm_unit_dict = read_cached(read_units, properties["UDUNITS"])
+                written = []
+
+                def write_periods(data_dict):
+                    write_results_netcdf(data_dict, properties, swmm_unit_dict, mode="a" if written else "w")
+                    written.append(len(data_dict))
+
+                with stage_timer("swmm"):
+                    run_swmm_library(swmm, library_inp, rpt_file, out_file, locations, variables,
+                                     on_periods=write_periods, n_periods=int(properties["netcdf_stream_periods"]))
+            else:
+                with stage_timer("swmm"):
+                    data_dict = run_swmm_library(swmm, library_inp, rpt_file, out_file, locations, variables)
+                write_results_netcdf(data_dict, properties)
+        output = None
+    else:
+        model_bin = run_info["properties"]["model-executable"]
+        main_logger.info("Model executable being used to run SWMM model: {0}".format(str(model_bin)))
+        model_args = [str(model_bin), str(run_info["properties"]["swmm_input_file"]),
+                      str(run_info["properties"]["swmm_output_file"])]
+        if properties["swmm_results_format"] == "binary":
+            model_args.append(str(properties["swmm_binary_output_file"]))
+        with open(os.path.join(str(run_info["workDir"]), 'Run_model.bat'), "w") as bf:
+            bf.write(" ".join(model_args))
+        with stage_timer("swmm"):
+            output = subprocess.run(model_args, check=True, cwd=str(run_info["workDir"]))
+    write_stage_metrics(properties)
 
 
     try:
@@ -884,107 +2155,339 @@ def run_model():
         main_logger.info("Reading warnings and errors from: {0}".format(properties["swmm_output_file"]))
 
         print("\n   -->     Writing Diagnostic file...\n")
-        df_err_warn = read_errors_warnings([logger_filename])
-        write_run_diagnostics(df_err_warn, run_info["diagnostic_xml"])
+        write_run_diagnostics(read_diagnostics([log_file()]), run_info["diagnostic_xml"])
     except Exception:
         main_logger.error(
             "Errors occurred while checking the SWMM model output for warnings and errors. Check {0}.".format(
-                logger_filename))
+                log_file()))
         raise ValueError(
             "Errors occurred while checking the SWMM model output for warnings and errors. Check {0}.".format(
-                logger_filename))
+                log_file()))
     return output
 
 
-def post_adapter():
+def post_adapter(run_info_file):
     """
     Post-Adapter Method.
     """
-    if __name__ == "__main__":
-        print("\n\n\n##### Running Post-Adapter EPA-SWMM Delft-FEWS for {0} ...\n".format(args.run_info))
-        main_logger.info("##### Running Post-Adapter EPA-SWMM Delft-FEWS for {0}".format(args.run_info))
+    print("\n\n\n##### Running Post-Adapter EPA-SWMM Delft-FEWS for {0} ...\n".format(run_info_file))
+    main_logger.info("##### Running Post-Adapter EPA-SWMM Delft-FEWS for {0}".format(run_info_file))
+    run_context.stages = []
+
+    if run_info_file is None or not Path(run_info_file).exists():
+        main_logger.error(f"'run_info.xml' not found: {run_info_file}")
+        raise AssertionError(f"'run_info.xml' not found: {run_info_file}")
+    else:
+        # Paths of the run_info.xml are relative to its folder
+        run_info = read_run_info(run_info_file, base_dir=Path(run_info_file).resolve().parents[0])
+        properties = run_info["properties"]
+
+        print("\n   -->     Checking SWMM for warnings and errors...")
+        main_logger.info("Checking SWMM for warnings and errors: {0}".format(properties["swmm_output_file"]))
 
-        if run_info_file is None or not run_info_file.exists():
-            main_logger.error(f"'run_info.xml' not found in {os.getcwd()}")
-            raise AssertionError(f"'run_info.xml' not found in {os.getcwd()}")
+    # If the output file doesn't exist, read the adapter log and make run_diagnostics
+    if not os.path.exists(properties["swmm_output_file"]):
+        main_logger.error("Was not able to find {0}".format(properties["swmm_output_file"]))
+        stop_program()
+    else:  # if output file exists, try reading errors and warning
+        try:
+            with stage_timer("read_swmm_messages"):
+                swmm_diagnostics = read_diagnostics([properties["swmm_output_file"]])
+        except Exception:
+            main_logger.error(
+                "Errors occurred while checking the SWMM model output for warnings and errors. Check {0}.".format(
+                    properties["swmm_output_file"]))
+            raise IOError(
+                "Errors occurred while checking the SWMM model output for warnings and errors. Check {0}.".format(
+                    properties["swmm_output_file"]))
+
+        # IF NO ERRORS:
+
+    swmm_errors = [description for level, description in swmm_diagnostics if level == 1]
+    if len(swmm_errors) == 0 and properties["engine"] == "library":
+        # The results were written for FEWS by the run command, while the model was stepping.
+        print("\n   -->     No SWMM Errors Found, results already written by the run command.\n")
+        main_logger.info("No SWMM errors found, results already written by the run command: {0}, {1}".format(
+            properties["out_nodes_netcdf"], properties["out_links_netcdf"]))
+
+    elif len(swmm_errors) == 0:  # level 1 corresponds to error
+        print("\n   -->     No SWMM Errors Found, proceeding...\n")
+        main_logger.info("No SWMM errors found, proceeding with parsing the RPT file: {0}".format(
+            properties["swmm_output_file"]))
+
+        # Read EPA SWMM results from *.rpt output file, or from the *.out binary output file.
+        # Only nodes and links are written to FEWS: the other blocks are skipped while reading.
+        print("   -->     Reading results into a DataFrame...\n")
+        locations, variables = read_output_filter(properties)
+        if properties["swmm_results_format"] == "binary":
+            with stage_timer("read_results"):
+                data_dict = read_out_file(properties["swmm_binary_output_file"], locations, variables,
+                                          object_types=("Node", "Link"))
+            main_logger.info("Reading results into a DataFrame: {0}".format(
+                properties["swmm_binary_output_file"]))
+        elif locations is not None and int(properties["rpt_workers"]) == 1:
+            # Only the blocks of the filtered locations are decoded, found through an index of the *.rpt file
+            # (saved next to it, e.g. DonRiver.rpt.idx) instead of scanning every line.
+            with stage_timer("read_results"):
+                data_dict = read_rpt_locations(properties["swmm_output_file"], locations,
+                                               str(properties["swmm_output_file"]) + ".idx", variables,
+                                               object_types=("Node", "Link"))
+            main_logger.info("Reading results into a DataFrame: {0}".format(properties["swmm_output_file"]))
         else:
-            run_info = read_run_info(run_info_file)
-            properties = run_info["properties"]
+            with stage_timer("read_results"):
+                data_dict = read_rpt_file(properties["swmm_output_file"], locations, variables,
+                                          object_types=("Node", "Link"), workers=int(properties["rpt_workers"]))
+            main_logger.info("Reading results into a DataFrame: {0}".format(properties["swmm_output_file"]))
+        write_results_netcdf(data_dict, properties)
 
-            print("\n   -->     Checking SWMM for warnings and errors...")
-            main_logger.info("Checking SWMM for warnings and errors: {0}".format(properties["swmm_output_file"]))
+        print("\n####### Post-Adapter process completed successfully!")
+        main_logger.info("###### Post-Adapter process completed successfully!")
 
-        # If the output file doesn't exist, read the adapter log and make run_diagnostics
-        if not os.path.exists(properties["swmm_output_file"]):
-            main_logger.error("Was not able to find {0}".format(properties["swmm_output_file"]))
+    else:
+        main_logger.error(
+            "Errors were detected in the model simulation.  See run_diagnostic.xml file for more details.")
+        raise Warning(
+            "Errors were detected in the model simulation.  See run_diagnostic.xml file for more details.")
+
+    write_stage_metrics(properties)
+    try:
+        print("\n   -->     Reading Python Log...")
+        main_logger.info("Reading adapter log, writing adapter log and SWMM errors/warnings in FEWS format.")
+        python_diagnostics = read_diagnostics(
+            [log_file()])  # even though SWMM log was read earlier, easier to just re-read it here.
+        print("\n   -->     Writing Diagnostic file...\n")
+        write_run_diagnostics(python_diagnostics + swmm_diagnostics, run_info["diagnostic_xml"])
+
+    except Exception:
+        main_logger.error(
+            "Errors occurred while checking the SWMM model output for warnings and errors. Check {0} and {1}.".format(
+                properties["swmm_output_file"],
+                log_file()))
+        raise ValueError(
+            "Errors occurred while checking the SWMM model output for warnings and errors. Check {0} and {1}.".format(
+                properties["swmm_output_file"],
+                log_file()))
+
+
+def ensemble_adapter(run_info_file, members=()):
+    """
+    Ensemble method: pre-adapter, model run and post-adapter of every member of an ensemble, ensemble_workers
+    members at a time, and the results of all the members combined in the nodes and links NetCDF files of the
+    run_info.xml, with a realization dimension.
+    The members are the run_info.xml files in members (with the same folder layout as the run_info.xml),
+    or else the realizations of the rainfall NetCDF file of the run_info.xml (see split_ensemble_rainfall).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    print("\n\n\n##### Running Ensemble EPA-SWMM Delft-FEWS for {0} ...\n".format(run_info_file))
+    main_logger.info("##### Running Ensemble EPA-SWMM Delft-FEWS for {0} ...".format(run_info_file))
+
+    if run_info_file is None or not Path(run_info_file).exists():
+        main_logger.error(f"'run_info.xml' not found: {run_info_file}")
+        raise AssertionError(f"'run_info.xml' not found: {run_info_file}")
+    else:
+        # Paths of the run_info.xml are relative to its folder
+        run_info = read_run_info(run_info_file, base_dir=Path(run_info_file).resolve().parents[0])
+        properties = run_info["properties"]
+
+    if members:
+        member_files = [Path(f).resolve() for f in members]
+        realizations = list(range(len(member_files)))
+        if len(set(f.parents[0] for f in member_files)) != len(member_files):
+            main_logger.error("The ensemble members must each have their own folder, to run side by side.")
             stop_program()
-        else:  # if output file exists, try reading errors and warning
-            try:
-                df_swmm_err = read_errors_warnings([properties["swmm_output_file"]])
-            except Exception:
-                main_logger.error(
-                    "Errors occurred while checking the SWMM model output for warnings and errors. Check {0}.".format(
-                        properties["swmm_output_file"]))
-                raise IOError(
-                    "Errors occurred while checking the SWMM model output for warnings and errors. Check {0}.".format(
-                        properties["swmm_output_file"]))
-
-            # IF NO ERRORS:
-
-        if len(df_swmm_err[df_swmm_err['level'] == 1]) == 0:  # level 1 corresponds to error
-            # Read EPA SWMM Units and attributes
-            print("\n   -->     No SWMM Errors Found, proceeding...\n")
-            main_logger.info("No SWMM errors found, proceeding with parsing the RPT file: {0}".format(
-                properties["swmm_output_file"]))
-
-            print("   -->     Reading units...\n")
-            swmm_unit_dict = read_units(properties["UDUNITS"])
-            main_logger.info("Reading units lookup table: {0}".format(properties["UDUNITS"]))
-
-            # Read EPA SWMM results from *.rpt output file.
-            print("   -->     Reading results into a DataFrame...\n")
-            data_dict = read_rpt_file(properties["swmm_output_file"])
-            main_logger.info("Reading results into a DataFrame: {0}".format(properties["swmm_output_file"]))
+    else:
+        member_files, realizations = split_ensemble_rainfall(run_info_file, run_info["netcdf"])
+
+    workers = int(properties.get("ensemble_workers", os.cpu_count()))
+    print("\n   -->     Running {0} members, {1} at a time...\n".format(len(member_files), workers))
+    main_logger.info("Running {0} ensemble members, {1} at a time.".format(len(member_files), workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failed = list(pool.map(run_ensemble_member, repeat(adapter_command()), member_files))
+    for member_file, step in zip(member_files, failed):
+        if step is not None:
+            main_logger.error("Ensemble member {0} failed in the {1} command; see its log folder.".format(
+                member_file, step))
+    if any(step is not None for step in failed):
+        stop_program()
 
-            print("\n   -->     Creating DataSet from the results DataFrame...\n")
-            main_logger.info("Creating DataSet from the results DataFrame.".format(properties["UDUNITS"]))
-            combined_ds_nodes, combined_ds_links = create_xarray_dataset(data_dict, swmm_unit_dict)
+    for key in ("out_nodes_netcdf", "out_links_netcdf"):
+        # The outputs of the members have the same path as the output of the run_info.xml, in their own folder
+        output = os.path.relpath(os.path.abspath(str(properties[key])), str(Path(run_info_file).resolve().parents[0]))
+        print("\n   -->     Writing ensemble netCDF output file {0}...\n".format(properties[key]))
+        main_logger.info("Writing ensemble netCDF output file: {0}".format(properties[key]))
+        combine_ensemble([Path(f).parents[0] / output for f in member_files], realizations, properties[key])
 
-            print("\n   -->     Writing nodes netCDF output file...\n")
-            main_logger.info("Writing nodes netCDF output file: {0}".format(properties["out_nodes_netcdf"]))
-            write_netcdf(combined_ds_nodes, properties["out_nodes_netcdf"])
+    print("\n####### Ensemble process completed successfully!")
+    main_logger.info("###### Ensemble process completed successfully!")
+    write_run_diagnostics(read_diagnostics([log_file()]), run_info["diagnostic_xml"])
 
-            print("\n   -->     Writing links netCDF output file...\n")
-            main_logger.info("Writing links netCDF output file: {0}".format(properties["out_links_netcdf"]))
-            write_netcdf(combined_ds_links, properties["out_links_netcdf"])
 
-            print("\n####### Post-Adapter process completed successfully!")
-            main_logger.info("###### Post-Adapter process completed successfully!")
+class Adapter:
+    """
+    Adapter for one run_info.xml, for use as a library: pre(), run() and post() are the pre, run and post commands,
+    with their log files in the log folder of the run_info.xml.
+    Several adapters can run in one Python process, e.g. one per thread: each command has its own logger and run
+    context (see RunContext), the paths are resolved from the folder of the run_info.xml without changing the working
+    directory, and errors raise AdapterError instead of exiting.
+    With profile=True, the stages of the commands are profiled with cProfile (see stage_timer).
+    """
 
-        else:
-            main_logger.error(
-                "Errors were detected in the model simulation.  See run_diagnostic.xml file for more details.")
-            raise Warning(
-                "Errors were detected in the model simulation.  See run_diagnostic.xml file for more details.")
+    def __init__(self, run_info_file, profile=False):
+        self.run_info_file = Path(run_info_file).resolve()
+        self.profile = profile
 
+    def pre(self):
+        self.call(pre_adapter, "pre_adapter.log")
+
+    def run(self):
+        return self.call(run_model, "run_adapter.log")
+
+    def post(self):
+        self.call(post_adapter, "post_adapter.log")
+
+    def call(self, command, log_name):
+        """
+        Run a command in the current thread with its own run context, and its own logger writing to its own log file
+        (as setup_logger does for the command line adapter). The logger is not registered with the logging module,
+        so its messages do not reach the other loggers.
+        """
+        logger_filename = str(self.run_info_file.parents[0]) + "//log//" + log_name
         try:
-            print("\n   -->     Reading Python Log...")
-            main_logger.info("Reading adapter log, writing adapter log and SWMM errors/warnings in FEWS format.")
-            df_python_err_warn = read_errors_warnings(
-                [logger_filename])  # even though SWMM log was read earlier, easier to just re-read it here.
-            print("\n   -->     Writing Diagnostic file...\n")
-            write_run_diagnostics(pd.concat([df_python_err_warn, df_swmm_err]), run_info["diagnostic_xml"])
+            os.remove(logger_filename)
+        except OSError:
+            pass
+        handler = logging.FileHandler(logger_filename)
+        handler.setFormatter(logging.Formatter('%(levelname)s: External Adapter - %(message)s (%(asctime)s)'))
+        logger = logging.Logger("EPASWMM FEWS Python Logger", logging.INFO)
+        logger.addHandler(handler)
+        run_context.logger = logger
+        run_context.logger_filename = logger_filename
+        run_context.profile = self.profile
+        try:
+            return command(self.run_info_file)
+        finally:
+            handler.close()
+            run_context.__dict__.clear()  # back to the defaults of RunContext
 
-        except Exception:
-            main_logger.error(
-                "Errors occurred while checking the SWMM model output for warnings and errors. Check {0} and {1}.".format(
-                    properties["swmm_output_file"],
-                    logger_filename))
-            raise ValueError(
-                "Errors occurred while checking the SWMM model output for warnings and errors. Check {0} and {1}.".format(
-                    properties["swmm_output_file"],
-                    logger_filename))
 
+class AdapterRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Command sent by a client to a resident adapter (see serve_adapter and forward_command): one JSON line
+    {"command": "pre", "run" or "post", "run_info": path of the run_info.xml, "profile": true to profile the stages of
+    the command}, answered at the end of the command
+    with one JSON line {"exit_code": 0 or 1, "message": error message}. The "stop" command stops the adapter.
+    """
+    commands = {"pre": Adapter.pre, "run": Adapter.run, "post": Adapter.post}
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            command, run_info_file = request["command"], request.get("run_info")
+        except (ValueError, KeyError, TypeError):
+            self.reply(1, "Invalid request: expected a JSON line with a command and a run_info.")
+            return
+        if command == "stop":
+            main_logger.info("Stopping the resident adapter.")
+            self.reply(0, "")
+            # shutdown waits for serve_forever to return, so it cannot be called from this request
+            threading.Thread(target=self.server.shutdown).start()
+        elif command not in self.commands or run_info_file is None:
+            self.reply(1, "Invalid request: unknown command {0} or missing run_info.".format(command))
+        else:
+            main_logger.info("Running the {0} command for: {1}".format(command, run_info_file))
+            try:
+                self.commands[command](Adapter(run_info_file, profile=bool(request.get("profile", False))))
+                self.reply(0, "")
+            except AdapterError as e:
+                self.reply(1, str(e))
+            except Exception as e:
+                # e.g. an unexpected error of a command: the adapter must keep serving the other runs
+                main_logger.exception("Unexpected error of the {0} command for: {1}".format(command, run_info_file))
+                self.reply(1, "Unexpected error of the {0} command: {1}".format(command, e))
+
+    def reply(self, exit_code, message):
+        self.wfile.write((json.dumps({"exit_code": exit_code, "message": message}) + "\n").encode("utf-8"))
+
+
+def forward_command(address, command, run_info_file, profile=False):
+    """
+    Client of a resident adapter: send a command ("pre", "run", "post" or "stop") for run_info_file to the adapter
+    listening at address (see serve_adapter), and wait for its end. With profile=True, the stages of the command are
+    profiled (see stage_timer).
+    Returns the exit code and the error message of the command, or None if no adapter is listening at address.
+    """
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        return None
+    with sock, sock.makefile("rwb") as f:
+        request = {"command": command, "run_info": str(run_info_file), "profile": profile}
+        f.write((json.dumps(request) + "\n").encode("utf-8"))
+        f.flush()
+        reply = f.readline()
+    if not reply:
+        return 1, "The resident adapter closed the connection before the end of the {0} command.".format(command)
+    reply = json.loads(reply.decode("utf-8"))
+    return reply["exit_code"], reply["message"]
+
+
+def parse_address(address):
+    """
+    Socket family and address of a resident adapter (see serve_adapter): "host:port" (or ":port" for localhost) for a
+    TCP socket, or else the path of a Unix domain socket.
+    """
+    host, sep, port = str(address).rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Unix domain sockets are not available, use host:port: {0}".format(address))
+    return socket.AF_UNIX, str(address)
+
+
+def serve_adapter(address):
+    """
+    Resident adapter: run the pre, run and post commands sent by the clients (see forward_command) in this process,
+    one thread per client, until a "stop" command. The heavy modules are imported once, and the units table and the
+    model template are read once while they are unchanged (see read_cached), instead of once per command.
+    There is no authentication, and a command runs the model executable of its run_info.xml: address must be a
+    loopback port (e.g. 127.0.0.1:8765) or a Unix domain socket, otherwise AdapterError is raised.
+    """
+    family, address = parse_address(address)
+    if family == socket.AF_INET:
+        try:
+            loopback = ipaddress.ip_address(socket.gethostbyname(address[0])).is_loopback
+        except (OSError, ValueError):
+            loopback = False
+        if not loopback:
+            main_logger.error("The resident adapter only listens on a loopback address, not on: {0}".format(
+                address[0]))
+            raise AdapterError("The resident adapter only listens on a loopback address, not on: {0}".format(
+                address[0]))
+
+    import netCDF4  # noqa: F401 imported now rather than by the first command
+    import xarray  # noqa: F401
+
+    if family == socket.AF_INET:
+        server = socketserver.ThreadingTCPServer(address, AdapterRequestHandler, bind_and_activate=False)
+        server.allow_reuse_address = True  # e.g. restarted right after a stop
+    else:
+        if os.path.exists(address):
+            os.remove(address)  # left by an adapter that did not stop
+        server = socketserver.ThreadingUnixStreamServer(address, AdapterRequestHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    try:
+        with server:
+            server.server_bind()
+            server.server_activate()
+            print("Resident adapter listening on: {0}".format(server.server_address))
+            main_logger.info("Resident adapter listening on: {0}".format(server.server_address))
+            server.serve_forever()
+    finally:
+        if family != socket.AF_INET and os.path.exists(address):
+            os.remove(address)
 
 
 ###############################################################
@@ -1009,11 +2512,19 @@ def setup_logger(name, log_file, logging_level=logging.INFO):
     return logger
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # worker processes of the parallel *.rpt reader in the PyInstaller executable
     parser = ap.ArgumentParser(description="TRCA-FEWS adapter for EPASWMM models")
     parser.set_defaults(func=parser.print_usage)
 
     parser.add_argument('--run_info', dest='run_info', required=True,
                         help='Full path to the run_info.xml file.')
+    parser.add_argument('--server', dest='server',
+                        help='Address of a resident adapter (see the serve command): host:port, or the path of a '
+                             'Unix domain socket. The pre, run and post commands are sent to it, or run by this '
+                             'process if it is not running.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile each stage of the pre, run and post commands with cProfile, to a pstats '
+                             'file in the log folder (e.g. log/post_adapter_read_results.prof).')
 
     subparsers = parser.add_subparsers(
         title="subcommands", description="valid subcommands", help="additional help"
@@ -1034,12 +2545,36 @@ if __name__ == "__main__":
     parser_post = subparsers.add_parser("post", help=help_pos)
     parser_post.set_defaults(func=post_adapter)
 
+    # create the parser for the "ensemble" command
+    help_ensemble = "Run pre, run and post for every member of an ensemble, in parallel"
+    parser_ensemble = subparsers.add_parser("ensemble", help=help_ensemble)
+    parser_ensemble.add_argument('--members', nargs='*', default=[],
+                                 help='run_info.xml files of the members; by default, the realizations of the '
+                                      'rainfall NetCDF file are run.')
+    parser_ensemble.set_defaults(func=ensemble_adapter)
+
+    # create the parser for the "serve" command
+    help_serve = "Run a resident adapter, running the commands sent to the --server address"
+    parser_serve = subparsers.add_parser("serve", help=help_serve)
+    parser_serve.set_defaults(func=serve_adapter)
+
     args = parser.parse_args()
-    run_info_file = Path(args.run_info)
-    os.chdir(Path(run_info_file).parents[0])  # os.getcwd()+"//"+args.model)
+    # The paths of the run_info.xml are relative to its folder (see read_run_info)
+    run_info_file = Path(args.run_info).resolve()
+
+    commands = {pre_adapter: "pre", run_model: "run", post_adapter: "post"}
+    if args.func is serve_adapter and args.server is None:
+        parser.error("the serve command requires a --server address")
+    if args.func in commands and args.server is not None:
+        # Thin client: the command is run by the resident adapter, which writes the log files
+        result = forward_command(args.server, commands[args.func], run_info_file, args.profile)
+        if result is not None:
+            if result[0] != 0:
+                print(result[1])
+            sys.exit(result[0])
 
     # DEFINE the logger file name; different logger for each adapter.
-    logger_filename = os.getcwd() + "//model_adapter.log"
+    logger_filename = str(Path(run_info_file).parents[0]) + "//model_adapter.log"
     if args.func.__name__ == "pre_adapter":
         logger_filename = str(Path(run_info_file).parents[0]) + "//log//pre_adapter.log"
 
@@ -1049,12 +2584,32 @@ if __name__ == "__main__":
     elif args.func.__name__ == "post_adapter":
         logger_filename = str(Path(run_info_file).parents[0]) + "//log//post_adapter.log"
 
-    main_logger = setup_logger('EPASWMM FEWS Python Logger', logger_filename, logging.INFO)
-    args.func()
-
-else:
-    logger_filename = os.getcwd() + "//model_adapter.log"  # when running from Python, do not save to Log folder
-    print(logger_filename)
-    main_logger = setup_logger('EPASWMM FEWS Python Logger', logger_filename, logging.DEBUG)
+    elif args.func.__name__ == "ensemble_adapter":
+        logger_filename = str(Path(run_info_file).parents[0]) + "//log//ensemble_adapter.log"
+
+    elif args.func.__name__ == "serve_adapter":
+        logger_filename = str(Path(run_info_file).parents[0]) + "//log//serve_adapter.log"
+
+    setup_logger('EPASWMM FEWS Python Logger', logger_filename, logging.INFO)
+    RunContext.logger_filename = logger_filename
+    if args.func is ensemble_adapter:
+        args.func(run_info_file, args.members)
+    elif args.func is serve_adapter:
+        args.func(args.server)
+    elif args.func in commands:
+        run_context.profile = args.profile
+        if args.server is not None:
+            main_logger.warning("No resident adapter at {0}; running the command in this process.".format(args.server))
+        args.func(run_info_file)
+    else:
+        args.func()
+
+elif multiprocessing.parent_process() is None:
+    # Worker processes of the parallel *.rpt reader keep the default logger without a log file: errors are reported
+    # by the parent process, whose log must not be replaced.
+    # when running from Python, do not save to Log folder
+    RunContext.logger_filename = os.getcwd() + "//model_adapter.log"
+    print(RunContext.logger_filename)
+    setup_logger('EPASWMM FEWS Python Logger', RunContext.logger_filename, logging.DEBUG)
     main_logger.info(
-        "Log written to root directory. When run from the command line, log will be written to the 'log' folder.")
\ No newline at end of file
+        "Log written to root directory. When run from the command line, log will be written to the 'log' folder.")
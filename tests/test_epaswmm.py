@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 import pytest
 import os
+import numpy as np
 import pandas as pd
 import datetime
 import xml.etree.ElementTree as ET
 import filecmp
+import json
+import pstats
 import shutil
+import socket
+import sys
+import threading
+import time
 from frozendict import frozendict
 from pathlib import Path
 import xarray as xr
@@ -18,11 +25,27 @@ from epaswmmadaptor.epaswmm import time_element
 from epaswmmadaptor.epaswmm import read_netcdf
 from epaswmmadaptor.epaswmm import bytes_to_string
 from epaswmmadaptor.epaswmm import write_runfile
+from epaswmmadaptor.epaswmm import read_inp
+from epaswmmadaptor.epaswmm import read_inp_cached
+from epaswmmadaptor.epaswmm import save_inp_cache
+from epaswmmadaptor.epaswmm import write_inp
+from epaswmmadaptor.epaswmm import set_inp_options
+from epaswmmadaptor.epaswmm import set_inp_curves
+from epaswmmadaptor.epaswmm import set_inp_file_paths
+from epaswmmadaptor.epaswmm import add_inp_controls
 from epaswmmadaptor.epaswmm import make_df
+from epaswmmadaptor.epaswmm import decode_block
 from epaswmmadaptor.epaswmm import write_rainfall
 from epaswmmadaptor.epaswmm import read_units
 from epaswmmadaptor.epaswmm import read_rpt_file
+from epaswmmadaptor.epaswmm import read_out_file
+from epaswmmadaptor.epaswmm import run_swmm_library
+from epaswmmadaptor.epaswmm import iter_rpt_blocks
+from epaswmmadaptor.epaswmm import index_rpt_file
+from epaswmmadaptor.epaswmm import read_rpt_locations
+from epaswmmadaptor.epaswmm import read_output_filter
 from epaswmmadaptor.epaswmm import read_errors_warnings
+from epaswmmadaptor.epaswmm import read_diagnostics
 from epaswmmadaptor.epaswmm import write_run_diagnostics
 from epaswmmadaptor.epaswmm import read_rating_curve
 from epaswmmadaptor.epaswmm import read_control_rules
@@ -30,6 +53,18 @@ from epaswmmadaptor.epaswmm import dir_element
 from epaswmmadaptor.epaswmm import create_xarray_dataset
 from epaswmmadaptor.epaswmm import setup_logger
 from epaswmmadaptor.epaswmm import write_netcdf
+from epaswmmadaptor.epaswmm import netcdf_encoding
+from epaswmmadaptor.epaswmm import write_results_netcdf
+from epaswmmadaptor.epaswmm import split_ensemble_rainfall
+from epaswmmadaptor.epaswmm import combine_ensemble
+from epaswmmadaptor.epaswmm import run_ensemble_member
+from epaswmmadaptor.epaswmm import Adapter
+from epaswmmadaptor.epaswmm import AdapterError
+from epaswmmadaptor.epaswmm import forward_command
+from epaswmmadaptor.epaswmm import serve_adapter
+from epaswmmadaptor.epaswmm import run_context
+from epaswmmadaptor.epaswmm import stage_timer
+from epaswmmadaptor.epaswmm import write_stage_metrics
 
 os.chdir(os.getcwd() + "//tests//module_adapter//Don")
 print(os.getcwd())
@@ -98,28 +133,28 @@ def test_read_run_info():
     assert run_info["time_zone"] == -5
     assert type(run_info["time_zone"]) == float  # using float and not int because of potential for half timezones
 
-    assert type(run_info["start_time"]) == pd.Timestamp
+    assert type(run_info["start_time"]) == datetime.datetime
     assert run_info["start_time"].year == 2020
     assert run_info["start_time"].month == 3
     assert run_info["start_time"].day == 18
     assert run_info["start_time"].hour == 20
     assert run_info["start_time"].minute == 00
 
-    assert type(run_info["end_time"]) == pd.Timestamp
+    assert type(run_info["end_time"]) == datetime.datetime
     assert run_info["end_time"].year == 2020
     assert run_info["end_time"].month == 3
     assert run_info["end_time"].day == 19
     assert run_info["end_time"].hour == 20
     assert run_info["end_time"].minute == 00
 
-    assert type(run_info["time0"]) == pd.Timestamp
+    assert type(run_info["time0"]) == datetime.datetime
     assert run_info["time0"].year == 2020
     assert run_info["time0"].month == 3
     assert run_info["time0"].day == 19
     assert run_info["time0"].hour == 20
     assert run_info["time0"].minute == 00
 
-    assert type(run_info["last_obs_time"]) == pd.Timestamp
+    assert type(run_info["last_obs_time"]) == datetime.datetime
     assert run_info["last_obs_time"].year == 2020
     assert run_info["last_obs_time"].month == 3
     assert run_info["last_obs_time"].day == 19
@@ -199,16 +234,109 @@ def test_read_control_rules():
                      'Rule AdapterRule1.3\nIF SIMULATION DATE = 04/24/2020\nAND SIMULATION CLOCKTIME = 18:00:00\nTHEN OUTLET OL341 SETTING = 0.3\n\n' \
                      'Rule AdapterRule1.4\nIF SIMULATION DATE = 04/24/2020\nAND SIMULATION CLOCKTIME = 23:00:00\nTHEN OUTLET OL341 SETTING = 0.2\n\n'
 
+def test_read_control_rules_compact():
+    file = os.getcwd() + "\\input\\Control_rules_compact.xml"
+    with open(file, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<TimeSeries xmlns="http://www.wldelft.nl/fews/PI" version="1.5">\n'
+                '<timeZone>-5.0</timeZone>\n<series>\n<header>\n'
+                '<locationId>OL341</locationId>\n<parameterId>OUTLET</parameterId>\n'
+                '<missVal>NaN</missVal>\n</header>\n'
+                '<event date="2020-04-23" time="18:00:00" value="0.5" flag="8"/>\n'
+                '<event date="2020-04-23" time="19:00:00" value="0.50" flag="8"/>\n'
+                '<event date="2020-04-23" time="20:00:00" value="NaN" flag="8"/>\n'
+                '<event date="2020-04-23" time="21:00:00" value="0.5" flag="8"/>\n'
+                '<event date="2020-04-23" time="22:00:00" value="0.4" flag="8"/>\n'
+                '<event date="2020-04-23" time="23:00:00" value="0.4" flag="8"/>\n'
+                '</series>\n</TimeSeries>\n')
+    try:
+        assert list(read_control_rules(file).values())[0].count("Rule AdapterRule") == 5
+        dict = read_control_rules(file, compact=True)
+    finally:
+        os.remove(file)
+    assert list(dict.values())[0] == 'Rule AdapterRule1.1\nIF SIMULATION DATE = 04/23/2020\nAND SIMULATION CLOCKTIME = 18:00:00\nTHEN OUTLET OL341 SETTING = 0.5\n\n' \
+                                     'Rule AdapterRule1.2\nIF SIMULATION DATE = 04/23/2020\nAND SIMULATION CLOCKTIME = 22:00:00\nTHEN OUTLET OL341 SETTING = 0.4\n\n'
+
+
 def test_write_rainfall():
-    write_rainfall(os.getcwd() + '\\input\\rain.nc', os.getcwd() + '\\model\\DonRiver_rainfall.dat',
-                   col_to_convert=['station_id', 'station_names'])
-    assert os.path.exists(os.getcwd() + '\\model\\DonRiver_rainfall.dat')
+    rain_dat = os.getcwd() + '\\model\\test_write_rainfall.dat'
+    # No file or digest left by an earlier run: the rainfall is always written
+    for file in (rain_dat, rain_dat + ".digest"):
+        if os.path.exists(file):
+            os.remove(file)
+    write_rainfall(os.getcwd() + '\\input\\rain.nc', rain_dat, col_to_convert=['station_id', 'station_names'])
+    assert os.path.exists(rain_dat)
     # compare the result of the method to the expected contents of the INP file.
-    check_file_contents = filecmp.cmp(os.getcwd() + '\\model\\DonRiver_rainfall.dat',
-                                      os.getcwd() + '\\model\\DonRiver_rainfall_expected.dat')
+    check_file_contents = filecmp.cmp(rain_dat, os.getcwd() + '\\model\\DonRiver_rainfall_expected.dat',
+                                      shallow=False)
+    for file in (rain_dat, rain_dat + ".digest"):
+        os.remove(file)
     assert check_file_contents
 
 
+def test_write_rainfall_missing_values():
+    """
+    Test the rainfall .DAT rows for missing values and station ids with blanks.
+    """
+    rain_nc = os.getcwd() + "//input//test_rain_missing_values.nc"
+    rain_dat = os.getcwd() + "//model//test_rain_missing_values.dat"
+    ds = xr.Dataset({"P": (("time", "stations"), np.array([[0.1, np.nan], [0.0, 2.5]], dtype="float32")),
+                     "station_id": (("stations",), np.array([b"DON_1", b"DON 2"]))},
+                    coords={"time": pd.date_range("2020-03-19 01:00", periods=2, freq="H")})
+    ds.to_netcdf(rain_nc)
+    write_rainfall(rain_nc, rain_dat)
+    with open(rain_dat) as f:
+        lines = f.read().splitlines()
+    for file in (rain_nc, rain_dat, rain_dat + ".digest"):
+        os.remove(file)
+    assert lines == [";Rainfall      ",
+                     "DON_1 2020 3 19 1 0 0.10000000149011612",
+                     "DON_1 2020 3 19 2 0 0.0",
+                     r"DON\ 2 2020 3 19 1 0 ",
+                     r"DON\ 2 2020 3 19 2 0 2.5"]
+
+
+def test_write_rainfall_digest():
+    """
+    Test that the rainfall .DAT file is only rewritten when the rainfall changed, and only appended to when the
+    rainfall was extended in time.
+    """
+    rain_nc = os.getcwd() + "//input//test_rain_digest.nc"
+    rain_dat = os.getcwd() + "//model//test_rain_digest.dat"
+    ds = xr.Dataset({"P": (("time", "stations"), np.arange(8, dtype="float32").reshape(4, 2)),
+                     "station_id": (("stations",), np.array([b"DON_1", b"DON_2"]))},
+                    coords={"time": pd.date_range("2020-03-19 01:00", periods=4, freq="H")})
+    ds.isel(time=slice(0, 3)).to_netcdf(rain_nc)
+    write_rainfall(rain_nc, rain_dat)
+    assert os.path.exists(rain_dat + ".digest")
+    with open(rain_dat) as f:
+        written = f.read()
+    assert len(written.splitlines()) == 7
+
+    # Same rainfall: the file is not written again
+    mtime = os.stat(rain_dat).st_mtime_ns
+    write_rainfall(rain_nc, rain_dat)
+    assert os.stat(rain_dat).st_mtime_ns == mtime
+
+    # One more time step: only its rows are appended
+    ds.to_netcdf(rain_nc)
+    write_rainfall(rain_nc, rain_dat)
+    with open(rain_dat) as f:
+        appended = f.read()
+    assert appended == written + "DON_1 2020 3 19 4 0 6.0\nDON_2 2020 3 19 4 0 7.0\n"
+
+    # Changed rainfall: the file is written again
+    ds["P"][0, 0] = 10.0
+    ds.to_netcdf(rain_nc)
+    write_rainfall(rain_nc, rain_dat)
+    with open(rain_dat) as f:
+        lines = f.read().splitlines()
+    assert lines[1] == "DON_1 2020 3 19 1 0 10.0"
+    assert lines[4] == "DON_1 2020 3 19 4 0 6.0"
+    for file in (rain_nc, rain_dat, rain_dat + ".digest"):
+        os.remove(file)
+
+
 def test_write_runfile():
     run_info = read_run_info((os.getcwd() + '\\run_info.xml'))
     run_info["properties"]["swmm_input_file"] = os.getcwd() + "//model//standard.inp"
@@ -272,6 +400,116 @@ def test_write_runfile():
     with pytest.raises(SystemExit):
         read_rating_curve(os.getcwd() + '\\input\\Dam_rating_curve_0curves.xml')
 
+def test_write_runfile_template():
+    """
+    Test rendering the model input file from a template that is never modified.
+    """
+    run_info = read_run_info(os.getcwd() + "//run_info.xml")
+    template = os.getcwd() + "//model//test_template.inp"
+    shutil.copy(os.getcwd() + "//model//DonRiver_SOURCE TEST FILE.inp", template)
+    run_info["properties"]["swmm_template_file"] = template
+    run_info["properties"]["swmm_input_file"] = os.getcwd() + "//model//test_template_run.inp"
+    run_info["properties"]["inp_cache"] = "true"
+    cache_file = os.path.join(run_info["workDir"], "inp_cache", "test_template.inp.pkl")
+    rc_dict = read_rating_curve(run_info["dam_rating_curve"])
+    rule_dict = read_control_rules(run_info["control_rule"])
+
+    # Every run gives the same file: the control rules of the previous run are not in the template
+    for run in range(2):
+        write_runfile(run_info, rc_dict, rule_dict)
+        assert filecmp.cmp(run_info["properties"]["swmm_input_file"], os.getcwd() + "//model//DonRiver_expected.inp",
+                           shallow=False)
+    assert filecmp.cmp(template, os.getcwd() + "//model//DonRiver_SOURCE TEST FILE.inp", shallow=False)
+    # The cache is written to the work dir, not next to the template
+    assert os.path.exists(cache_file)
+    assert not os.path.exists(template + ".pkl")
+    for file in (template, cache_file, run_info["properties"]["swmm_input_file"]):
+        os.remove(file)
+    os.rmdir(os.path.dirname(cache_file))
+
+    # <string key="inp_cache" value="false"/> turns the cache off, as <bool .../> does
+    shutil.copy(os.getcwd() + "//model//DonRiver_SOURCE TEST FILE.inp", template)
+    run_info["properties"]["inp_cache"] = "false"
+    write_runfile(run_info, rc_dict, rule_dict)
+    assert not os.path.exists(cache_file)
+    for file in (template, run_info["properties"]["swmm_input_file"]):
+        os.remove(file)
+
+
+def test_read_inp():
+    """
+    Test parsing the *.inp file into sections, editing them and writing them back.
+    """
+    file = os.getcwd() + "//model//DonRiver_SOURCE TEST FILE.inp"
+    sections = read_inp(file)
+    assert [name for name, lines in sections][:3] == [None, "[TITLE]", "[OPTIONS]"]
+    write_inp(sections, os.getcwd() + "//model//test_read_inp.inp")
+    assert filecmp.cmp(file, os.getcwd() + "//model//test_read_inp.inp", shallow=False)
+    os.remove(os.getcwd() + "//model//test_read_inp.inp")
+
+    edited = set_inp_options(sections, {"START_DATE": "START_DATE           03/19/2020"})
+    options = dict(edited)["[OPTIONS]"]
+    assert "START_DATE           03/19/2020\n" in options
+    assert len(options) == len(dict(sections)["[OPTIONS]"])
+    assert "START_DATE           03/19/2020\n" not in dict(sections)["[OPTIONS]"]  # the parsed file is unchanged
+
+    edited, set_curves = set_inp_curves(sections, {"LOC_Y": "LOC_Y     Rating     1     2\n"})
+    assert set_curves == {"LocationX", "LOC_Y", "LOC_Z"}
+    curves = "".join(dict(edited)["[CURVES]"])
+    assert "LOC_Y     Rating     1     2\nLOC_Y" not in curves
+    assert "LOC_Y     Rating     1     2\n\n;" in curves
+
+    # File names made absolute, e.g. for the EPA SWMM shared library, which opens them from the working directory
+    edited = set_inp_file_paths(read_inp(os.getcwd() + "//model//DonRiver.inp"), "/work/Don")
+    gages = dict(edited)["[RAINGAGES]"]
+    assert gages[1] == dict(read_inp(os.getcwd() + "//model//DonRiver.inp"))["[RAINGAGES]"][1]  # comment line
+    assert gages[3] == 'DON_3            INTENSITY 1:00     1.0      FILE       "{0}"   DON_3    MM   \n'.format(
+        os.path.join("/work/Don", "model/rain.dat"))
+    edited = set_inp_file_paths([["[FILES]", ["[FILES]\n", "USE HOTSTART  hot.hsf\n", 'SAVE OUTFLOWS "/abs/out.txt"\n']]],
+                                "/work/Don")
+    assert edited[0][1][1:] == ['USE HOTSTART  "{0}"\n'.format(os.path.join("/work/Don", "hot.hsf")),
+                                'SAVE OUTFLOWS "/abs/out.txt"\n']
+
+    # Control rules are appended at the end of the [CONTROLS] section, also when it is the last section.
+    sections = [[None, []], ["[OPTIONS]", ["[OPTIONS]\n"]], ["[CONTROLS]", ["[CONTROLS]\n", "\n"]]]
+    edited = add_inp_controls(sections, {"OL341-OUTLET": "Rule AdapterRule1.1\n"})
+    assert edited[-1][1] == ["[CONTROLS]\n", "\n", "Rule AdapterRule1.1\n"]
+
+
+def test_read_inp_cached():
+    """
+    Test that the parsed *.inp file is reused while the file is unchanged.
+    """
+    file = os.getcwd() + "//model//test_read_inp_cached.inp"
+    shutil.copy(os.getcwd() + "//model//DonRiver_SOURCE TEST FILE.inp", file)
+    sections = read_inp_cached(file)
+    assert os.path.exists(file + ".pkl")
+    assert sections == read_inp(file)
+
+    # The cache is used, and not the file, as long as the file is unchanged
+    marked = [[name, list(lines)] for name, lines in sections]
+    marked[1][1][0] = "[TITLE] from the cache\n"
+    save_inp_cache(marked, file)
+    assert read_inp_cached(file)[1][1][0] == "[TITLE] from the cache\n"
+    os.utime(file, ns=(os.stat(file).st_atime_ns, os.stat(file).st_mtime_ns + 10 ** 9))  # same contents
+    assert read_inp_cached(file)[1][1][0] == "[TITLE] from the cache\n"
+
+    with open(file, "a") as f:
+        f.write("\n")
+    assert read_inp_cached(file) == read_inp(file)
+
+    # Threads of one process (e.g. a resident adapter) saving the same cache each write their own temporary file
+    threads = [threading.Thread(target=save_inp_cache, args=(sections, file)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert read_inp_cached(file) == sections
+    assert [f for f in os.listdir(os.getcwd() + "//model") if f.endswith(".tmp")] == []
+    os.remove(file)
+    os.remove(file + ".pkl")
+
+
 def test_create_xarray_dataset():
     run_info = read_run_info(os.getcwd() + '//run_info.xml')
     data_dict = read_rpt_file(run_info["properties"]["swmm_output_file"])
@@ -284,6 +522,15 @@ def test_create_xarray_dataset():
     assert type(combined_ds_nodes) == xr.Dataset
     assert type(combined_ds_links) == xr.Dataset
 
+    # Values are copied in place into (time x station_id) arrays
+    assert combined_ds_nodes['Head'].dims == ('time', 'station_id')
+    assert list(combined_ds_nodes.station_id.values) == sorted(combined_ds_nodes.station_id.values)
+    assert (combined_ds_nodes['Head'].sel(station_id='Node_J1').values == data_dict['Node_J1']['Data']['Head']).all()
+    assert combined_ds_links['Flow'].attrs['units'] == 'ft3_s1'
+
+    with pytest.raises(SystemExit):
+        create_xarray_dataset(data_dict, read_units(os.getcwd() + "//model//UDUNITS_lookup_MissingUnits.csv"))
+
 
 def test_add_attributes():
     """
@@ -348,6 +595,57 @@ def test_make_df():
     assert (df.columns == ['Inflow', 'Flooding', 'Depth', 'Head']).all()
 
 
+def test_decode_block():
+    """
+    Check the vectorized decoding of timeSeries rows into datetime64 times and float64 values.
+    """
+    file = os.getcwd() + "//model//test_make_df.csv"
+    with open(file) as f:
+        lines = f.readlines()
+    times, values = decode_block(lines[7:12], 4)
+    assert times.dtype == np.dtype("datetime64[ns]")
+    assert values.dtype == np.float64
+    assert values.shape == (5, 4)
+    assert pd.Timestamp(times[0]) == pd.to_datetime(lines[7].split()[0]) + pd.to_timedelta(lines[7].split()[1])
+    assert values[3, 0] == pytest.approx(0.004)
+    assert values[3, 2] == pytest.approx(0.027, 0.0001)
+
+    with pytest.raises(ValueError):
+        decode_block(lines[7:12], 5)
+
+
+def test_decode_block_time_axis():
+    """
+    Check that the time axis of a report is detected once and shared by the following blocks.
+    """
+    file = os.getcwd() + "//model//FEWS_Test_model_output.rpt"
+    with open(file) as f:
+        lines = f.readlines()
+    rows_j1 = lines[1475:1569]  # Node J1
+    rows_j2 = lines[1578:1672]  # Node J2
+    time_axis = {}
+    times_j1, values_j1 = decode_block(rows_j1, 4, time_axis)
+    assert isinstance(time_axis['times'], pd.DatetimeIndex)
+    assert time_axis['times'].freq == pd.Timedelta(minutes=15)
+    assert (time_axis['times'] == times_j1).all()
+
+    times_j2, values_j2 = decode_block(rows_j2, 4, time_axis)
+    assert times_j2 is time_axis['times']
+    assert (values_j2 == decode_block(rows_j2, 4)[1]).all()
+
+    # A block that does not match the report time axis is decoded entirely
+    times, values = decode_block(rows_j2[:-1], 4, time_axis)
+    assert (times == times_j1[:-1]).all()
+
+    # Irregular time steps: no shared time axis
+    file = os.getcwd() + "//model//test_make_df.csv"
+    with open(file) as f:
+        lines = f.readlines()
+    time_axis = {}
+    decode_block(lines[7:12], 4, time_axis)
+    assert time_axis['times'] is None
+
+
 def test_read_units():
     """
     Check if reading in the units lookup and attributes information properly.
@@ -449,6 +747,255 @@ def test_read_rpt_file():
     assert data_dict['Node_J001']['Data']['Head'].iloc[-1] == pytest.approx(291.763, 0.001)
 
 
+def test_iter_rpt_blocks():
+    """
+    Test the streaming generator over the timeSeries blocks of the *.rpt file.
+    """
+    file = os.getcwd() + "//model//FEWS_Test_model_output.rpt"
+    blocks = iter_rpt_blocks(file)
+    name, info, df = next(blocks)
+    assert name == "Subcatchment_DON_1"
+    assert info['Header'] == ['Precip.', 'Losses', 'Runoff']
+    assert info['Units'] == ['in/hr', 'in/hr', 'CFS']
+    assert (df.columns == ['Precip.', 'Losses', 'Runoff']).all()
+
+    names = [name] + [name for name, info, df in blocks]
+    assert len(names) == 20
+    assert names[-1] == "Link_C3"
+
+    data_dict = read_rpt_file(file)
+    for name, info, df in iter_rpt_blocks(file):
+        assert info['start_line'] == data_dict[name]['start_line']
+        assert info['end_line'] == data_dict[name]['end_line']
+        assert df.equals(data_dict[name]['Data'])
+
+
+def test_read_rpt_locations():
+    """
+    Test reading only some locations of the *.rpt file through its block index.
+    """
+    file = os.getcwd() + "//model//FEWS_Test_model_output.rpt"
+    index_file = os.getcwd() + "//model//FEWS_Test_model_output.rpt.idx"
+    data_dict = read_rpt_file(file)
+    blocks = index_rpt_file(file, index_file)
+    assert list(blocks.keys()) == list(data_dict.keys())
+    assert os.path.isfile(index_file)
+    assert index_rpt_file(file, index_file) == blocks
+
+    locations = read_rpt_locations(file, ["Link_C3", "Node_J1"], index_file)
+    os.remove(index_file)
+    assert list(locations.keys()) == ["Link_C3", "Node_J1"]
+    for name, info in locations.items():
+        assert info['start_line'] == data_dict[name]['start_line']
+        assert info['end_line'] == data_dict[name]['end_line']
+        assert info['units_dict'] == data_dict[name]['units_dict']
+        assert info['Data'].equals(data_dict[name]['Data'])
+
+    with pytest.raises(SystemExit):
+        read_rpt_locations(file, ["Node_Missing"])
+
+
+def test_read_rpt_file_filter():
+    """
+    Test the location/variable whitelist of the post-adapter, from the properties and from a filter file.
+    """
+    file = os.getcwd() + "//model//FEWS_Test_model_output.rpt"
+    filter_file = os.getcwd() + "//model//test_output_filter.csv"
+    with open(filter_file, "w") as f:
+        f.write("type,name\nlocation,Link_C3\nvariable,Depth\n")
+    locations, variables = read_output_filter({"output_locations": "Node_J1, Node_J2", "output_filter_file": filter_file})
+    os.remove(filter_file)
+    assert locations == ["Node_J1", "Node_J2", "Link_C3"]
+    assert variables == ["Depth"]
+    assert read_output_filter({}) == (None, None)
+
+    data_dict = read_rpt_file(file, locations, variables)
+    assert list(data_dict.keys()) == ["Node_J1", "Node_J2", "Link_C3"]
+    assert data_dict["Node_J1"]['Header'] == ["Depth"]
+    assert data_dict["Link_C3"]['units_dict'] == {"Depth": "feet"}
+    assert (data_dict["Node_J1"]['Data'].columns == ["Depth"]).all()
+    assert data_dict["Node_J1"]['Data']["Depth"].equals(read_rpt_file(file)["Node_J1"]['Data']["Depth"])
+
+    data_dict = read_rpt_file(file, object_types=("Node",))
+    assert len(data_dict) > 0 and all(name.startswith("Node_") for name in data_dict)
+    swmm_unit_dict = read_units(os.getcwd() + "//model//UDUNITS_lookup.csv")
+    combined_ds_nodes, combined_ds_links = create_xarray_dataset(data_dict, swmm_unit_dict)
+    assert combined_ds_nodes.sizes['station_id'] == len(data_dict)
+    assert combined_ds_links.sizes == frozendict({'time': 0, 'station_id': 0})
+
+
+def test_read_rpt_file_parallel():
+    """
+    Test that decoding the *.rpt blocks with a pool of worker processes gives the same results as a single process.
+    """
+    file = os.getcwd() + "//model//FEWS_Test_model_output.rpt"
+    data_dict = read_rpt_file(file)
+    parallel = read_rpt_file(file, workers=2)
+    assert list(parallel.keys()) == list(data_dict.keys())
+    for name, info in parallel.items():
+        assert info['start_line'] == data_dict[name]['start_line']
+        assert info['end_line'] == data_dict[name]['end_line']
+        assert info['units_dict'] == data_dict[name]['units_dict']
+        assert info['Data'].equals(data_dict[name]['Data'])
+
+    parallel = read_rpt_file(file, locations=["Node_J1", "Link_C3"], workers=2)
+    assert list(parallel.keys()) == ["Node_J1", "Link_C3"]
+
+
+def write_swmm_out(out_file, subcatchments, nodes, links, times, flow_code=0):
+    """
+    Write a small EPA SWMM binary output file (*.out) with synthetic results.
+    The value of variable k of object j at period t is t + 10 * j + 0.1 * k.
+    """
+    def ints(*values):
+        return np.array(values, dtype="<i4").tobytes()
+
+    counts = [len(subcatchments), len(nodes), len(links)]
+    n_vars = [8, 6, 5, 15]  # subcatchment, node, link and system variables without pollutants
+    header = ints(516114522, 51000, flow_code, *counts, 0)
+    ids = b"".join(ints(len(name)) + name.encode() for name in subcatchments + nodes + links)
+    props = b"".join(ints(n_props, *range(n_props)) + np.zeros(n_props * count, dtype="<f4").tobytes()
+                     for n_props, count in zip([1, 3, 5], counts))
+    variables = b"".join(ints(n, *range(n)) for n in n_vars)
+    days = (np.array(times, dtype="datetime64[s]") - np.datetime64("1899-12-30", "s")) / np.timedelta64(1, "D")
+    reporting = np.array([days[0]], dtype="<f8").tobytes() + ints(900)
+    periods = b""
+    for t, day in enumerate(days):
+        periods += np.array([day], dtype="<f8").tobytes()
+        for count, n in zip(counts + [1], n_vars):
+            values = [[t + 10 * j + 0.1 * k for k in range(n)] for j in range(count)]
+            periods += np.array(values, dtype="<f4").tobytes()
+    id_pos = len(header)
+    input_pos = id_pos + len(ids)
+    output_pos = input_pos + len(props) + len(variables) + len(reporting)
+    with open(out_file, "wb") as f:
+        f.write(header + ids + props + variables + reporting + periods)
+        f.write(ints(id_pos, input_pos, output_pos, len(times), 0, 516114522))
+
+
+def test_read_out_file():
+    """
+    Test reading the results from the EPA SWMM binary output file (*.out).
+    """
+    file = os.getcwd() + "//model//test_read_out_file.out"
+    times = pd.date_range("2020-03-18 20:15", periods=4, freq="15min")
+    write_swmm_out(file, ["DON_1"], ["J1", "J2", "Out1"], ["C1", "C2"], times, flow_code=3)
+    data_dict = read_out_file(file)
+    os.remove(file)
+
+    assert sorted(data_dict.keys()) == ['Link_C1', 'Link_C2', 'Node_J1', 'Node_J2', 'Node_Out1',
+                                        'Subcatchment_DON_1']
+    assert data_dict['Node_J2']['Header'] == ['Inflow', 'Flooding', 'Depth', 'Head']
+    assert data_dict['Node_J2']['Units'] == ['CMS', 'CMS', 'meters', 'meters']
+    assert data_dict['Link_C1']['Header'] == ['Flow', 'Velocity', 'Depth', 'Capacity']
+    assert data_dict['Link_C1']['units_dict'] == {'Flow': 'CMS', 'Velocity': 'm/sec', 'Depth': 'meters',
+                                                  'Capacity': 'Setting'}
+    assert (data_dict['Node_J2']['Data'].index == times).all()
+    assert data_dict['Node_J2']['Data']['Head'].iloc[2] == pytest.approx(2 + 10 + 0.1)
+    assert data_dict['Node_J2']['Data']['Inflow'].iloc[3] == pytest.approx(3 + 10 + 0.4)
+    assert data_dict['Link_C2']['Data']['Velocity'].iloc[0] == pytest.approx(10 + 0.2)
+    assert data_dict['Subcatchment_DON_1']['Data']['Losses'].iloc[1] == pytest.approx(2 * 1 + 0.2 + 0.3)
+
+    swmm_unit_dict = read_units(os.getcwd() + "//model//UDUNITS_lookup.csv")
+    combined_ds_nodes, combined_ds_links = create_xarray_dataset(data_dict, swmm_unit_dict)
+    assert combined_ds_nodes.sizes == frozendict({'time': 4, 'station_id': 3})
+    assert combined_ds_links.sizes == frozendict({'time': 4, 'station_id': 2})
+
+    write_swmm_out(file, ["DON_1"], ["J1", "J2", "Out1"], ["C1", "C2"], times, flow_code=3)
+    data_dict = read_out_file(file, locations=["Node_J2", "Link_C1"], variables=["Head", "Flow"])
+    os.remove(file)
+    assert sorted(data_dict.keys()) == ['Link_C1', 'Node_J2']
+    assert data_dict['Node_J2']['Header'] == ['Head']
+    assert data_dict['Node_J2']['Data']['Head'].iloc[2] == pytest.approx(2 + 10 + 0.1)
+
+    with pytest.raises(SystemExit):
+        read_out_file(os.getcwd() + "//model//FEWS_Test_model_output.rpt")
+
+
+class FakeSwmmLibrary:
+    """
+    Python stand-in for the EPA SWMM 5.2 shared library: nodes J1, J2, conduit C1 and weir W1, with results that
+    grow linearly with the elapsed time (hours), routed in 200 s steps and reported every 300 s.
+    """
+    def __init__(self, duration=1200):
+        self.names = {2: ["J1", "J2"], 3: ["C1", "W1"]}
+        self.duration = duration
+        self.time = 0
+        self.calls = []
+
+    def swmm_open(self, inp, rpt, out):
+        self.calls.append("open")
+        return 0
+
+    def swmm_start(self, save):
+        self.calls.append("start")
+        return 0
+
+    def swmm_step(self, elapsed):
+        self.time = self.time + 200 if self.time < self.duration else 0
+        elapsed._obj.value = self.time / 86400
+        return 0
+
+    def swmm_end(self):
+        self.calls.append("end")
+        return 0
+
+    def swmm_report(self):
+        self.calls.append("report")
+        return 0
+
+    def swmm_close(self):
+        self.calls.append("close")
+        return 0
+
+    def swmm_getError(self, message, size):
+        return 0
+
+    def swmm_getCount(self, object_type):
+        return len(self.names[object_type])
+
+    def swmm_getName(self, object_type, index, name, size):
+        name.value = self.names[object_type][index].encode("utf-8")
+
+    def swmm_getValue(self, code, index):
+        system = {0: 43908.0, 5: 300, 8: 3}  # start 2020-03-18, report step 300 s, CMS
+        if code < 100:
+            return system[code]
+        if code == 400:
+            return [0, 3][index]  # link type: C1 is a conduit, W1 a weir
+        if code == 405:
+            return 2.0  # full depth of C1, and height of the opening of W1
+        return code + index + self.time / 3600
+
+
+def test_run_swmm_library():
+    """
+    Test collecting the results while stepping the model with the EPA SWMM shared library.
+    """
+    swmm = FakeSwmmLibrary()
+    data_dict = run_swmm_library(swmm, "model.inp", "model.rpt")
+    assert swmm.calls == ["open", "start", "end", "report", "close"]
+    assert sorted(data_dict.keys()) == ['Link_C1', 'Link_W1', 'Node_J1', 'Node_J2']
+    assert data_dict['Node_J2']['Header'] == ['Inflow', 'Flooding', 'Depth', 'Head']
+    assert data_dict['Node_J2']['Units'] == ['CMS', 'CMS', 'meters', 'meters']
+    assert list(data_dict['Node_J2']['Data'].index) == list(pd.date_range("2020-03-18 00:05", periods=4, freq="5min"))
+    # reporting times (300 s, 600 s, ...) fall between the routing steps, and are interpolated
+    assert data_dict['Node_J2']['Data']['Head'].iloc[0] == pytest.approx(304 + 1 + 300 / 3600)
+    assert data_dict['Node_J2']['Data']['Inflow'].iloc[3] == pytest.approx(307 + 1 + 1200 / 3600)
+    assert data_dict['Link_C1']['Data']['Capacity'].iloc[1] == pytest.approx((411 + 600 / 3600) / 2.0)
+    # the Capacity of a weir is its setting, as in the *.rpt file, even though it has a full depth
+    assert data_dict['Link_W1']['Data']['Capacity'].iloc[1] == pytest.approx(407 + 1 + 600 / 3600)
+
+    data_dict = run_swmm_library(FakeSwmmLibrary(), "model.inp", "model.rpt", locations=["Link_C1"],
+                                 variables=["Depth"])
+    assert list(data_dict.keys()) == ['Link_C1']
+    assert data_dict['Link_C1']['Header'] == ['Depth']
+    assert data_dict['Link_C1']['Data']['Depth'].iloc[2] == pytest.approx(411 + 900 / 3600)
+
+    with pytest.raises(SystemExit):
+        run_swmm_library(FakeSwmmLibrary(duration=0), "model.inp", "model.rpt")
+
+
 def test_read_fail_rpt_file():
     """
     Test reading the results *.rpt file that should be failing.
@@ -495,6 +1042,29 @@ def test_read_errors_warnings():
     assert len(df_no_err_warn) == 0
 
 
+def test_read_diagnostics(tmp_path):
+    """
+    Test reading the messages of a *.rpt file as a list, without duplicates, up to its first timeSeries block.
+    """
+    file = os.getcwd() + "\\model\\FEWS_Test_model_output_exampleError.rpt"
+    assert read_diagnostics([file]) == list(zip(read_errors_warnings([file])["level"],
+                                                read_errors_warnings([file])["description"]))
+
+    rpt = tmp_path / "test_read_diagnostics.rpt"
+    rpt.write_text("  WARNING 03: negative offset ignored for Link C1\n"
+                   "  WARNING 03: negative offset ignored for Link C1\n"
+                   "  ERROR 317: cannot open rainfall data file RAINFALL.DAT.\n"
+                   "  <<< Node WARNING_J1 >>>\n"
+                   "  ERROR 999: not a message of the model\n")
+    assert read_diagnostics([rpt]) == [(2, "WARNING 03: negative offset ignored for Link C1"),
+                                       (1, "ERROR 317: cannot open rainfall data file RAINFALL.DAT.")]
+
+    xml = tmp_path / "test_read_diagnostics.xml"
+    write_run_diagnostics(read_diagnostics([rpt]), xml)
+    assert ('<line level="1" description="ERROR 317: cannot open rainfall data file RAINFALL.DAT."/>'
+            in xml.read_text())
+
+
 def test_write_run_diagnostics():
     """
     1) Remove both the Python log file and the Run Diagnostics
@@ -584,3 +1154,265 @@ def test_write_netcdf():
     assert not os.path.exists(file)
     write_netcdf(combined_ds_links, properties["out_links_netcdf"])
     assert os.path.exists(file)
+
+
+def test_write_netcdf_encoding():
+    """
+    Test the compression, packing and chunking options of the NetCDF output files.
+    """
+    data_dict = read_rpt_file(os.getcwd() + "//model//FEWS_Test_model_output.rpt")
+    swmm_unit_dict = read_units(os.getcwd() + "//model//UDUNITS_lookup.csv")
+    combined_ds_nodes, combined_ds_links = create_xarray_dataset(data_dict, swmm_unit_dict)
+    assert netcdf_encoding(combined_ds_nodes, {}) is None
+
+    file = os.getcwd() + "//output//test_write_netcdf_encoding.nc"
+    properties = {"netcdf_complevel": 4, "netcdf_dtype": "float32", "netcdf_chunk_by_station": True}
+    write_netcdf(combined_ds_nodes, file, netcdf_encoding(combined_ds_nodes, properties))
+    with xr.open_dataset(file) as ds:
+        assert ds["Depth"].encoding["zlib"]
+        assert ds["Depth"].encoding["complevel"] == 4
+        assert ds["Depth"].encoding["dtype"] == np.dtype("float32")
+        assert ds["Depth"].encoding["chunksizes"] == (combined_ds_nodes.sizes["time"], 1)
+        assert np.allclose(ds["Depth"].values, combined_ds_nodes["Depth"].values, rtol=1e-6)
+
+    properties = {"netcdf_dtype": "int16"}
+    write_netcdf(combined_ds_nodes, file, netcdf_encoding(combined_ds_nodes, properties))
+    with xr.open_dataset(file) as ds:
+        assert ds["Depth"].encoding["dtype"] == np.dtype("int16")
+        tolerance = float(combined_ds_nodes["Depth"].max() - combined_ds_nodes["Depth"].min()) / 65532
+        assert np.abs(ds["Depth"].values - combined_ds_nodes["Depth"].values).max() <= tolerance
+    os.remove(file)
+
+    with pytest.raises(SystemExit):
+        netcdf_encoding(combined_ds_nodes, {"netcdf_dtype": "float16"})
+
+
+def test_write_results_netcdf_stream():
+    """
+    Test appending the results to the NetCDF files while the model is running.
+    """
+    properties = {"UDUNITS": os.getcwd() + "//model//UDUNITS_lookup.csv",
+                  "out_nodes_netcdf": os.getcwd() + "//output//test_stream_nodes.nc",
+                  "out_links_netcdf": os.getcwd() + "//output//test_stream_links.nc",
+                  "netcdf_stream_periods": 3}
+    swmm_unit_dict = read_units(properties["UDUNITS"])
+    batches = []
+
+    def write_periods(data_dict):
+        write_results_netcdf(data_dict, properties, swmm_unit_dict, mode="a" if batches else "w")
+        batches.append(len(data_dict['Node_J1']['Data']))
+
+    assert run_swmm_library(FakeSwmmLibrary(duration=3000), "model.inp", "model.rpt", on_periods=write_periods,
+                            n_periods=3) is None
+    assert batches == [3, 3, 3, 1]
+
+    expected_nodes, expected_links = create_xarray_dataset(
+        run_swmm_library(FakeSwmmLibrary(duration=3000), "model.inp", "model.rpt"), swmm_unit_dict)
+    with xr.open_dataset(properties["out_nodes_netcdf"]) as ds:
+        assert ds.sizes["time"] == 10
+        assert (ds["time"].values == expected_nodes["time"].values).all()
+        np.testing.assert_allclose(ds["Head"].values, expected_nodes["Head"].values)
+        assert ds["Head"].attrs["units"] == expected_nodes["Head"].attrs["units"]
+    with xr.open_dataset(properties["out_links_netcdf"]) as ds:
+        np.testing.assert_allclose(ds["Capacity"].values, expected_links["Capacity"].values)
+    os.remove(properties["out_nodes_netcdf"])
+    os.remove(properties["out_links_netcdf"])
+
+
+def test_split_ensemble_rainfall(tmp_path):
+    """
+    Test splitting a member-indexed rainfall NetCDF file into one folder per member, and combining their results.
+    """
+    base_dir = tmp_path / "Don"
+    for folder in ("input", "model", "log", "output"):
+        (base_dir / folder).mkdir(parents=True)
+    shutil.copy(os.getcwd() + "//run_info.xml", base_dir / "run_info.xml")
+    shutil.copy(os.getcwd() + "//model//DonRiver.inp", base_dir / "model" / "DonRiver.inp")
+    (base_dir / "log" / "pre_adapter.log").write_text("INFO: old log")
+    with xr.open_dataset(os.getcwd() + "//input//rain.nc") as rain:
+        ensemble = xr.concat([rain, rain.assign(P=rain["P"] * 2)], dim="realization",
+                             data_vars=["P"]).assign_coords(realization=[3, 4])
+        ensemble.to_netcdf(base_dir / "input" / "rain_ensemble.nc")
+
+    member_files, realizations = split_ensemble_rainfall(base_dir / "run_info.xml",
+                                                         base_dir / "input" / "rain_ensemble.nc")
+    assert realizations == [3, 4]
+    assert member_files == [tmp_path / "Don_member_3" / "run_info.xml", tmp_path / "Don_member_4" / "run_info.xml"]
+    assert (tmp_path / "Don_member_4" / "model" / "DonRiver.inp").exists()
+    assert not (tmp_path / "Don_member_4" / "log" / "pre_adapter.log").exists()
+    root = ET.parse(member_files[1]).getroot()
+    member_rainfall = root.find("pi:inputNetcdfFile", {"pi": "http://www.wldelft.nl/fews/PI"}).text
+    assert member_rainfall == str(tmp_path / "Don_member_4" / "input" / "rain_ensemble.nc")
+    with xr.open_dataset(member_rainfall) as rain, xr.open_dataset(os.getcwd() + "//input//rain.nc") as expected:
+        assert "realization" not in rain["P"].dims
+        np.testing.assert_allclose(rain["P"].values, expected["P"].values * 2)
+
+    for k, member_file in enumerate(member_files):
+        ds = xr.Dataset({"Depth": (("time", "station_id"), np.full((2, 1), float(k)))},
+                        coords={"time": pd.date_range("2020-03-18", periods=2, freq="h"), "station_id": ["J1"]})
+        ds.to_netcdf(member_file.parents[0] / "output" / "DonRiver_output_nodes.nc")
+    combine_ensemble([f.parents[0] / "output" / "DonRiver_output_nodes.nc" for f in member_files], realizations,
+                     base_dir / "output" / "DonRiver_output_nodes.nc")
+    with xr.open_dataset(base_dir / "output" / "DonRiver_output_nodes.nc") as ds:
+        assert ds["Depth"].dims == ("realization", "time", "station_id")
+        assert list(ds["realization"].values) == [3, 4]
+        assert ds["Depth"].sel(realization=4).values.tolist() == [[1.0], [1.0]]
+
+    # Absolute paths in the folder of the run_info.xml are moved to the folder of each member
+    pi = {"pi": "http://www.wldelft.nl/fews/PI"}
+    tree = ET.parse(base_dir / "run_info.xml")
+    tree.getroot().find("pi:workDir", pi).text = str(base_dir)
+    tree.getroot().find("pi:outputDiagnosticFile", pi).text = str(base_dir / "log" / "run_diagnostics.xml")
+    tree.getroot().find("pi:properties/*[@key='swmm_input_file']", pi).set("value",
+                                                                           str(base_dir / "model" / "DonRiver.inp"))
+    tree.write(base_dir / "run_info.xml")
+    member_files, realizations = split_ensemble_rainfall(base_dir / "run_info.xml",
+                                                         base_dir / "input" / "rain_ensemble.nc")
+    root = ET.parse(member_files[0]).getroot()
+    assert root.find("pi:workDir", pi).text == str(tmp_path / "Don_member_3")
+    assert root.find("pi:outputDiagnosticFile", pi).text == str(tmp_path / "Don_member_3" / "log" /
+                                                                 "run_diagnostics.xml")
+    assert root.find("pi:properties/*[@key='swmm_input_file']", pi).get("value") == str(
+        tmp_path / "Don_member_3" / "model" / "DonRiver.inp")
+    assert root.find("pi:inputRatingCurveFile", pi).text == tree.getroot().find("pi:inputRatingCurveFile", pi).text
+
+    # A file written by the runs outside of that folder would be shared by the members
+    tree.getroot().find("pi:outputDiagnosticFile", pi).text = str(tmp_path / "run_diagnostics.xml")
+    tree.write(base_dir / "run_info.xml")
+    with pytest.raises(SystemExit):
+        split_ensemble_rainfall(base_dir / "run_info.xml", base_dir / "input" / "rain_ensemble.nc")
+
+
+def test_run_ensemble_member():
+    assert run_ensemble_member([sys.executable, "-c", "import sys"], "run_info.xml") is None
+    assert run_ensemble_member([sys.executable, "-c", "import sys; sys.exit('post' in sys.argv)"],
+                               "run_info.xml") == "post"
+
+
+
+def test_adapter(tmp_path):
+    """
+    Test running the pre-adapter of two run_info.xml folders at the same time, in one process.
+    """
+    shutil.copytree(Path(os.getcwd()).parents[0] / "bin", tmp_path / "bin")
+    for name in ("A", "B"):
+        shutil.copytree(os.getcwd(), tmp_path / name, ignore=shutil.ignore_patterns("*.log"))
+        # without control rules, which DonRiver.inp has no [CONTROLS] section for
+        run_info = (tmp_path / name / "run_info.xml").read_text()
+        run_info = "\n".join(line for line in run_info.split("\n") if "inputTimeSeriesFile" not in line)
+        (tmp_path / name / "run_info.xml").write_text(run_info)
+    cwd = os.getcwd()
+    errors = []
+
+    def pre(name):
+        try:
+            Adapter(tmp_path / name / "run_info.xml").pre()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=pre, args=(name,)) for name in ("A", "B")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert os.getcwd() == cwd
+    for name in ("A", "B"):
+        assert (tmp_path / name / "model" / "rain.dat").exists()
+        log = (tmp_path / name / "log" / "pre_adapter.log").read_text()
+        assert "Completed Pre-Adapter" in log
+        assert str(tmp_path / name / "run_info.xml") in log
+        assert str(tmp_path / ("B" if name == "A" else "A")) not in log
+        # each adapter has its own logger: its messages do not go to the log of the module
+        assert str(tmp_path / name) not in Path(logger_filename).read_text()
+
+    (tmp_path / "A" / "input" / "rain.nc").unlink()
+    with pytest.raises(AdapterError):
+        Adapter(tmp_path / "A" / "run_info.xml").pre()
+
+
+def test_post_adapter_locations(tmp_path):
+    """
+    Test the post-adapter with an output_locations filter: only the blocks of those locations are read from the
+    *.rpt file, through its index.
+    """
+    shutil.copytree(Path(os.getcwd()).parents[0] / "bin", tmp_path / "bin")
+    shutil.copytree(os.getcwd(), tmp_path / "A", ignore=shutil.ignore_patterns("*.log"))
+    run_info = (tmp_path / "A" / "run_info.xml").read_text().replace(
+        "</properties>", '<string key="output_locations" value="Node_J2,Link_C3,Subcatchment_DON_1"/>\n'
+                         '<string key="output_variables" value="Depth"/>\n</properties>')
+    (tmp_path / "A" / "run_info.xml").write_text(run_info)
+    Adapter(tmp_path / "A" / "run_info.xml").post()
+
+    assert (tmp_path / "A" / "model" / "DonRiver.rpt.idx").exists()
+    assert "Locations not found" not in (tmp_path / "A" / "log" / "post_adapter.log").read_text()
+    expected = read_rpt_file(tmp_path / "A" / "model" / "DonRiver.rpt", ["Node_J2", "Link_C3"], ["Depth"])
+    for kind, name in (("nodes", "Node_J2"), ("links", "Link_C3")):
+        with xr.open_dataset(tmp_path / "A" / "output" / "DonRiver_output_{0}.nc".format(kind)) as ds:
+            assert list(ds["station_id"].values) == [name]
+            assert list(ds.data_vars) == ["Depth"]
+            np.testing.assert_array_equal(ds["Depth"].values[:, 0], expected[name]["Data"]["Depth"].values)
+
+
+def test_serve_adapter(tmp_path):
+    """
+    Test sending commands to a resident adapter on a localhost port.
+    """
+    shutil.copytree(Path(os.getcwd()).parents[0] / "bin", tmp_path / "bin")
+    shutil.copytree(os.getcwd(), tmp_path / "A", ignore=shutil.ignore_patterns("*.log"))
+    run_info = (tmp_path / "A" / "run_info.xml").read_text()
+    run_info = "\n".join(line for line in run_info.split("\n") if "inputTimeSeriesFile" not in line)
+    (tmp_path / "A" / "run_info.xml").write_text(run_info)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        address = "127.0.0.1:{0}".format(s.getsockname()[1])
+    assert forward_command(address, "pre", tmp_path / "A" / "run_info.xml") is None
+    # any client could run a model executable through it: only loopback addresses are accepted
+    with pytest.raises(AdapterError):
+        serve_adapter("0.0.0.0" + address[address.index(":"):])
+
+    server = threading.Thread(target=serve_adapter, args=(address,))
+    server.start()
+    try:
+        for _ in range(100):
+            result = forward_command(address, "pre", tmp_path / "A" / "run_info.xml")
+            if result is not None:
+                break
+            time.sleep(0.1)
+        assert result == (0, "")
+        assert "Completed Pre-Adapter" in (tmp_path / "A" / "log" / "pre_adapter.log").read_text()
+
+        (tmp_path / "A" / "input" / "rain.nc").unlink()
+        exit_code, message = forward_command(address, "pre", tmp_path / "A" / "run_info.xml")
+        assert exit_code == 1
+        assert "pre_adapter.log" in message
+        assert forward_command(address, "clean", tmp_path / "A" / "run_info.xml")[0] == 1
+    finally:
+        assert forward_command(address, "stop", "") == (0, "")
+        server.join(10)
+    assert not server.is_alive()
+
+
+def test_stage_timer(tmp_path):
+    """
+    Test timing and profiling the stages of a command, and writing its metrics file.
+    """
+    run_context.logger_filename = str(tmp_path / "post_adapter.log")
+    run_context.stages = []
+    run_context.profile = True
+    try:
+        with stage_timer("read_results"):
+            with stage_timer("inner"):  # part of read_results
+                sum(range(100000))
+        write_stage_metrics({"stage_metrics": True})
+        stages = run_context.stages
+    finally:
+        del run_context.logger_filename, run_context.stages, run_context.profile
+    assert [stage["stage"] for stage in stages] == ["read_results"]
+    assert stages[0]["wall_time"] > 0
+    assert stages[0]["cpu_time"] >= 0
+    assert stages[0]["peak_rss_mb"] is None or stages[0]["peak_rss_mb"] > 0
+    assert pstats.Stats(str(tmp_path / "post_adapter_read_results.prof")).total_calls > 0
+    assert not (tmp_path / "post_adapter_inner.prof").exists()
+    with open(tmp_path / "post_adapter_metrics.json") as f:
+        assert json.load(f)["stages"] == stages